@@ -0,0 +1,206 @@
+"""
+Socket activation of services.
+
+A service may set, in its `[service]` section:
+
+    listen=8000               # or host:port, or the path of a unix socket
+    listen_target=8001        # proxy connections to this address instead
+
+When it is started, the server binds `listen` itself and reports the service
+as LISTENING, but only spawns it once the first connection arrives.
+
+Without `listen_target`, the listening socket is handed to the service the way
+systemd does it: as file descriptor 3, with LISTEN_FDS and LISTEN_PID set in
+its environment. The service accepts the connection that woke it and
+everything after it. With `listen_target`, for services that bind their own
+port, the server accepts connections itself and proxies each one to
+`listen_target` once the service is ready.
+
+The socket stays bound while the service is restarted, so connections made in
+the meantime wait rather than being refused, and when the service exits
+without being restarted the server goes back to listening for it. Stopping
+the service closes the socket.
+"""
+
+import asyncio
+import logging
+import sys
+
+from .proxy import (
+    bind,
+    format_address,
+    parse_address,
+    remove_socket_file,
+    serve,
+)
+
+
+logger = logging.getLogger()
+
+
+# run in place of the service's command: moves the sockets to descriptors
+# 3 and up, sets LISTEN_PID to its own pid (which exec keeps) and then execs
+# the command
+ACTIVATE_SCRIPT = """\
+import fcntl, os, sys
+fds = [int(fd) for fd in sys.argv[1].split(",")]
+moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, 3 + len(fds)) for fd in fds]
+for fd in fds:
+    os.close(fd)
+for i, fd in enumerate(moved):
+    os.dup2(fd, 3 + i)
+    os.close(fd)
+os.environ["LISTEN_FDS"] = str(len(fds))
+os.environ["LISTEN_PID"] = str(os.getpid())
+os.execvp(sys.argv[2], sys.argv[2:])
+"""
+
+
+class SocketActivation(object):
+    """
+    The listening sockets of one service, and what to do with connections
+    to them.
+    """
+
+    def __init__(self, name, addresses, target=None):
+        self.name = name
+        self.addresses = addresses
+        self.target = target
+        self.sockets = []
+        self.tasks = []
+        self.armed = False
+
+    def __str__(self):
+        return ", ".join(format_address(a) for a in self.addresses)
+
+    @classmethod
+    def create(cls, name, config):
+        """
+        The service's activation settings, or None if it does not set
+        `listen`.
+        """
+
+        values = config["service"]
+
+        addresses = [
+            parse_address(a)
+            for a in values.get("listen", "").split(",")
+            if a.strip()
+        ]
+
+        if not addresses:
+            return None
+
+        target = None
+        if values.get("listen_target"):
+            target = parse_address(values["listen_target"])
+
+        return cls(name, addresses, target)
+
+    def is_open(self):
+        return bool(self.sockets)
+
+    def matches(self, other):
+        return (
+            other is not None
+            and (self.addresses, self.target) == (other.addresses, other.target)
+        )
+
+    def open(self):
+        """
+        Bind the listening sockets, raising OSError if any of them cannot be.
+        """
+
+        try:
+            for address in self.addresses:
+                self.sockets.append(bind(address))
+        except OSError:
+            self.close()
+            raise
+
+        logger.info(
+            "[locald] listening on {} for service {}"
+            .format(self, self.name)
+        )
+
+    def pause(self):
+        """
+        Stop accepting or waiting for connections, leaving them to wait on
+        the sockets.
+        """
+
+        self.disarm()
+
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def close(self):
+
+        self.pause()
+
+        for address in self.addresses:
+            if isinstance(address, str):
+                remove_socket_file(address)
+
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+
+    def get_fds(self):
+        return [sock.fileno() for sock in self.sockets]
+
+    def arm(self, activate):
+        """
+        Call `activate` when a connection arrives, without accepting it.
+        """
+
+        if self.armed:
+            return
+
+        loop = asyncio.get_running_loop()
+        for sock in self.sockets:
+            loop.add_reader(sock.fileno(), self.fire, activate)
+
+        self.armed = True
+
+    def disarm(self):
+
+        if not self.armed:
+            return
+
+        loop = asyncio.get_running_loop()
+        for sock in self.sockets:
+            loop.remove_reader(sock.fileno())
+
+        self.armed = False
+
+    def fire(self, activate):
+        self.disarm()
+        activate()
+
+    def serve(self, handle_connection):
+        """
+        Accept connections on the listening sockets, handing each one to
+        `handle_connection(client)`.
+        """
+
+        if self.tasks:
+            return
+
+        for sock in self.sockets:
+            self.tasks.append(asyncio.ensure_future(serve(sock, handle_connection)))
+
+
+def get_activation_args(args, fds):
+    """
+    Wrap the service command `args` so it starts with `fds` passed to it as
+    the LISTEN_FDS protocol expects.
+    """
+
+    return [
+        sys.executable,
+        "-c",
+        ACTIVATE_SCRIPT,
+        ",".join(str(fd) for fd in fds),
+    ] + list(args)
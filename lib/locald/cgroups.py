@@ -0,0 +1,591 @@
+"""
+Per-service cgroups and resource limits.
+
+Services with limits that need a cgroup (every setting below but `nice`) run
+in a cgroup of their own, `<name>.service`, created under the cgroup locald
+was started in (or `cgroup_path` from the `[locald]` section). The server
+moves itself into `locald.server` next to them, since once controllers are
+enabled only leaf cgroups may hold processes, and undoes all of this when it
+stops, unless services are still running in their cgroups.
+
+Since that changes the cgroup locald was started in, it is only done where
+that cgroup was delegated to it (systemd's `Delegate=yes`), where
+`cgroup_path` is set, or with `cgroups=yes` in the `[locald]` section.
+`cgroups=no` disables it altogether.
+
+A service's process tree is then the membership of its cgroup, which includes
+anything that daemonized, and killing a service kills the whole cgroup at
+once.
+
+Services may set:
+
+    memory_max=512M     # memory.max
+    cpu_weight=50       # cpu.weight, 1-10000 (default 100)
+    cpu_max=150%        # cpu.max, as a percentage of one CPU
+    io_weight=50        # io.weight, 1-10000 (default 100)
+    nice=10             # -20 to 19
+    cpu_affinity=0-3,6  # CPUs the service may run on
+
+Limits need the matching controller to be enabled for the cgroup locald runs
+in, which usually means running it with delegation, e.g.
+`systemd-run --user --scope -p Delegate=yes locald server-start`. Without
+cgroups, `nice` and `cpu_affinity` are applied to the processes directly,
+`cpu_weight` is approximated with a nice value, and the other limits are
+ignored with a warning.
+"""
+
+import errno
+import logging
+import os
+import signal
+import sys
+
+import psutil
+
+from .logs import parse_size
+
+
+logger = logging.getLogger()
+
+
+# the controllers for which limits can be set
+CONTROLLERS = ["cpu", "cpuset", "io", "memory"]
+
+CPU_MAX_PERIOD = 100000
+
+# the extended attributes systemd sets on cgroups it delegated
+DELEGATE_XATTRS = ["trusted.delegate", "user.delegate"]
+
+# run in place of the service's command: moves itself into the service's
+# cgroup, so that it is there before it can spawn anything, and then execs
+# the command, which keeps its pid
+CGROUP_SCRIPT = """\
+import os, sys
+try:
+    with open(os.path.join(sys.argv[1], "cgroup.procs"), "w") as fp:
+        fp.write(str(os.getpid()))
+except OSError as ex:
+    sys.exit("locald: unable to join cgroup {}: {}".format(sys.argv[1], ex))
+os.execvp(sys.argv[2], sys.argv[2:])
+"""
+
+
+class CgroupError(ValueError):
+    pass
+
+
+class ResourceLimits(object):
+    """
+    A service's resource limits, parsed from its configuration.
+    """
+
+    def __init__(self, config):
+        values = config["service"]
+
+        self.memory_max = None
+        if values.get("memory_max"):
+            self.memory_max = parse_size(values["memory_max"])
+
+        self.cpu_weight = get_int(values, "cpu_weight", 1, 10000)
+        self.io_weight = get_int(values, "io_weight", 1, 10000)
+        self.nice = get_int(values, "nice", -20, 19)
+
+        self.cpu_max = None
+        if values.get("cpu_max"):
+            percent = values["cpu_max"].strip().rstrip("%")
+            try:
+                self.cpu_max = float(percent)
+            except ValueError:
+                raise CgroupError("invalid cpu_max '{}'".format(values["cpu_max"]))
+
+            if self.cpu_max <= 0:
+                raise CgroupError("cpu_max must be greater than 0%")
+
+        self.cpu_affinity = None
+        if values.get("cpu_affinity"):
+            self.cpu_affinity = parse_cpus(values["cpu_affinity"])
+
+    def get_settings(self):
+        """
+        The cgroup interface files to write, as (controller, file, value).
+        """
+
+        settings = []
+
+        if self.memory_max is not None:
+            settings.append(("memory", "memory.max", str(self.memory_max)))
+
+        if self.cpu_weight is not None:
+            settings.append(("cpu", "cpu.weight", str(self.cpu_weight)))
+
+        if self.cpu_max is not None:
+            quota = int(CPU_MAX_PERIOD * self.cpu_max / 100)
+            settings.append((
+                "cpu",
+                "cpu.max",
+                "{} {}".format(quota, CPU_MAX_PERIOD),
+            ))
+
+        if self.io_weight is not None:
+            settings.append(("io", "io.weight", "default {}".format(self.io_weight)))
+
+        if self.cpu_affinity is not None:
+            settings.append((
+                "cpuset",
+                "cpuset.cpus",
+                ",".join(str(cpu) for cpu in self.cpu_affinity),
+            ))
+
+        return settings
+
+
+class Cgroup(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def write(self, filename, value):
+        with open(os.path.join(self.path, filename), "w") as fp:
+            fp.write(value)
+
+    def add(self, pid):
+        self.write("cgroup.procs", str(pid))
+
+    def get_pids(self):
+
+        try:
+            with open(os.path.join(self.path, "cgroup.procs")) as fp:
+                return [int(line) for line in fp if line.strip()]
+        except OSError:
+            return []
+
+    def kill(self):
+        """
+        SIGKILL every process in the cgroup, atomically where the kernel
+        supports cgroup.kill. Refuses to if the server is in it.
+        """
+
+        pids = self.get_pids()
+        if os.getpid() in pids:
+            logger.error(
+                "[locald] not killing cgroup {}, the server is in it"
+                .format(self.path)
+            )
+            return
+
+        try:
+            self.write("cgroup.kill", "1")
+            return
+        except OSError:
+            pass
+
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def remove(self):
+        """
+        Remove the cgroup if nothing is left in it.
+        """
+
+        try:
+            os.rmdir(self.path)
+        except OSError as ex:
+            if ex.errno not in (errno.ENOENT, errno.EBUSY):
+                logger.warning(
+                    "[locald] unable to remove cgroup {}: {}"
+                    .format(self.path, ex)
+                )
+
+
+class CgroupManager(object):
+    """
+    Creates and places services in their cgroups.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.server = Cgroup(os.path.join(path, "locald.server"))
+        self.controllers = set()
+        # those enabled by locald, which it disables again when it stops
+        self.enabled = set()
+
+    @classmethod
+    def create(cls, config):
+        """
+        Set up cgroups for the server, returning None if they are disabled
+        or cannot be used here.
+        """
+
+        setting = config["locald"].get("cgroups", "auto").lower()
+        if setting in ("0", "false", "no", "off"):
+            return None
+
+        path = config["locald"].get("cgroup_path")
+        explicit = setting in ("1", "true", "yes", "on") or path is not None
+
+        resumed = False
+        if path is None:
+            path = get_own_cgroup()
+            if path is None:
+                logger.info(
+                    "[locald] no cgroup v2 hierarchy found, not using cgroups"
+                )
+                return None
+
+            # a server replaced by server-reload left it in there
+            if os.path.basename(path) == "locald.server":
+                path = os.path.dirname(path)
+                resumed = True
+
+        if not explicit and not is_delegated(path):
+            logger.info(
+                "[locald] cgroup {} was not delegated to locald, not using "
+                "cgroups (set cgroups=yes to use it anyway)"
+                .format(path)
+            )
+            return None
+
+        manager = cls(path)
+
+        try:
+            manager.setup(resumed)
+        except OSError as ex:
+            logger.info(
+                "[locald] unable to use cgroups under {}: {}"
+                .format(path, ex)
+            )
+            return None
+
+        return manager
+
+    def setup(self, resumed=False):
+
+        os.makedirs(self.server.path, exist_ok=True)
+        self.server.add(os.getpid())
+
+        with open(os.path.join(self.path, "cgroup.controllers")) as fp:
+            available = set(fp.read().split())
+
+        enabled = self.get_subtree_control()
+
+        for controller in CONTROLLERS:
+            if controller not in available:
+                continue
+
+            if controller in enabled:
+                self.controllers.add(controller)
+                # the server it replaced enabled them
+                if resumed:
+                    self.enabled.add(controller)
+                continue
+
+            try:
+                Cgroup(self.path).write(
+                    "cgroup.subtree_control",
+                    "+{}".format(controller),
+                )
+            except OSError as ex:
+                logger.info(
+                    "[locald] unable to enable the {} controller under {}: {}"
+                    .format(controller, self.path, ex)
+                )
+            else:
+                self.controllers.add(controller)
+                self.enabled.add(controller)
+
+        logger.info(
+            "[locald] running services in cgroups under {} (controllers: {})"
+            .format(self.path, ", ".join(sorted(self.controllers)) or "none")
+        )
+
+    def close(self):
+        """
+        Undo setup: disable the controllers locald enabled, move the server
+        back to the cgroup it was started in and remove `locald.server`.
+        Nothing is changed while services are left in cgroups of their own.
+        """
+
+        try:
+            left = [
+                entry.name
+                for entry in os.scandir(self.path)
+                if entry.is_dir() and entry.path != self.server.path
+                and Cgroup(entry.path).get_pids()
+            ]
+        except OSError:
+            return
+
+        if left:
+            logger.info(
+                "[locald] leaving cgroups under {} as they are, processes "
+                "are still running in {}"
+                .format(self.path, ", ".join(sorted(left)))
+            )
+            return
+
+        parent = Cgroup(self.path)
+
+        try:
+            for controller in sorted(self.enabled):
+                parent.write(
+                    "cgroup.subtree_control",
+                    "-{}".format(controller),
+                )
+
+            parent.add(os.getpid())
+        except OSError as ex:
+            logger.info(
+                "[locald] unable to move the server back to {}: {}"
+                .format(self.path, ex)
+            )
+            return
+
+        self.server.remove()
+
+    def get_subtree_control(self):
+
+        with open(os.path.join(self.path, "cgroup.subtree_control")) as fp:
+            return set(fp.read().split())
+
+    def get_cgroup(self, name):
+        return Cgroup(os.path.join(self.path, "{}.service".format(name)))
+
+    def prepare(self, name, limits):
+        """
+        Create the service's cgroup and apply `limits` to it. Returns the
+        cgroup and the settings that could not be applied.
+        """
+
+        cgroup = self.get_cgroup(name)
+        os.makedirs(cgroup.path, exist_ok=True)
+
+        unapplied = []
+        for controller, filename, value in limits.get_settings():
+            if controller not in self.controllers:
+                unapplied.append(filename)
+                continue
+
+            try:
+                cgroup.write(filename, value)
+            except OSError as ex:
+                logger.warning(
+                    "[locald] unable to set {} for {}: {}"
+                    .format(filename, name, ex)
+                )
+                unapplied.append(filename)
+
+        return cgroup, unapplied
+
+
+def spawn(name, limits, manager, popen):
+    """
+    Start a service by calling `popen(cgroup)`, with its own cgroup if
+    cgroups are in use (or None), which the process has to move itself into,
+    see get_cgroup_args. Applies whatever limits the cgroup could not to its
+    processes directly. Returns the process and its cgroup, or None.
+    """
+
+    cgroup, unapplied = prepare_cgroup(name, limits, manager)
+
+    process = popen(cgroup)
+
+    apply_limits(name, limits, unapplied, process)
+
+    return process, cgroup
+
+
+def prepare_cgroup(name, limits, manager):
+    """
+    The first half of spawn: the service's cgroup, or None, and the limits
+    it could not apply. Services without any cgroup settings are not given a
+    cgroup, which spares them the detour through CGROUP_SCRIPT.
+    """
+
+    cgroup = None
+    unapplied = [filename for _, filename, _ in limits.get_settings()]
+
+    if manager is not None and unapplied:
+        try:
+            cgroup, unapplied = manager.prepare(name, limits)
+        except OSError as ex:
+            logger.warning(
+                "[locald] unable to start {} in a cgroup: {}"
+                .format(name, ex)
+            )
+            cgroup = None
+
+    return cgroup, unapplied
+
+
+def apply_limits(name, limits, unapplied, process):
+    """
+    The second half of spawn: apply the `unapplied` limits to `process` and
+    what it has spawned so far.
+    """
+
+    nice = limits.nice
+    if nice is None and "cpu.weight" in unapplied:
+        nice = get_nice_for_weight(limits.cpu_weight)
+
+    for filename in ("memory.max", "cpu.max", "io.weight"):
+        if filename in unapplied:
+            logger.warning(
+                "[locald] {} for {} needs cgroups with its controller enabled, "
+                "ignoring it"
+                .format(filename, name)
+            )
+
+    affinity = None
+    if "cpuset.cpus" in unapplied:
+        affinity = limits.cpu_affinity
+
+    if nice is None and affinity is None:
+        return
+
+    try:
+        parent = psutil.Process(process.pid)
+        # anything it may already have spawned was not around to inherit
+        processes = [parent] + parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+
+    for p in processes:
+        try:
+            if nice is not None:
+                p.nice(nice)
+
+            if affinity is not None:
+                p.cpu_affinity(affinity)
+        except (psutil.NoSuchProcess, psutil.AccessDenied, OSError) as ex:
+            logger.warning(
+                "[locald] unable to set priority of {} pid {}: {}"
+                .format(name, p.pid, ex)
+            )
+
+
+def get_cgroup_args(args, cgroup):
+    """
+    Wrap the service command `args` so that it moves into `cgroup` before
+    running.
+    """
+
+    return [sys.executable, "-c", CGROUP_SCRIPT, cgroup.path] + list(args)
+
+
+def is_delegated(path):
+    """
+    Whether systemd delegated the cgroup at `path` to what runs in it.
+    """
+
+    for name in DELEGATE_XATTRS:
+        try:
+            if os.getxattr(path, name) == b"1":
+                return True
+        except OSError:
+            pass
+
+    return False
+
+
+def get_own_cgroup():
+    """
+    The path of the cgroup v2 group this process is in, or None if there is
+    no cgroup v2 hierarchy.
+    """
+
+    mount = None
+    try:
+        with open("/proc/mounts") as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) > 2 and fields[2] == "cgroup2":
+                    mount = fields[1]
+                    break
+    except OSError:
+        return None
+
+    if mount is None:
+        return None
+
+    try:
+        with open("/proc/self/cgroup") as fp:
+            for line in fp:
+                if line.startswith("0::"):
+                    relative = line[3:].strip().lstrip("/")
+                    return os.path.join(mount, relative).rstrip("/")
+    except OSError:
+        return None
+
+    return None
+
+
+def get_int(values, key, minimum, maximum):
+
+    if not values.get(key):
+        return None
+
+    try:
+        value = int(values[key])
+    except ValueError:
+        raise CgroupError("invalid {} '{}'".format(key, values[key]))
+
+    if not minimum <= value <= maximum:
+        raise CgroupError(
+            "{} must be between {} and {}"
+            .format(key, minimum, maximum)
+        )
+
+    return value
+
+
+def parse_cpus(value):
+    """
+    Parse a list of CPUs such as "0-3,6".
+    """
+
+    cpus = set()
+
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+
+        try:
+            if "-" in part:
+                first, last = part.split("-", 1)
+                cpus.update(range(int(first), int(last) + 1))
+            else:
+                cpus.add(int(part))
+        except ValueError:
+            raise CgroupError("invalid cpu_affinity '{}'".format(value))
+
+    if not cpus:
+        raise CgroupError("invalid cpu_affinity '{}'".format(value))
+
+    return sorted(cpus)
+
+
+def get_nice_for_weight(weight):
+    """
+    The nice value closest to a cpu.weight, each nice step being worth
+    about 25% more or less CPU, with weight 100 at nice 0.
+    """
+
+    nice = 0
+    relative = weight / 100
+
+    while relative > 1.125 and nice > -20:
+        relative /= 1.25
+        nice -= 1
+
+    while relative < 0.9 and nice < 19:
+        relative *= 1.25
+        nice += 1
+
+    return nice
@@ -1,13 +1,14 @@
 # Copyright 2020, Ryan P. Kelly.
 
 import argparse
+import datetime
 import os
-import shutil
+import re
 import sys
 import time
 
 from locald.client import Client
-from locald.config import get_config, get_config_for_service
+from locald.config import get_config
 from locald.server import ensure_server, is_server_running, stop_server
 
 
@@ -43,6 +44,9 @@ class App(object):
         server_stop_parser = subparsers.add_parser("server-stop")
         server_stop_parser.set_defaults(func=self.server_stop)
 
+        server_reload_parser = subparsers.add_parser("server-reload")
+        server_reload_parser.set_defaults(func=self.server_reload)
+
         server_wait_parser = subparsers.add_parser("server-wait")
         server_wait_parser.add_argument(
             "--timeout",
@@ -59,7 +63,10 @@ class App(object):
         start_parser = subparsers.add_parser("start")
         start_parser.set_defaults(func=self.start)
 
-        start_parser.add_argument("name")
+        start_parser.add_argument(
+            "name",
+            help="service name, comma separated list of names or ALL",
+        )
 
         start_parser.add_argument(
             "--dependencies-only",
@@ -70,18 +77,87 @@ class App(object):
         stop_parser = subparsers.add_parser("stop")
         stop_parser.set_defaults(func=self.stop)
 
-        stop_parser.add_argument("name")
+        stop_parser.add_argument(
+            "name",
+            help="service name, comma separated list of names or ALL",
+        )
 
         restart_parser = subparsers.add_parser("restart")
         restart_parser.set_defaults(func=self.restart)
 
-        restart_parser.add_argument("name")
+        restart_parser.add_argument(
+            "name",
+            help="service name, comma separated list of names or ALL",
+        )
+
+        scale_parser = subparsers.add_parser("scale")
+        scale_parser.set_defaults(func=self.scale)
+
+        scale_parser.add_argument(
+            "name",
+            help="name of a service that sets replicas",
+        )
+
+        scale_parser.add_argument(
+            "count",
+            help="number of instances to run",
+            type=int,
+        )
 
         status_parser = subparsers.add_parser("status")
         status_parser.set_defaults(func=self.status)
 
         status_parser.add_argument("names")
 
+        status_parser.add_argument(
+            "--verbose",
+            "-v",
+            help="show pid, uptime, restarts, last exit code and resource "
+            "usage for each service",
+            action="store_true",
+        )
+
+        status_parser.add_argument(
+            "--json",
+            help="print the detailed status as JSON",
+            action="store_true",
+        )
+
+        top_parser = subparsers.add_parser("top")
+        top_parser.set_defaults(func=self.top)
+
+        top_parser.add_argument(
+            "names",
+            nargs="?",
+            default="ALL",
+            help="service name, comma separated list of names or ALL "
+            "(default)",
+        )
+
+        top_parser.add_argument(
+            "--sort",
+            "-s",
+            help="order services by cpu (default), rss, io or name",
+            choices=["cpu", "rss", "io", "name"],
+            default="cpu",
+        )
+
+        top_parser.add_argument(
+            "--once",
+            help="print the current usage once instead of updating it",
+            action="store_true",
+        )
+
+        top_parser.add_argument(
+            "--history",
+            help="number of samples of CPU usage to draw (default 30)",
+            type=int,
+            default=30,
+        )
+
+        reload_parser = subparsers.add_parser("reload")
+        reload_parser.set_defaults(func=self.reload)
+
         logs_parser = subparsers.add_parser("logs")
         logs_parser.set_defaults(func=self.logs)
 
@@ -90,6 +166,49 @@ class App(object):
             action="store_true",
         )
 
+        logs_parser.add_argument(
+            "--lines",
+            "-n",
+            help="number of lines to show first (default: 10 when following "
+            "without a query, otherwise all of them)",
+            type=int,
+        )
+
+        logs_parser.add_argument(
+            "--since",
+            help="only show lines captured after this time, either a date "
+            "and/or time (2020-06-01 12:30, 12:30:15) or a duration ago (90s, "
+            "10m, 2h, 1d)",
+            type=parse_time,
+        )
+
+        logs_parser.add_argument(
+            "--until",
+            help="only show lines captured before this time, in the same "
+            "formats as --since",
+            type=parse_time,
+        )
+
+        logs_parser.add_argument(
+            "--grep",
+            "-g",
+            help="only show lines matching this regular expression",
+        )
+
+        logs_parser.add_argument(
+            "--timestamps",
+            "-t",
+            help="show the time each line was captured",
+            action="store_true",
+        )
+
+        logs_parser.add_argument(
+            "--color",
+            help="color service names (default: auto, only on a terminal)",
+            choices=["auto", "always", "never"],
+            default="auto",
+        )
+
         logs_parser.add_argument("names")
 
         args = parser.parse_args()
@@ -104,20 +223,6 @@ class App(object):
 
         return returncode
 
-    def get_services(self, config, args_names):
-
-        names = [n.strip() for n in args_names.split(",") if n.strip()]
-
-        if "ALL" in names:
-            for key, values in config.items():
-                if "service_path" in values:
-                    names.append(key)
-
-            names.remove("ALL")
-            names = list(set(names))
-
-        return names
-
     def start(self, config, args):
         client = Client(config)
         client.start(args.name, quiet=args.quiet, dependencies_only=args.dependencies_only)
@@ -130,9 +235,26 @@ class App(object):
         client = Client(config)
         client.restart(args.name, quiet=args.quiet)
 
+    def scale(self, config, args):
+        client = Client(config)
+        client.scale(args.name, args.count, quiet=args.quiet)
+
     def status(self, config, args):
         client = Client(config)
-        client.status(args.names)
+        client.status(args.names, verbose=args.verbose, as_json=args.json)
+
+    def top(self, config, args):
+        client = Client(config)
+        return client.top(
+            args.names,
+            sort=args.sort,
+            follow=not args.once,
+            history=args.history,
+        )
+
+    def reload(self, config, args):
+        client = Client(config)
+        client.reload(quiet=args.quiet)
 
     def server_start(self, config, args):
         ensure_server(config, args)
@@ -141,13 +263,14 @@ class App(object):
         if is_server_running(config):
 
             client = Client(config)
-
-            names = self.get_services(config, "ALL")
-            for name in names:
-                client.stop(name, quiet=args.quiet)
+            client.stop("ALL", quiet=args.quiet)
 
             stop_server(config)
 
+    def server_reload(self, config, args):
+        client = Client(config)
+        return client.server_reload(quiet=args.quiet)
+
     def server_wait(self, config, args):
         start_time = time.time()
         while time.time() - start_time < args.timeout:
@@ -174,35 +297,61 @@ class App(object):
 
     def logs(self, config, args):
 
-        names = self.get_services(config, args.names)
+        query = (args.since, args.until, args.grep)
 
-        log_paths = []
-        for name in names:
-            service_config = get_config_for_service(config, name)
+        lines = args.lines
+        if lines is None and not args.no_follow and query == (None, None, None):
+            lines = 10
 
-            if "log_path" not in service_config["service"]:
-                continue
+        client = Client(config)
+        return client.logs(
+            args.names,
+            follow=not args.no_follow,
+            lines=lines,
+            since=args.since,
+            until=args.until,
+            grep=args.grep,
+            timestamps=args.timestamps,
+            color={"always": True, "never": False}.get(args.color),
+            quiet=args.quiet,
+        )
 
-            log_paths.append(service_config["service"]["log_path"])
 
-        if not log_paths:
-            if not args.quiet:
-                sys.stderr.write("NO logs to tail\n")
-                sys.stderr.flush()
-                sys.exit(1)
+DURATION_UNITS = {
+    "s": 1,
+    "m": 60,
+    "h": 60 * 60,
+    "d": 24 * 60 * 60,
+}
 
-        if args.no_follow:
-            exec_args = [
-                "cat",
-            ]
-        else:
-            exec_args = [
-                "tail",
-                "-F",
-            ]
 
-        exec_args.extend(log_paths)
+def parse_time(value):
+    """
+    Parse a point in time for --since and --until into seconds since the
+    epoch. Accepts durations before now (10m), times today (12:30), dates
+    and times (2020-06-01 12:30) and plain epoch seconds.
+    """
+
+    value = value.strip()
+
+    match = re.match(r"^(\d+(?:\.\d+)?)([smhd])$", value)
+    if match:
+        number, unit = match.groups()
+        return time.time() - float(number) * DURATION_UNITS[unit]
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        pass
 
-        exec_path = shutil.which(exec_args[0])
+    try:
+        of_day = datetime.time.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid time '{}'".format(value))
 
-        os.execv(exec_path, exec_args)
+    return datetime.datetime.combine(datetime.date.today(), of_day).timestamp()
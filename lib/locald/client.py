@@ -1,13 +1,27 @@
+import collections
+import datetime
+import heapq
+import itertools
 import json
+import os
+import re
 import socket
+import sys
+import time
+import zlib
 
-from .server import is_server_running
+from .config import expand_service_names, get_config_for_service
+from .protocol import FrameDecoder, encode_frame
+from .replicas import is_replicated
+from .search import LogQuery, search_log
+from .server import format_lines, is_server_running
 
 
 class Client(object):
 
     def __init__(self, config):
         self.config = config
+        self.request_ids = itertools.count(1)
 
     def connect(self):
 
@@ -18,56 +32,104 @@ class Client(object):
 
         return sock
 
-    def prepare_data(self, data):
+    def send(self, sock, command):
+        return self.send_many(sock, [command])[0]
 
-        raw_data = json.dumps(data)
-        raw_data = raw_data.encode("utf-8")
+    def send_many(self, sock, commands):
+        """
+        Pipeline `commands` over `sock`, returning their responses in the
+        same order as the commands.
+        """
 
-        return raw_data
+        requests = {}
+        data = bytearray()
+        for command in commands:
+            request_id = next(self.request_ids)
+            requests[request_id] = command
 
-    def parse_response(self, raw_data):
-        data = raw_data.decode("utf-8")
-        data = json.loads(data)
+            data.extend(encode_frame(dict(command, id=request_id)))
 
-        return data
+        sock.sendall(data)
 
-    def send(self, sock, command):
+        decoder = FrameDecoder()
+        responses = {}
 
-        data = self.prepare_data(command)
-        sock.sendall(data)
+        while len(responses) < len(requests):
+            raw_data = sock.recv(1024 * 1024)
+            if not raw_data:
+                raise Exception(
+                    "connection closed by server after {} of {} responses"
+                    .format(len(responses), len(requests))
+                )
 
-        raw_response = sock.recv(1024 * 1024)  # XXX
+            for message in decoder.feed(raw_data):
+                request_id = message.get("id")
+                if request_id not in requests:
+                    raise Exception(
+                        "received a response to unknown request {!r}"
+                        .format(request_id)
+                    )
 
-        try:
-            return self.parse_response(raw_response)
-        except Exception as ex:
-            raise Exception(
-                "failed to parse response from command {!r}"
-                .format(command)
-            ) from ex
+                responses[request_id] = message["response"]
+
+        return [responses[request_id] for request_id in requests]
+
+    def stream(self, sock, command):
+        """
+        Send `command` over `sock` and yield each part of its response as it
+        arrives, until the server sends the last one.
+        """
+
+        request_id = next(self.request_ids)
+        sock.sendall(encode_frame(dict(command, id=request_id)))
+
+        decoder = FrameDecoder()
+
+        while True:
+            raw_data = sock.recv(1024 * 1024)
+            if not raw_data:
+                raise Exception("connection closed by server")
+
+            for message in decoder.feed(raw_data):
+                if message.get("id") != request_id:
+                    raise Exception(
+                        "received a response to unknown request {!r}"
+                        .format(message.get("id"))
+                    )
+
+                yield message["response"]
+
+                if not message.get("more"):
+                    return
 
     def send_command(self, command):
+        return self.send_commands([command])[0]
+
+    def send_commands(self, commands):
 
         sock = None
 
         try:
             sock = self.connect()
-            response = self.send(sock, command)
+            responses = self.send_many(sock, commands)
         except FileNotFoundError:
             if is_server_running(self.config):
                 message = "sending command failed. are your socket permissions correct?"
             else:
                 message = "sending command failed. server does not appear to be running."
 
-            response = {
-                "messages": [message],
-            }
+            responses = [
+                {
+                    "messages": [message],
+                }
+                for _ in commands
+            ]
 
         finally:
             if sock is not None:
                 sock.close()
 
-        return response
+        return responses
 
     def start(self, name, quiet=False, dependencies_only=False):
 
@@ -109,16 +171,471 @@ class Client(object):
             if not quiet:
                 print(message)
 
-    def status(self, names):
+    def scale(self, name, count, quiet=False):
+
+        command = {
+            "command": "scale",
+            "name": name,
+            "count": count,
+        }
+
+        response = self.send_command(command)
+
+        for message in response["messages"]:
+            if not quiet:
+                print(message)
+
+    def status(self, names, verbose=False, as_json=False):
 
         command = {
             "command": "status",
             "name": names,
+            "details": verbose or as_json,
         }
 
         statuses = self.send_command(command)
 
+        if as_json:
+            print(json.dumps(statuses, indent=2, sort_keys=True))
+            return
+
         names = list(statuses.keys())
         names.sort()
+
+        if verbose:
+            self.print_details(names, statuses)
+            return
+
         for name in names:
             print("{}: {}".format(name, statuses[name]))
+
+    def print_details(self, names, statuses):
+
+        rows = [STATUS_COLUMNS]
+        for name in names:
+            rows.append([name] + self.format_details(statuses[name]))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(STATUS_COLUMNS))]
+
+        for row in rows:
+            print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+    def format_details(self, details):
+
+        status = details["status"]
+        if details["next_restart"] is not None:
+            seconds = max(details["next_restart"] - time.time(), 0)
+            status = "{} ({:.1f}s)".format(status, seconds)
+
+        restarts = str(details["restarts"])
+        if details["memory_restarts"]:
+            restarts = "{} ({} max_rss)".format(restarts, details["memory_restarts"])
+
+        rss = format_bytes(details["rss"])
+        if details["rss_growth"] is not None:
+            # growing faster than its rss_growth_alert
+            rss = "{} (+{}/h)".format(rss, format_bytes(details["rss_growth"] * 3600))
+
+        return [
+            status,
+            format_value(details["pid"]),
+            format_value(details["processes"] or None),
+            format_duration(details["uptime"]),
+            restarts,
+            format_value(details["exit_code"]),
+            format_value(details["cpu_percent"], "{:.1f}"),
+            rss,
+            format_value(details["fds"]),
+        ]
+
+    def logs(self, names, follow=True, lines=None, since=None, until=None,
+             grep=None, timestamps=False, color=None, quiet=False):
+        """
+        Print the logs of the services in `names` as one stream, ordered by
+        when each line was captured. With more than one service, every line
+        is prefixed with its service's name, colored when writing to a
+        terminal unless `color` says otherwise. Without a server, what was
+        written to the services' log files is printed instead.
+        """
+
+        command = {
+            "command": "logs",
+            "name": names,
+            "follow": follow,
+            "lines": lines,
+            "since": since,
+            "until": until,
+            "grep": grep,
+        }
+
+        service_names = expand_service_names(self.config, names)
+
+        if color is None:
+            color = sys.stdout.isatty() and "NO_COLOR" not in os.environ
+
+        prefixes = get_prefixes(service_names, color)
+
+        sock = None
+
+        try:
+            try:
+                sock = self.connect()
+                responses = self.stream(sock, command)
+            except (FileNotFoundError, ConnectionRefusedError):
+                responses = [
+                    self.read_log_files(service_names, lines, since, until, grep),
+                ]
+
+            for response in responses:
+                for message in response["messages"]:
+                    if not quiet:
+                        sys.stderr.write("{}\n".format(message))
+
+                # the server lists the services lines come from, with the
+                # instances of services with replicas in their place
+                if response.get("names"):
+                    prefixes = get_prefixes(response["names"], color)
+
+                if response.get("dropped"):
+                    sys.stderr.write(
+                        "... {} lines dropped ...\n"
+                        .format(response["dropped"])
+                    )
+
+                output = []
+                for timestamp, name, line in response["lines"]:
+                    if timestamps:
+                        output.append(format_timestamp(timestamp))
+
+                    output.append(prefixes.get(name, ""))
+                    output.append(line)
+                    output.append("\n")
+
+                sys.stdout.write("".join(output))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        except BrokenPipeError:
+            # the output was piped to something like head, which has exited.
+            # point stdout somewhere harmless so the flush at exit succeeds
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def read_log_files(self, names, lines=None, since=None, until=None,
+                       grep=None):
+        """
+        The response the server would give to a logs command for the services
+        in `names`, read straight from their log files, for when there is no
+        server to ask. Nothing is followed.
+        """
+
+        messages = ["server does not appear to be running, reading log files"]
+
+        try:
+            query = LogQuery(since=since, until=until, pattern=grep)
+        except re.error as ex:
+            return {
+                "messages": messages + ["invalid pattern: {}".format(ex)],
+                "lines": [],
+            }
+
+        # relative paths are relative to where the server would run
+        base = self.config["locald"].get(
+            "working_dir",
+            self.config["locald"]["config_dir"],
+        )
+
+        found = []
+        sources = []
+        for name in names:
+            service_config = get_config_for_service(self.config, name)
+            log_path = service_config["service"].get("log_path")
+
+            if is_replicated(service_config):
+                messages.append(
+                    "'{}' has replicas, their logs can only be read through "
+                    "the server".format(name)
+                )
+            elif not log_path:
+                messages.append("'{}' has no log_path".format(name))
+            else:
+                found.append(name)
+                sources.append(search_log(os.path.join(base, log_path), name, query))
+
+        merged = heapq.merge(*sources, key=lambda line: line[0])
+        if lines is not None:
+            merged = collections.deque(merged, lines)
+
+        return {
+            "messages": messages,
+            "lines": format_lines(merged),
+            "names": found,
+        }
+
+    def top(self, names, sort="cpu", follow=True, history=30):
+        """
+        Show the resource usage of running services, redrawn each time the
+        server samples them when following.
+        """
+
+        command = {
+            "command": "top",
+            "name": names,
+            "follow": follow,
+            "history": history,
+        }
+
+        redraw = follow and sys.stdout.isatty()
+
+        sock = None
+
+        try:
+            sock = self.connect()
+
+            for response in self.stream(sock, command):
+                output = format_top(response["services"], sort, history)
+
+                if redraw:
+                    # move to the top left and clear the screen
+                    output = "\x1b[H\x1b[2J" + output
+
+                sys.stdout.write(output)
+                sys.stdout.flush()
+        except FileNotFoundError:
+            sys.stderr.write("sending command failed. server does not appear to be running.\n")
+            return 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def reload(self, quiet=False):
+
+        command = {
+            "command": "reload",
+        }
+
+        response = self.send_command(command)
+
+        for message in response["messages"]:
+            if not quiet:
+                print(message)
+
+    def server_reload(self, quiet=False, timeout=10):
+        """
+        Replace the server without stopping any services, then wait for the
+        new one to answer.
+        """
+
+        command = {
+            "command": "server-reload",
+        }
+
+        response = self.send_command(command)
+
+        for message in response["messages"]:
+            if not quiet:
+                print(message)
+
+        if not response.get("reloading"):
+            return 1
+
+        # the old server may still be closing its socket, or the new one not
+        # have opened it yet
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = None
+
+            try:
+                sock = self.connect()
+                self.send(sock, {"command": "status", "name": "ALL"})
+                break
+            except Exception:
+                if time.monotonic() > deadline:
+                    raise Exception("Timeout while waiting for the new server")
+
+                time.sleep(0.1)
+            finally:
+                if sock is not None:
+                    sock.close()
+
+        if not quiet:
+            print("server reloaded")
+
+
+STATUS_COLUMNS = [
+    "NAME",
+    "STATUS",
+    "PID",
+    "PROCS",
+    "UPTIME",
+    "RESTARTS",
+    "EXIT",
+    "CPU%",
+    "RSS",
+    "FDS",
+]
+
+
+def format_value(value, template="{}"):
+
+    if value is None:
+        return "-"
+
+    return template.format(value)
+
+
+def format_duration(seconds):
+
+    if seconds is None:
+        return "-"
+
+    seconds = int(seconds)
+
+    if seconds < 60:
+        return "{}s".format(seconds)
+    elif seconds < 60 * 60:
+        return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+    elif seconds < 24 * 60 * 60:
+        return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    else:
+        return "{}d{:02d}h".format(seconds // 86400, seconds % 86400 // 3600)
+
+
+def format_bytes(value):
+
+    if value is None:
+        return "-"
+
+    for unit in ["B", "K", "M", "G"]:
+        if value < 1024 or unit == "G":
+            break
+
+        value /= 1024
+
+    if unit == "B":
+        return "{}B".format(int(value))
+
+    return "{:.1f}{}".format(value, unit)
+
+
+TOP_COLUMNS = [
+    "NAME",
+    "STATUS",
+    "PROCS",
+    "CPU%",
+    "RSS",
+    "THREADS",
+    "READ/s",
+    "WRITE/s",
+    "CPU HISTORY",
+]
+
+TOP_SORT_KEYS = {
+    "name": lambda item: item[0],
+    "cpu": lambda item: -(item[1]["cpu_percent"] or 0),
+    "rss": lambda item: -(item[1]["rss"] or 0),
+    "io": lambda item: -((item[1]["read_rate"] or 0) + (item[1]["write_rate"] or 0)),
+}
+
+SPARK_CHARS = "\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+
+
+def format_top(services, sort, width):
+
+    items = sorted(services.items(), key=lambda item: item[0])
+    items.sort(key=TOP_SORT_KEYS[sort])
+
+    total_cpu = sum(s["cpu_percent"] or 0 for s in services.values())
+    total_rss = sum(s["rss"] or 0 for s in services.values())
+
+    lines = [
+        "{} services running, CPU {:.1f}%, RSS {}".format(
+            len(services),
+            total_cpu,
+            format_bytes(total_rss),
+        ),
+        "",
+    ]
+
+    rows = [TOP_COLUMNS]
+    for name, service in items:
+        rows.append([
+            name,
+            service["status"],
+            format_value(service["processes"] or None),
+            format_value(service["cpu_percent"], "{:.1f}"),
+            format_bytes(service["rss"]),
+            format_value(service["threads"]),
+            format_bytes(service["read_rate"]),
+            format_bytes(service["write_rate"]),
+            format_sparkline(service["cpu_history"], width),
+        ])
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(TOP_COLUMNS))]
+
+    for row in rows:
+        lines.append("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip())
+
+    return "\n".join(lines) + "\n"
+
+
+def format_sparkline(values, width):
+    """
+    Draw `values` as a line of block characters, scaled so a full block is
+    one whole CPU, right aligned in `width` characters.
+    """
+
+    chars = []
+    for value in values[-width:]:
+        level = min(max(value, 0) / 100, 1)
+        chars.append(SPARK_CHARS[int(round(level * (len(SPARK_CHARS) - 1)))])
+
+    return "".join(chars).rjust(width)
+
+
+# foreground colors used for service name prefixes
+PREFIX_COLORS = [32, 33, 34, 35, 36, 92, 93, 94, 95, 96]
+
+
+def format_prefix(name, width, color=False):
+    """
+    The label put in front of each of a service's lines. Each service is
+    given a color based on its name, so it stays the same across runs.
+    """
+
+    prefix = name.ljust(width)
+
+    if color:
+        code = PREFIX_COLORS[zlib.crc32(name.encode("utf-8")) % len(PREFIX_COLORS)]
+        prefix = "\x1b[{}m{}\x1b[0m".format(code, prefix)
+
+    return "{} | ".format(prefix)
+
+
+def get_prefixes(names, color):
+    """
+    The prefix of lines from each of the services in `names`. Lines are only
+    labelled with their service when there is more than one.
+    """
+
+    if len(names) < 2:
+        return {}
+
+    width = max(len(name) for name in names)
+
+    return {
+        name: format_prefix(name, width, color)
+        for name in names
+    }
+
+
+def format_timestamp(timestamp):
+
+    captured = datetime.datetime.fromtimestamp(timestamp)
+
+    return "{} ".format(captured.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3])
@@ -56,7 +56,7 @@ def get_config(config_path):
     return config
 
 
-def get_config_for_service(config, name):
+def get_service_config_path(config, name):
 
     service_config_path = config[name]["service_path"]
 
@@ -65,6 +65,13 @@ def get_config_for_service(config, name):
         config_dir = config["locald"]["config_dir"]
         service_config_path = os.path.join(config_dir, service_config_path)
 
+    return service_config_path
+
+
+def get_config_for_service(config, name):
+
+    service_config_path = get_service_config_path(config, name)
+
     service_config = get_config(service_config_path)
 
     if "log_path" in service_config:
@@ -78,12 +85,105 @@ def get_config_for_service(config, name):
     return service_config
 
 
+def get_service_names(config):
+    return [
+        name
+        for name, values in config.items()
+        if "service_path" in values
+    ]
+
+
+def expand_service_names(config, names):
+    """
+    Turn a comma separated list of service names, which may include the
+    keyword ALL, into a list of names without duplicates.
+    """
+
+    names = [n.strip() for n in names.split(",") if n.strip()]
+
+    if "ALL" in names:
+        names.extend(get_service_names(config))
+
+    expanded = []
+    for name in names:
+        if name != "ALL" and name not in expanded:
+            expanded.append(name)
+
+    return expanded
+
+
 def get_service_configs(config):
-    
+
     service_configs = {}
-    
-    for name, values in config.items():
-        if "service_path" in values:
-            service_configs[name] = get_config_for_service(config, name)
-    
+
+    for name in get_service_names(config):
+        service_configs[name] = get_config_for_service(config, name)
+
     return service_configs
+
+
+def get_stat_key(path):
+    """
+    Cheap fingerprint of a file's contents, used to tell whether it needs to
+    be parsed again.
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ServiceConfigRegistry(object):
+    """
+    Parsed service configurations, kept in memory and only reparsed when the
+    underlying .service file's inode, size or mtime changes.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.entries = {}
+
+    def get(self, name):
+
+        path = get_service_config_path(self.config, name)
+        stat_key = get_stat_key(path)
+
+        entry = self.entries.get(name)
+        if (
+            entry is not None
+            and stat_key is not None
+            and entry[0] == path
+            and entry[1] == stat_key
+        ):
+            return entry[2]
+
+        service_config = get_config_for_service(self.config, name)
+        self.entries[name] = (path, stat_key, service_config)
+
+        return service_config
+
+    def reload(self):
+        """
+        Reparse every service's configuration, regardless of whether it looks
+        modified. Returns the names of services whose definitions changed.
+        """
+
+        changed = []
+
+        for name in get_service_names(self.config):
+            entry = self.entries.pop(name, None)
+
+            try:
+                service_config = self.get(name)
+            except Exception:
+                if entry is not None:
+                    self.entries[name] = entry
+                raise
+
+            if entry is not None and entry[2] != service_config:
+                changed.append(name)
+
+        return changed
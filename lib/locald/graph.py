@@ -0,0 +1,172 @@
+"""
+Service dependency graph resolution and ordered, parallel execution.
+"""
+
+import asyncio
+
+
+class DependencyError(ValueError):
+    pass
+
+
+def get_requires(service_config):
+
+    requires = service_config["service"].get("requires", "")
+    requires = [r.strip() for r in requires.split(",") if r.strip()]
+
+    return requires
+
+
+def resolve_dependencies(config, names, get_service_config):
+    """
+    Walk the `requires` of every service in `names`, loading each service's
+    configuration exactly once. Returns a tuple of the graph (a dict mapping
+    each name to the list of names it requires) and the loaded service
+    configurations.
+    """
+
+    graph = {}
+    service_configs = {}
+
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+
+        if name in graph:
+            continue
+
+        if name not in config:
+            raise DependencyError("unknown service '{}'".format(name))
+
+        service_config = get_service_config(name)
+        requires = get_requires(service_config)
+
+        for require in requires:
+            if require not in config:
+                raise DependencyError(
+                    "unknown required service '{}'"
+                    .format(require)
+                )
+
+        graph[name] = requires
+        service_configs[name] = service_config
+
+        pending.extend(requires)
+
+    cycle = find_cycle(graph)
+    if cycle is not None:
+        raise DependencyError(
+            "dependency cycle detected: {}"
+            .format(" -> ".join(cycle))
+        )
+
+    return graph, service_configs
+
+
+def get_reverse_graph(graph):
+    """
+    Flip the edges of `graph`, so that every name "requires" the names that
+    depend on it. Running the result in dependency order visits dependents
+    before their dependencies, which is the order to stop things in.
+    """
+
+    reverse_graph = {name: [] for name in graph}
+
+    for name, requires in graph.items():
+        for require in requires:
+            if require in reverse_graph and name not in reverse_graph[require]:
+                reverse_graph[require].append(name)
+
+    return reverse_graph
+
+
+def find_cycle(graph):
+    """
+    Return a list of names forming a cycle in `graph` (with the first name
+    repeated at the end), or None if the graph is acyclic.
+    """
+
+    visiting = 1
+    visited = 2
+
+    state = {}
+
+    for root in sorted(graph):
+        if root in state:
+            continue
+
+        path = [root]
+        stack = [iter(graph[root])]
+        state[root] = visiting
+
+        while stack:
+            try:
+                child = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                state[path.pop()] = visited
+                continue
+
+            if state.get(child) == visiting:
+                return path[path.index(child):] + [child]
+
+            if child in state:
+                continue
+
+            state[child] = visiting
+            path.append(child)
+            stack.append(iter(graph.get(child, [])))
+
+    return None
+
+
+async def run_in_dependency_order(graph, func, max_concurrency, stop_on_error=True):
+    """
+    Await `func(name)` for every name in `graph`, with at most
+    `max_concurrency` calls in flight. A name is run as soon as everything it
+    requires has completed, so independent branches of the graph run
+    concurrently. With `stop_on_error`, once any call raises nothing new is
+    started; otherwise a failure does not hold up anything else.
+
+    Returns a list of (name, result, exception) tuples in completion order.
+    Names that were never run because of an earlier failure are not included.
+    """
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    finished = {name: asyncio.Event() for name in graph}
+    succeeded = set()
+
+    results = []
+    failed = False
+
+    async def run(name):
+        nonlocal failed
+
+        requires = [r for r in graph[name] if r in graph]
+
+        try:
+            for require in requires:
+                await finished[require].wait()
+
+            if stop_on_error and (failed or not succeeded.issuperset(requires)):
+                return
+
+            async with semaphore:
+                if stop_on_error and failed:
+                    return
+
+                try:
+                    result = await func(name)
+                except Exception as ex:
+                    results.append((name, None, ex))
+                    failed = True
+                    return
+
+            results.append((name, result, None))
+            succeeded.add(name)
+        finally:
+            finished[name].set()
+
+    await asyncio.gather(*[run(name) for name in sorted(graph)])
+
+    return results
@@ -0,0 +1,728 @@
+"""
+Capture of service output.
+
+Each service's stdout and stderr are read by the server through a
+non-blocking pipe and split into lines. Every line is stamped with the time it
+was captured, kept in a bounded in-memory ring buffer, optionally appended to
+the service's `log_path`, and handed to anyone following the service's logs.
+
+Writes to `log_path` are buffered and flushed every `log_flush_interval`
+seconds. The file can be rotated by size and age:
+
+    log_max_size=100M  # rotate once the file reaches this size
+    log_max_age=86400  # rotate once its oldest output is this old, in seconds
+    log_keep=5         # rotated segments to keep (default 5)
+    log_compress=gzip  # gzip (default), zstd or none
+
+Rotated segments are renamed to `<log_path>.<timestamp>` and compressed off
+the event loop, one at a time. Each file has a sparse index of when its output
+was captured next to it, see locald.search. The age of a file is taken from
+the first entry of its index, so it carries over when the server restarts,
+and is checked on a timer as well as on every write, so the logs of quiet
+services are rotated too.
+"""
+
+import asyncio
+import collections
+import datetime
+import glob
+import gzip
+import logging
+import os
+import re
+import shutil
+import struct
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger()
+
+
+# lines longer than this are split, so a service that never writes a newline
+# cannot grow the partial line buffer without bound
+MAX_LINE_LENGTH = 64 * 1024
+
+# buffered output is written out early once it reaches this size
+MAX_BUFFER_SIZE = 256 * 1024
+
+SIZE_SUFFIXES = {
+    "": 1,
+    "K": 1024,
+    "M": 1024 ** 2,
+    "G": 1024 ** 3,
+}
+
+COMPRESSION_EXTENSIONS = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+    "none": "",
+}
+
+SEGMENT_TIME_FORMAT = "%Y%m%d-%H%M%S-%f"
+
+# (capture time, offset) entries of a log file's index
+INDEX_ENTRY = struct.Struct("!dQ")
+
+# a new index entry is added once output arrives this many seconds or bytes
+# after the previous entry
+INDEX_INTERVAL = 0.01
+INDEX_SPACING = 64 * 1024
+
+
+class LogConfigError(ValueError):
+    pass
+
+
+def parse_size(value):
+    """
+    Parse a size in bytes, optionally suffixed with K, M or G.
+    """
+
+    match = re.match(r"^\s*(\d+)\s*([KMG]?)B?\s*$", value, re.IGNORECASE)
+    if not match:
+        raise LogConfigError("invalid size '{}'".format(value))
+
+    number, suffix = match.groups()
+
+    return int(number) * SIZE_SUFFIXES[suffix.upper()]
+
+
+class RotationPolicy(object):
+    """
+    A service's log file settings, parsed from its configuration.
+    """
+
+    def __init__(self, config):
+        values = config["service"]
+
+        self.max_size = None
+        if values.get("log_max_size"):
+            self.max_size = parse_size(values["log_max_size"])
+
+        self.max_age = None
+        if values.get("log_max_age"):
+            self.max_age = float(values["log_max_age"])
+
+        self.keep = int(values.get("log_keep", "5"))
+        self.flush_interval = float(values.get("log_flush_interval", "0.1"))
+
+        self.compress = values.get("log_compress", "gzip").lower()
+        if self.compress not in COMPRESSION_EXTENSIONS:
+            raise LogConfigError(
+                "unknown log_compress '{}', expected one of {}"
+                .format(self.compress, ", ".join(COMPRESSION_EXTENSIONS))
+            )
+
+        if self.compress == "zstd" and zstandard is None:
+            logger.warning(
+                "[locald] zstandard is not installed, compressing logs with "
+                "gzip"
+            )
+            self.compress = "gzip"
+
+    def should_rotate(self, size, started_at):
+        """
+        Whether a log file of `size` bytes, whose oldest output was captured
+        at `started_at` (None if there is none yet), is due for rotation.
+        """
+
+        if self.max_size is not None and size >= self.max_size:
+            return True
+
+        if (
+            self.max_age is not None
+            and started_at is not None
+            and time.time() - started_at >= self.max_age
+        ):
+            return True
+
+        return False
+
+
+def get_segments(log_path):
+    """
+    Rotated segments of `log_path`, oldest first. Segments that are still
+    being compressed are listed once, under their uncompressed name.
+    """
+
+    segments = set()
+
+    prefix = log_path + "."
+    for path in glob.glob(glob.escape(prefix) + "*"):
+        suffix = path[len(prefix):]
+        stamp = suffix.split(".", 1)[0]
+
+        try:
+            datetime.datetime.strptime(stamp, SEGMENT_TIME_FORMAT)
+        except ValueError:
+            continue
+
+        if suffix.endswith((".tmp", ".idx")):
+            continue
+
+        if suffix == stamp:
+            segments.add(path)
+        else:
+            segments.add(path[:-len(suffix)] + stamp)
+
+    return [
+        find_segment(path)
+        for path in sorted(segments)
+    ]
+
+
+def find_segment(path):
+    """
+    The file a segment currently lives in, which depends on whether it has
+    been compressed yet.
+    """
+
+    for extension in COMPRESSION_EXTENSIONS.values():
+        if os.path.exists(path + extension):
+            return path + extension
+
+    return path
+
+
+def get_segment_base(path):
+    """
+    The path of a segment without any compression extension.
+    """
+
+    for extension in COMPRESSION_EXTENSIONS.values():
+        if extension and path.endswith(extension):
+            return path[:-len(extension)]
+
+    return path
+
+
+def get_index_path(path):
+    return get_segment_base(path) + ".idx"
+
+
+def compress_segment(path, compress):
+
+    if compress == "none":
+        return path
+
+    compressed_path = path + COMPRESSION_EXTENSIONS[compress]
+    tmp_path = compressed_path + ".tmp"
+
+    with open(path, "rb") as src:
+        if compress == "zstd":
+            with open(tmp_path, "wb") as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+        else:
+            with gzip.open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    os.rename(tmp_path, compressed_path)
+    os.unlink(path)
+
+    return compressed_path
+
+
+def prune_segments(log_path, keep):
+
+    segments = get_segments(log_path)
+
+    for path in segments[:max(len(segments) - keep, 0)]:
+        for remove_path in (path, get_index_path(path)):
+            try:
+                os.unlink(remove_path)
+            except OSError:
+                pass
+
+
+def get_start_time(index_path):
+    """
+    The capture time of the oldest output in a log file, from the first
+    entry of its index, or None.
+    """
+
+    try:
+        with open(index_path, "rb") as fp:
+            data = fp.read(INDEX_ENTRY.size)
+    except OSError:
+        return None
+
+    if len(data) < INDEX_ENTRY.size:
+        return None
+
+    timestamp, _ = INDEX_ENTRY.unpack(data)
+
+    return timestamp
+
+
+def finish_rotation(log_path, path, policy):
+    """
+    Compress a freshly rotated segment and drop old ones. Runs on a worker
+    thread, never more than one at a time for the same log, see
+    ServiceLog.rotate.
+    """
+
+    compress_segment(path, policy.compress)
+    prune_segments(log_path, policy.keep)
+
+
+class Subscription(object):
+    """
+    Lines delivered to one follower of one or more service logs. Holds at most
+    `max_lines` undelivered lines, dropping the oldest if the follower falls
+    behind.
+    """
+
+    def __init__(self, max_lines=10000):
+        self.lines = collections.deque()
+        self.max_lines = max_lines
+        self.dropped = 0
+        self.event = asyncio.Event()
+
+    def put(self, line):
+        if len(self.lines) >= self.max_lines:
+            self.lines.popleft()
+            self.dropped += 1
+
+        self.lines.append(line)
+        self.event.set()
+
+    async def get(self):
+        """
+        Wait for lines, then return all of them along with the number of lines
+        dropped since the previous call.
+        """
+
+        while not self.lines:
+            self.event.clear()
+            await self.event.wait()
+
+        lines = list(self.lines)
+        self.lines.clear()
+
+        dropped = self.dropped
+        self.dropped = 0
+
+        return lines, dropped
+
+
+class OutputPipe(object):
+    """
+    The read end of one run's output, with whatever it has sent of its
+    current line so far.
+    """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.partial = b""
+
+
+class ServiceLog(object):
+    """
+    Output of every run of a single service. Lines are kept as
+    (timestamp, service name, bytes) tuples, without their trailing newline.
+    """
+
+    def __init__(self, name, scheduler, max_lines=1000):
+        self.name = name
+        self.scheduler = scheduler
+        self.lines = collections.deque(maxlen=max_lines)
+        self.seq = 0
+        self.outputs = []
+        self.log_fp = None
+        self.log_path = None
+        self.log_size = 0
+        self.log_started_at = None
+        self.buffer = bytearray()
+        self.index_fp = None
+        self.index_buffer = bytearray()
+        self.last_index = None
+        self.rotation = None
+        self.rotated = collections.deque()
+        self.rotating = None
+        self.subscriptions = set()
+
+    def attach(self, pipe, log_path=None, rotation=None, keep=False):
+        """
+        Start reading from `pipe`, the read end of a new run's output. Unless
+        `keep` is set, the output of previous runs is no longer read; with it,
+        a run being replaced can keep writing until it exits.
+        """
+
+        if not keep:
+            self.detach()
+
+        if log_path != self.log_path:
+            self.close_log_file()
+            self.log_path = log_path
+
+        self.rotation = rotation
+
+        # open the file up front, so that its age is checked even if nothing
+        # is ever written to it
+        if self.log_path and rotation is not None:
+            if self.log_fp is None:
+                try:
+                    self.open_log_file()
+                except OSError as ex:
+                    logger.warning(
+                        "[locald] unable to open log for {} at {}: {}"
+                        .format(self.name, self.log_path, ex)
+                    )
+            elif self.log_started_at is not None:
+                self.schedule_rotation()
+
+        output = OutputPipe(pipe)
+        self.outputs.append(output)
+        os.set_blocking(pipe.fileno(), False)
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(pipe.fileno(), self.read, output)
+
+    def detach(self, output=None):
+        """
+        Stop reading `output`, or every run's output.
+        """
+
+        outputs = [output] if output is not None else list(self.outputs)
+
+        for output in outputs:
+            if output not in self.outputs:
+                continue
+
+            self.outputs.remove(output)
+
+            try:
+                asyncio.get_running_loop().remove_reader(output.pipe.fileno())
+            except RuntimeError:
+                pass
+
+            try:
+                output.pipe.close()
+            except OSError:
+                pass
+
+            if output.partial:
+                self.add_lines(output.partial, [output.partial])
+                output.partial = b""
+
+    def read(self, output):
+
+        try:
+            data = os.read(output.pipe.fileno(), 64 * 1024)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        # the pipe stays open until the service and anything it spawned have
+        # all exited, so there is no output left to miss once this happens
+        if not data:
+            self.detach(output)
+            return
+
+        self.feed(data, output)
+
+    def feed(self, data, output):
+
+        data = output.partial + data
+        lines = data.split(b"\n")
+        output.partial = lines.pop()
+
+        while len(output.partial) > MAX_LINE_LENGTH:
+            lines.append(output.partial[:MAX_LINE_LENGTH])
+            output.partial = output.partial[MAX_LINE_LENGTH:]
+
+        if lines:
+            self.add_lines(data[:len(data) - len(output.partial)], lines)
+
+    def add_lines(self, data, lines):
+
+        timestamp = time.time()
+
+        self.write(data, timestamp)
+
+        for line in lines:
+            entry = (timestamp, self.name, line)
+
+            self.lines.append(entry)
+            self.seq += 1
+
+            for subscription in self.subscriptions:
+                subscription.put(entry)
+
+    def restore(self, lines):
+        """
+        Put back the (timestamp, bytes) `lines` a previous server held in
+        memory, which are already in the log file if there is one.
+        """
+
+        for timestamp, line in lines:
+            self.lines.append((timestamp, self.name, line))
+            self.seq += 1
+
+    def write(self, data, timestamp):
+        """
+        Buffer `data` for appending to the log file. The index gets an entry
+        for it unless the previous entry was recent and close enough.
+        """
+
+        if not self.log_path:
+            return
+
+        if self.log_fp is None:
+            try:
+                self.open_log_file()
+            except OSError as ex:
+                logger.warning(
+                    "[locald] unable to open log for {} at {}: {}"
+                    .format(self.name, self.log_path, ex)
+                )
+                return
+
+        offset = self.log_size + len(self.buffer)
+
+        if self.last_index is None:
+            self.add_index_entry(timestamp, offset)
+        else:
+            last_timestamp, last_offset = self.last_index
+            if (
+                timestamp - last_timestamp >= INDEX_INTERVAL
+                or offset - last_offset >= INDEX_SPACING
+            ):
+                # keep the index sorted even if the clock steps backwards
+                self.add_index_entry(max(timestamp, last_timestamp), offset)
+
+        self.buffer.extend(data)
+        if not data.endswith(b"\n"):
+            self.buffer.extend(b"\n")
+
+        if len(self.buffer) >= MAX_BUFFER_SIZE:
+            self.flush()
+        elif self.scheduler.when((self.name, "flush")) is None:
+            interval = self.rotation.flush_interval if self.rotation else 0.1
+            self.scheduler.call_later(
+                interval,
+                self.flush,
+                key=(self.name, "flush"),
+            )
+
+    def add_index_entry(self, timestamp, offset):
+        self.index_buffer.extend(INDEX_ENTRY.pack(timestamp, offset))
+        self.last_index = (timestamp, offset)
+
+        if self.log_started_at is None:
+            self.log_started_at = timestamp
+            self.schedule_rotation()
+
+    def flush(self):
+        """
+        Write out the buffered output, then rotate the log file if it is due.
+        """
+
+        self.write_buffer()
+
+        if self.log_fp is None:
+            return
+
+        if self.rotation is None:
+            return
+
+        if self.rotation.should_rotate(self.log_size, self.log_started_at):
+            self.rotate()
+        elif (
+            self.log_started_at is not None
+            and self.scheduler.when((self.name, "rotate")) is None
+        ):
+            # checked a little early, the clocks may not quite agree
+            self.schedule_rotation()
+
+    def write_buffer(self):
+
+        self.scheduler.cancel((self.name, "flush"))
+
+        if not self.buffer or self.log_fp is None:
+            return
+
+        try:
+            self.log_fp.write(self.buffer)
+
+            # written after the output it points at, so a reader never finds
+            # an entry past the end of the file
+            self.index_fp.write(self.index_buffer)
+        except OSError as ex:
+            logger.warning(
+                "[locald] unable to write log for {} to {}: {}"
+                .format(self.name, self.log_path, ex)
+            )
+
+        self.log_size += len(self.buffer)
+        self.buffer.clear()
+        self.index_buffer.clear()
+
+    def schedule_rotation(self):
+        """
+        Check the log file's age once it is due, in case nothing is written
+        then.
+        """
+
+        if self.rotation is None or self.rotation.max_age is None:
+            return
+
+        due = self.log_started_at + self.rotation.max_age - time.time()
+
+        self.scheduler.call_later(
+            max(due, 0),
+            self.flush,
+            key=(self.name, "rotate"),
+        )
+
+    def open_log_file(self):
+
+        log_fp = open(self.log_path, "ab", buffering=0)
+
+        try:
+            self.index_fp = open(
+                get_index_path(self.log_path),
+                "ab",
+                buffering=0,
+            )
+        except OSError:
+            log_fp.close()
+            raise
+
+        self.log_fp = log_fp
+        self.log_size = os.fstat(log_fp.fileno()).st_size
+        self.last_index = None
+
+        # the file may have been appended to since long before
+        self.log_started_at = None
+        if self.log_size:
+            self.log_started_at = get_start_time(get_index_path(self.log_path))
+
+        if self.log_started_at is not None:
+            self.schedule_rotation()
+
+    def rotate(self):
+        """
+        Move the current log file aside and start a new one, leaving
+        compression and pruning of the old one to a worker thread.
+        """
+
+        self.close_log_file()
+
+        stamp = datetime.datetime.now().strftime(SEGMENT_TIME_FORMAT)
+        path = "{}.{}".format(self.log_path, stamp)
+
+        try:
+            os.rename(self.log_path, path)
+        except OSError as ex:
+            logger.warning(
+                "[locald] unable to rotate log for {} at {}: {}"
+                .format(self.name, self.log_path, ex)
+            )
+            return
+
+        try:
+            os.rename(get_index_path(self.log_path), get_index_path(path))
+        except OSError:
+            pass
+
+        logger.info(
+            "[locald] rotated log for {} to {}"
+            .format(self.name, path)
+        )
+
+        # one at a time, so that pruning never removes a segment another
+        # thread is still compressing
+        self.rotated.append((self.log_path, path, self.rotation))
+        if self.rotating is None:
+            self.finish_rotation()
+
+    def finish_rotation(self):
+
+        loop = asyncio.get_running_loop()
+
+        self.rotating = loop.run_in_executor(
+            None,
+            finish_rotation,
+            *self.rotated.popleft(),
+        )
+        self.rotating.add_done_callback(self.rotation_done)
+
+    def rotation_done(self, future):
+
+        self.rotating = None
+
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(
+                "[locald] unable to compress rotated log for {}: {}"
+                .format(self.name, future.exception())
+            )
+
+        if self.rotated:
+            self.finish_rotation()
+
+    def close_log_file(self):
+
+        self.write_buffer()
+        self.scheduler.cancel((self.name, "rotate"))
+
+        if self.log_fp is None:
+            return
+
+        for fp in (self.log_fp, self.index_fp):
+            try:
+                fp.close()
+            except OSError:
+                pass
+
+        self.log_fp = None
+        self.index_fp = None
+
+    def close(self):
+        self.detach()
+        self.close_log_file()
+
+    def get_lines(self, count=None):
+        """
+        The most recent `count` lines held in memory, or all of them.
+        """
+
+        lines = list(self.lines)
+
+        if count is not None:
+            lines = lines[max(len(lines) - count, 0):]
+
+        return lines
+
+    def resize(self, max_lines):
+        """
+        Hold at most `max_lines` lines in memory from now on, dropping the
+        oldest ones if there are more.
+        """
+
+        if self.lines.maxlen != max_lines:
+            self.lines = collections.deque(self.lines, maxlen=max_lines)
+
+    def get_lines_since(self, seq):
+        """
+        Lines added after the point at which `self.seq` was `seq`, as far as
+        they are still held in memory.
+        """
+
+        count = min(self.seq - seq, len(self.lines))
+        if count <= 0:
+            return []
+
+        return list(self.lines)[-count:]
+
+    def subscribe(self, subscription):
+        self.subscriptions.add(subscription)
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
@@ -0,0 +1,391 @@
+"""
+Resource usage of service process trees, sampled with psutil.
+
+The server samples every running service every `metrics_interval` seconds
+(default 3, 0 to disable) and keeps the last `metrics_history` samples
+(default 120) of each one, for `locald top`.
+"""
+
+import array
+import collections
+import os
+import time
+
+import psutil
+
+
+# how many passes can reuse the process trees found by a scan of the process
+# table, unless a process in one of them exits, starts a child, or a new tree
+# shows up
+TREE_REFRESH_PASSES = 5
+
+# whether the children of a process can be listed without a scan of the
+# process table, which takes Linux with CONFIG_PROC_CHILDREN; elsewhere new
+# children are only found when the trees are next refreshed
+PROC_CHILDREN = os.path.exists(
+    "/proc/self/task/{}/children".format(os.getpid())
+)
+
+# what is kept of each sample in a service's history
+HISTORY_COLUMNS = [
+    "time",
+    "cpu_percent",
+    "rss",
+    "threads",
+    "read_rate",
+    "write_rate",
+]
+
+
+class ProcessSampler(object):
+    """
+    Samples the resource usage of whole process trees. CPU time seen for each
+    process is remembered between samples, so that CPU usage can be reported
+    for the interval since the previous sample rather than averaged over the
+    lifetime of the process.
+    """
+
+    def __init__(self):
+        self.cpu_times = {}
+        self.sampled_at = None
+        self.trees = {}
+        self.passes = 0
+        self.stale = True
+        self.processes = {}
+        self.next_processes = {}
+
+    def sample(self, pids, cgroups=None):
+        """
+        Sample every tree in one pass. `pids` maps names to the pid at the
+        root of each tree, and a dict of name to sample is returned, see
+        sample_tree. Trees whose root has already exited are left out.
+
+        The trees of names in `cgroups` are made up of the members of their
+        cgroup, which needs no scan of the process table.
+        """
+
+        cgroups = cgroups or {}
+
+        now = time.time()
+
+        trees = self.get_trees([
+            pid
+            for name, pid in pids.items()
+            if name not in cgroups
+        ])
+
+        self.next_processes = {}
+        for name, cgroup in cgroups.items():
+            trees[pids[name]] = self.get_cgroup_tree(pids[name], cgroup)
+
+        self.processes = self.next_processes
+
+        cpu_times = {}
+        samples = {}
+        for name, pid in pids.items():
+            if not trees.get(pid):
+                continue
+
+            sample = self.sample_tree(pid, trees[pid], now, cpu_times)
+            if sample is not None:
+                samples[name] = sample
+
+        self.cpu_times = cpu_times
+        self.sampled_at = now
+
+        return samples
+
+    def get_trees(self, pids):
+        """
+        The process trees rooted at `pids`. Finding them takes a scan of the
+        whole process table, which costs more than sampling, so one scan
+        covers every tree and the result is reused for a few passes, as long
+        as none of them has changed.
+        """
+
+        self.passes += 1
+
+        if not pids:
+            return {}
+
+        refresh = (
+            self.stale
+            or self.passes >= TREE_REFRESH_PASSES
+            or any(pid not in self.trees for pid in pids)
+            or any(has_changed(self.trees[pid]) for pid in pids)
+        )
+
+        if refresh:
+            processes, children = get_process_table()
+
+            self.trees = {
+                pid: get_tree(pid, processes, children)
+                for pid in pids
+                if pid in processes
+            }
+            self.passes = 0
+            self.stale = False
+
+        return dict(self.trees)
+
+    def get_cgroup_tree(self, pid, cgroup):
+        """
+        The processes in `cgroup`, with `pid` first. psutil processes are
+        kept from one pass to the next, since creating them is not free.
+        """
+
+        members = cgroup.get_pids()
+        if pid not in members:
+            return []
+
+        members.remove(pid)
+
+        tree = []
+        for member in [pid] + members:
+            process = self.processes.get(member)
+            if process is None:
+                try:
+                    process = psutil.Process(member)
+                except psutil.NoSuchProcess:
+                    continue
+
+            tree.append(process)
+            self.next_processes[member] = process
+
+        return tree
+
+    def sample_tree(self, pid, tree, now, cpu_times):
+
+        root = tree[0]
+
+        sample = {
+            "time": now,
+            "pid": pid,
+            "processes": 0,
+            "cpu_percent": 0.0,
+            "rss": 0,
+            "fds": 0,
+            "threads": 0,
+            "read_bytes": 0,
+            "write_bytes": 0,
+        }
+
+        cpu_total = 0.0
+        cpu_delta = 0.0
+        started_at = None
+        new_root = True
+
+        for process in tree:
+            try:
+                with process.oneshot():
+                    created = process.create_time()
+                    cpu = process.cpu_times()
+                    memory = process.memory_info()
+                    threads = process.num_threads()
+                    fds = get_num_fds(process)
+                    io = get_io_counters(process)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                # the tree has changed, so look for it again next time
+                self.stale = True
+                continue
+            except psutil.AccessDenied:
+                continue
+
+            if process is root:
+                started_at = created
+
+            # the creation time tells a reused pid apart from the original
+            key = (process.pid, created)
+            cpu_time = cpu.user + cpu.system
+            cpu_times[key] = cpu_time
+
+            previous = self.cpu_times.get(key)
+            if previous is not None:
+                cpu_delta += cpu_time - previous
+                if process is root:
+                    new_root = False
+            else:
+                # did not exist at the previous sample
+                cpu_delta += cpu_time
+
+            cpu_total += cpu_time
+
+            sample["processes"] += 1
+            sample["rss"] += memory.rss
+            sample["threads"] += threads
+            sample["fds"] += fds
+
+            if io is not None:
+                sample["read_bytes"] += io.read_bytes
+                sample["write_bytes"] += io.write_bytes
+
+        if not sample["processes"]:
+            return None
+
+        if self.sampled_at is None or new_root:
+            # nothing to compare against yet, so fall back to the average
+            # since the service started, as ps does
+            elapsed = now - (started_at or now)
+            cpu_used = cpu_total
+        else:
+            elapsed = now - self.sampled_at
+            cpu_used = cpu_delta
+
+        if elapsed > 0:
+            sample["cpu_percent"] = round(max(cpu_used, 0) / elapsed * 100, 1)
+
+        return sample
+
+
+class MetricsHistory(object):
+    """
+    The most recent `size` samples of one service, in a fixed-size ring
+    buffer with one preallocated array per column of HISTORY_COLUMNS.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.columns = {
+            column: array.array("d", bytes(8 * size))
+            for column in HISTORY_COLUMNS
+        }
+        self.count = 0
+        self.next = 0
+        self.last = None
+
+    def append(self, sample):
+        """
+        Record `sample` as returned by ProcessSampler.sample, working out IO
+        rates against the previous one.
+        """
+
+        values = dict(sample)
+
+        values["read_rate"] = 0.0
+        values["write_rate"] = 0.0
+
+        last = self.last
+        if last is not None and last["pid"] == sample["pid"]:
+            elapsed = sample["time"] - last["time"]
+            if elapsed > 0:
+                values["read_rate"] = max(sample["read_bytes"] - last["read_bytes"], 0) / elapsed
+                values["write_rate"] = max(sample["write_bytes"] - last["write_bytes"], 0) / elapsed
+
+        for column, data in self.columns.items():
+            data[self.next] = values[column]
+
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.last = values
+
+    def get(self, column, count=None):
+        """
+        The last `count` values of `column` (or all of them), oldest first.
+        """
+
+        if count is None or count > self.count:
+            count = self.count
+
+        data = self.columns[column]
+        start = (self.next - count) % self.size
+
+        if start + count <= self.size:
+            return data[start:start + count].tolist()
+
+        return (data[start:] + data[:start + count - self.size]).tolist()
+
+    def get_latest(self):
+        return self.last
+
+
+def get_process_table():
+    """
+    Every process on the system by pid, along with a mapping of each pid to
+    the pids of its children.
+    """
+
+    processes = {}
+    children = collections.defaultdict(list)
+
+    for process in psutil.process_iter(["ppid"]):
+        processes[process.pid] = process
+
+        ppid = process.info["ppid"]
+        if ppid is not None and ppid != process.pid:
+            children[ppid].append(process.pid)
+
+    return processes, children
+
+
+def get_tree(pid, processes, children):
+    """
+    The process `pid` followed by all of its descendants.
+    """
+
+    tree = []
+
+    pending = [pid]
+    while pending:
+        pid = pending.pop()
+
+        if pid in processes:
+            tree.append(processes[pid])
+
+        pending.extend(children.get(pid, []))
+
+    return tree
+
+
+def get_child_pids(pid):
+    """
+    The pids of the children of `pid`, or None if it has exited.
+    """
+
+    children = set()
+
+    try:
+        for task in os.listdir("/proc/{}/task".format(pid)):
+            path = "/proc/{}/task/{}/children".format(pid, task)
+            with open(path) as fp:
+                children.update(int(child) for child in fp.read().split())
+    except OSError:
+        return None
+
+    return children
+
+
+def has_changed(tree):
+    """
+    Whether a process in `tree` has exited or started a child that is not
+    part of it, as far as can be told without a scan of the process table.
+    """
+
+    if not PROC_CHILDREN:
+        return False
+
+    members = {process.pid for process in tree}
+
+    for pid in members:
+        children = get_child_pids(pid)
+        if children is None or not children <= members:
+            return True
+
+    return False
+
+
+def get_num_fds(process):
+
+    try:
+        return process.num_fds()
+    except (AttributeError, psutil.AccessDenied):
+        # num_fds is not available everywhere
+        return 0
+
+
+def get_io_counters(process):
+
+    try:
+        return process.io_counters()
+    except (AttributeError, psutil.AccessDenied):
+        # io_counters is not available everywhere
+        return None
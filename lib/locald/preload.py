@@ -0,0 +1,643 @@
+"""
+Preloading Python services.
+
+A service whose command runs a Python script or module may set, in its
+`[service]` section:
+
+    preload=django, pandas, myproject.settings    # modules to import up front
+
+The server then keeps a zygote for it: an interpreter (the one the command
+runs) that has already imported those modules. Starting or restarting the
+service forks it from the zygote instead of running its command, so the
+imports are not paid for again. The forked process is set up as the command
+would have been (arguments, environment, output, cgroup) and runs the script
+or module as `__main__`.
+
+The zygote is started the first time the service is, which is a normal start,
+and is used from the next start on. Before a fork, the files of every module
+the zygote has loaded are checked, at most once every STALE_CHECK_INTERVAL
+seconds, and if any of them changed (or the interpreter or `preload` did),
+that start is a normal one too and the zygote is replaced in the background.
+Changes to modules that are not loaded until the service runs, usually its
+own code, take effect on the next restart without that.
+
+Modules may read the environment as they are imported, so a zygote only forks
+runs with the environment it was started with. A service with `proxy_port`,
+whose $PORT changes from one run to the next, has a zygote for each of its
+`proxy_backend_ports`, and is not preloaded without them.
+
+Commands are run as `python [-u] [-B] script|-m module|-c code [args]`,
+optionally through `env`. Anything else, and anything the zygote fails to do,
+falls back to running the command as usual. Processes forked by a zygote are
+killed if it dies, which relies on prctl, so preloading is only done on Linux.
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from .state import create_output_pipe
+
+
+logger = logging.getLogger()
+
+
+# seconds to wait for a zygote to fork before running the command instead
+FORK_TIMEOUT = 5
+
+# seconds for which the files of a zygote's modules are taken to be as they
+# were when last checked, so that starting many processes at once, such as
+# the replicas of a service, stats them once
+STALE_CHECK_INTERVAL = 1
+
+# seconds a closed zygote is given to exit before it is killed, and between
+# checks of whether it has
+EXIT_TIMEOUT = 1
+EXIT_POLL_INTERVAL = 0.05
+
+# runs in the zygote: imports the modules, reports the files they came from,
+# then forks a child for each request and reports its pid and, once it has
+# been reaped, its exit code. Exits once the server closes its end and every
+# child has exited.
+ZYGOTE_SCRIPT = r"""
+import ctypes, json, os, runpy, select, signal, socket, sys, traceback
+
+sock = socket.socket(fileno=int(sys.argv[1]))
+
+def send(message):
+    try:
+        sock.sendall(json.dumps(message).encode() + b"\n")
+    except OSError:
+        pass
+
+try:
+    for name in sys.argv[2].split(","):
+        __import__(name)
+except BaseException:
+    send({"error": traceback.format_exc()})
+    sys.exit(1)
+
+# anything printed while importing belongs to the zygote, not its children
+sys.stdout.flush()
+sys.stderr.flush()
+
+files = {}
+for module in list(sys.modules.values()):
+    path = getattr(module, "__file__", None)
+    if path:
+        try:
+            files[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+
+send({"ready": files})
+
+wakeup_r, wakeup_w = os.pipe()
+os.set_blocking(wakeup_w, False)
+signal.set_wakeup_fd(wakeup_w)
+signal.signal(signal.SIGCHLD, lambda *args: None)
+
+def run(request, fd):
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    os.close(wakeup_r)
+    os.close(wakeup_w)
+    sock.close()
+
+    # PR_SET_PDEATHSIG, nothing else would notice the zygote going away;
+    # the server does not preload elsewhere, see check_platform
+    if sys.platform.startswith("linux"):
+        ctypes.CDLL(None).prctl(1, signal.SIGKILL)
+
+    if request["cgroup"]:
+        try:
+            with open(os.path.join(request["cgroup"], "cgroup.procs"), "w") as fp:
+                fp.write(str(os.getpid()))
+        except OSError:
+            pass
+
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.close(null)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+
+    os.environ.clear()
+    os.environ.update(request["env"])
+    os.chdir(request["cwd"])
+
+    unbuffered = request["unbuffered"] or os.environ.get("PYTHONUNBUFFERED")
+    sys.stdout = open(1, "w", buffering=1 if unbuffered else -1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+    if unbuffered:
+        sys.stdout.reconfigure(write_through=True)
+
+    sys.dont_write_bytecode = request["dont_write_bytecode"]
+    sys.argv = request["argv"]
+
+    if request["kind"] == "module":
+        # run afresh as __main__, even if it was preloaded itself
+        sys.modules.pop(request["target"], None)
+        sys.path[0] = request["cwd"]
+        runpy.run_module(request["target"], run_name="__main__", alter_sys=True)
+    elif request["kind"] == "code":
+        sys.path[0] = ""
+        exec(compile(request["target"], "<string>", "exec"), {"__name__": "__main__"})
+    else:
+        sys.path[0] = os.path.dirname(os.path.abspath(request["target"]))
+        runpy.run_path(request["target"], run_name="__main__")
+
+def print_exception(ex):
+    # without the zygote's frames, as if the command had been run directly
+    tb = ex.__traceback__
+    while tb is not None and (
+        tb.tb_frame.f_globals is globals()
+        or tb.tb_frame.f_globals.get("__name__") == "runpy"
+    ):
+        tb = tb.tb_next
+    traceback.print_exception(type(ex), ex, tb)
+
+children = set()
+buffer = b""
+fds = []
+accepting = True
+
+while accepting or children:
+    watched = [sock, wakeup_r] if accepting else [wakeup_r]
+    readable = select.select(watched, [], [])[0]
+
+    if wakeup_r in readable:
+        os.read(wakeup_r, 4096)
+        while children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            children.discard(pid)
+            send({"exited": pid, "returncode": os.waitstatus_to_exitcode(status)})
+
+    if sock in readable:
+        data, received, _, _ = socket.recv_fds(sock, 65536, 16)
+        fds.extend(received)
+        if not data:
+            accepting = False
+            continue
+
+        buffer += data
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            request = json.loads(line)
+            fd = fds.pop(0)
+
+            pid = os.fork()
+            if not pid:
+                # the child leaves the loop the way the script would exit
+                try:
+                    run(request, fd)
+                except SystemExit:
+                    raise
+                except BaseException as ex:
+                    print_exception(ex)
+                    sys.exit(1)
+                finally:
+                    sys.stdout.flush()
+                sys.exit()
+
+            os.close(fd)
+            children.add(pid)
+            send({"pid": pid})
+"""
+
+
+class PreloadError(Exception):
+    pass
+
+
+class PythonCommand(object):
+    """
+    A service command that runs a Python script, module or code, as the
+    zygote needs it.
+    """
+
+    def __init__(self, interpreter, kind, target, argv, env,
+                 unbuffered=False, dont_write_bytecode=False):
+        self.interpreter = interpreter
+        self.kind = kind
+        self.target = target
+        self.argv = argv
+        self.env = env
+        self.unbuffered = unbuffered
+        self.dont_write_bytecode = dont_write_bytecode
+
+    @classmethod
+    def parse(cls, args, env):
+        """
+        Parse the service command `args`, to be run with `env`, raising
+        PreloadError for anything the zygote could not run the same way.
+        """
+
+        args = list(args)
+        env = dict(env)
+
+        if args and os.path.basename(args[0]) == "env":
+            args.pop(0)
+
+            while args and "=" in args[0] and not args[0].startswith("-"):
+                key, _, value = args.pop(0).partition("=")
+                env[key] = value
+
+            if args and args[0].startswith("-"):
+                raise PreloadError("options to env are not supported")
+
+        if not args or not os.path.basename(args[0]).startswith("python"):
+            raise PreloadError("the command does not run python")
+
+        interpreter = args[0]
+        if os.sep not in interpreter:
+            interpreter = shutil.which(interpreter, path=env.get("PATH"))
+
+            if interpreter is None:
+                raise PreloadError("'{}' was not found".format(args[0]))
+
+        options = {}
+        index = 1
+
+        while index < len(args):
+            arg = args[index]
+
+            if not arg.startswith("-") or arg == "-":
+                break
+
+            index += 1
+
+            for position, flag in enumerate(arg[1:], 2):
+                if flag == "u":
+                    options["unbuffered"] = True
+                elif flag == "B":
+                    options["dont_write_bytecode"] = True
+                elif flag in ("m", "c"):
+                    target = arg[position:]
+                    if not target:
+                        if index == len(args):
+                            raise PreloadError("-{} needs an argument".format(flag))
+
+                        target = args[index]
+                        index += 1
+
+                    kind = "module" if flag == "m" else "code"
+                    argv = ["-c" if flag == "c" else target] + args[index:]
+
+                    return cls(interpreter, kind, target, argv, env, **options)
+                else:
+                    raise PreloadError("option -{} is not supported".format(flag))
+
+        if index == len(args) or args[index] == "-":
+            raise PreloadError("the command does not run a script")
+
+        return cls(interpreter, "path", args[index], args[index:], env, **options)
+
+    def get_request(self, cgroup_path=None):
+        return {
+            "kind": self.kind,
+            "target": self.target,
+            "argv": self.argv,
+            "env": self.env,
+            "cwd": os.getcwd(),
+            "cgroup": cgroup_path,
+            "unbuffered": self.unbuffered,
+            "dont_write_bytecode": self.dont_write_bytecode,
+        }
+
+
+class ForkedProcess(object):
+    """
+    A service process forked by a zygote, in place of a subprocess.Popen.
+    The zygote is its parent, so it is the zygote that reports its exit.
+    """
+
+    def __init__(self, pid, stdout, on_exit=None):
+        self.pid = pid
+        self.stdout = stdout
+        self.on_exit = on_exit
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def send_signal(self, signum):
+
+        # once reaped, the pid may belong to something else
+        if self.returncode is not None:
+            return
+
+        try:
+            os.kill(self.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def set_returncode(self, returncode):
+
+        if self.returncode is not None:
+            return
+
+        self.returncode = returncode
+
+        if self.on_exit is not None:
+            asyncio.get_running_loop().call_soon(self.on_exit)
+
+
+class Zygote(object):
+    """
+    An interpreter with a service's `preload` modules imported, forking the
+    service's processes on request.
+    """
+
+    def __init__(self, name, interpreter, modules, env=None):
+        self.name = name
+        self.interpreter = interpreter
+        self.modules = modules
+        self.env = env
+        self.process = None
+        self.sock = None
+        self.ready = None
+        self.files = {}
+        self.checked_at = None
+        self.stale = False
+        self.buffer = b""
+        self.forks = collections.deque()
+        self.children = {}
+
+    def matches(self, interpreter, modules, env):
+        return (
+            (self.interpreter, self.modules, self.env)
+            == (interpreter, modules, env)
+        )
+
+    def open(self):
+        """
+        Start the zygote, resolving `ready` with None once it has imported
+        its modules or with the exception describing why it could not.
+        """
+
+        loop = asyncio.get_running_loop()
+        self.ready = loop.create_future()
+
+        logger.info(
+            "[locald] preloading {} for service {}"
+            .format(", ".join(self.modules), self.name)
+        )
+
+        parent, child = socket.socketpair()
+
+        try:
+            self.process = subprocess.Popen(
+                [
+                    self.interpreter,
+                    "-c",
+                    ZYGOTE_SCRIPT,
+                    str(child.fileno()),
+                    ",".join(self.modules),
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                pass_fds=[child.fileno()],
+                env=self.env,
+            )
+        except OSError as ex:
+            parent.close()
+            self.ready.set_result(PreloadError(str(ex)))
+            return
+        finally:
+            child.close()
+
+        self.sock = parent
+        self.sock.setblocking(False)
+        loop.add_reader(self.sock.fileno(), self.read)
+
+    def is_ready(self):
+        return (
+            self.sock is not None
+            and self.ready.done()
+            and self.ready.result() is None
+        )
+
+    def is_stale(self):
+        """
+        Whether any file of a module the zygote has loaded has changed since,
+        as of the last check, which is at most STALE_CHECK_INTERVAL seconds
+        old.
+        """
+
+        now = time.monotonic()
+        if self.stale or (
+            self.checked_at is not None
+            and now - self.checked_at < STALE_CHECK_INTERVAL
+        ):
+            return self.stale
+
+        self.checked_at = now
+
+        for path, mtime in self.files.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    self.stale = True
+                    break
+            except OSError:
+                self.stale = True
+                break
+
+        return self.stale
+
+    async def fork(self, command, cgroup_path=None, on_exit=None):
+        """
+        Fork a process running `command`, in the cgroup at `cgroup_path` if
+        given, once the zygote reports it has, which is quick once it is
+        ready. Raises PreloadError if it does not within FORK_TIMEOUT.
+        """
+
+        stdout, write_fd = create_output_pipe()
+
+        try:
+            data = json.dumps(command.get_request(cgroup_path)).encode() + b"\n"
+
+            try:
+                sent = socket.send_fds(self.sock, [data], [write_fd])
+            except OSError as ex:
+                raise PreloadError("unable to reach the zygote: {}".format(ex))
+
+            if sent != len(data):
+                raise PreloadError("unable to send the whole request to the zygote")
+        except BaseException:
+            stdout.close()
+            raise
+        finally:
+            os.close(write_fd)
+
+        # resolved by handle, in the order the requests were sent
+        forked = asyncio.get_running_loop().create_future()
+        self.forks.append((forked, stdout, on_exit))
+
+        try:
+            return await asyncio.wait_for(forked, FORK_TIMEOUT)
+        except asyncio.TimeoutError:
+            stdout.close()
+            raise PreloadError("the zygote did not fork in time")
+        except BaseException:
+            stdout.close()
+
+            # cancelled just as it was forked
+            if forked.done() and not forked.cancelled() and not forked.exception():
+                forked.result().kill()
+
+            raise
+
+    def read(self):
+        """
+        Handle whatever the zygote has sent.
+        """
+
+        try:
+            data = self.sock.recv(1024 * 1024)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.closed()
+            return
+
+        self.buffer += data
+
+        while b"\n" in self.buffer:
+            line, self.buffer = self.buffer.split(b"\n", 1)
+            self.handle(json.loads(line))
+
+    def handle(self, message):
+
+        if "ready" in message:
+            self.files = message["ready"]
+            self.checked_at = time.monotonic()
+
+            logger.info(
+                "[locald] preloaded {} modules for service {}"
+                .format(len(self.files), self.name)
+            )
+
+            self.resolve(None)
+        elif "error" in message:
+            self.resolve(PreloadError(message["error"].strip()))
+        elif "pid" in message:
+            forked, stdout, on_exit = self.forks.popleft()
+
+            # given up on, see fork
+            if forked.done():
+                kill(message["pid"])
+                return
+
+            process = ForkedProcess(message["pid"], stdout, on_exit)
+            self.children[process.pid] = process
+
+            forked.set_result(process)
+        elif "exited" in message:
+            process = self.children.pop(message["exited"], None)
+            if process is not None:
+                process.set_returncode(message["returncode"])
+
+    def resolve(self, error):
+        if not self.ready.done():
+            self.ready.set_result(error)
+
+    def close(self):
+        """
+        Stop forking. The zygote exits once its last process has, and keeps
+        reporting their exits until then.
+        """
+
+        if self.sock is None:
+            return
+
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.closed()
+
+    def closed(self):
+
+        if self.sock is None:
+            return
+
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+
+        self.resolve(PreloadError("the zygote exited"))
+
+        for forked, _, _ in self.forks:
+            if not forked.done():
+                forked.set_exception(PreloadError("the zygote exited"))
+        self.forks.clear()
+
+        # killed along with the zygote, see PR_SET_PDEATHSIG
+        for process in self.children.values():
+            process.set_returncode(-signal.SIGKILL)
+        self.children.clear()
+
+        loop = asyncio.get_running_loop()
+        self.reap(loop.time() + EXIT_TIMEOUT)
+
+    def reap(self, deadline):
+        """
+        Wait for the zygote to exit without blocking, killing it if it has
+        not by `deadline`, in loop time.
+        """
+
+        if self.process.poll() is not None:
+            return
+
+        loop = asyncio.get_running_loop()
+        if loop.time() >= deadline:
+            self.process.kill()
+
+        loop.call_later(EXIT_POLL_INTERVAL, self.reap, deadline)
+
+
+def kill(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def check_platform():
+    """
+    Raise PreloadError where forked processes could outlive their zygote.
+    """
+
+    if not sys.platform.startswith("linux"):
+        raise PreloadError("preloading is only supported on Linux")
+
+
+def get_preload_modules(config):
+    """
+    The modules the service's zygote imports, in a tuple that is empty if
+    it does not set `preload`.
+    """
+
+    return tuple(
+        name.strip()
+        for name in config["service"].get("preload", "").split(",")
+        if name.strip()
+    )
@@ -0,0 +1,161 @@
+"""
+Readiness probes for services.
+
+A service may declare any number of the following in its `[service]` section,
+and is considered ready once all of them pass:
+
+    ready_tcp=8000             # or host:port, a connection must succeed
+    ready_http=http://localhost:8000/health  # must respond with a 200
+    ready_file=/tmp/myservice.pid            # the path must exist
+    ready_log=listening on port \\d+         # regex searched for in the output
+
+`ready_timeout` (seconds, default 60) bounds how long to wait and
+`ready_interval` (seconds, default 0.1) controls how often to check.
+"""
+
+import asyncio
+import http.client
+import os
+import re
+import time
+import urllib.request
+
+
+class ProbeError(Exception):
+    pass
+
+
+class TCPProbe(object):
+
+    def __init__(self, address):
+        if ":" in address:
+            host, port = address.rsplit(":", 1)
+        else:
+            host, port = "localhost", address
+
+        self.host = host or "localhost"
+        self.port = int(port)
+
+    def __str__(self):
+        return "tcp {}:{}".format(self.host, self.port)
+
+    async def check(self):
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                timeout=1,
+            )
+        except (OSError, asyncio.TimeoutError):
+            return False
+
+        writer.close()
+
+        return True
+
+
+class HTTPProbe(object):
+
+    def __init__(self, url):
+        self.url = url
+
+    def __str__(self):
+        return "http {}".format(self.url)
+
+    async def check(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.fetch)
+
+    def fetch(self):
+        try:
+            with urllib.request.urlopen(self.url, timeout=1) as response:
+                return response.status == 200
+        except (OSError, http.client.HTTPException):
+            return False
+
+
+class FileProbe(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return "file {}".format(self.path)
+
+    async def check(self):
+        return os.path.exists(self.path)
+
+
+class LogProbe(object):
+    """
+    Searches lines the service outputs after the probe was created, so a
+    match left over from a previous run does not count.
+    """
+
+    def __init__(self, pattern, log):
+        self.pattern = re.compile(pattern.encode("utf-8"))
+        self.log = log
+        self.seq = log.seq
+
+    def __str__(self):
+        return "log {}".format(self.pattern.pattern.decode("utf-8"))
+
+    async def check(self):
+
+        lines = self.log.get_lines_since(self.seq)
+        self.seq = self.log.seq
+
+        return any(self.pattern.search(line) for _, _, line in lines)
+
+
+def get_probes(service_config, log):
+
+    values = service_config["service"]
+
+    probes = []
+
+    if values.get("ready_tcp"):
+        probes.append(TCPProbe(values["ready_tcp"]))
+
+    if values.get("ready_http"):
+        probes.append(HTTPProbe(values["ready_http"]))
+
+    if values.get("ready_file"):
+        probes.append(FileProbe(values["ready_file"]))
+
+    if values.get("ready_log"):
+        probes.append(LogProbe(values["ready_log"], log))
+
+    return probes
+
+
+async def wait_until_ready(name, service_config, probes, is_alive, sleep=asyncio.sleep):
+    """
+    Wait until every probe passes, raising ProbeError if the service exits
+    or `ready_timeout` elapses first. `sleep` is awaited between checks.
+    """
+
+    values = service_config["service"]
+    timeout = float(values.get("ready_timeout", "60"))
+    interval = float(values.get("ready_interval", "0.1"))
+
+    deadline = time.monotonic() + timeout
+
+    pending = list(probes)
+    while True:
+        pending = [p for p in pending if not await p.check()]
+        if not pending:
+            return
+
+        if not is_alive():
+            raise ProbeError(
+                "'{}' exited before becoming ready"
+                .format(name)
+            )
+
+        if time.monotonic() >= deadline:
+            raise ProbeError(
+                "'{}' did not become ready within {} seconds ({})"
+                .format(name, timeout, ", ".join(str(p) for p in pending))
+            )
+
+        await sleep(interval)
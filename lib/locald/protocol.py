@@ -0,0 +1,71 @@
+"""
+Framing for messages on the control socket.
+
+Every message is a JSON document encoded as UTF-8 and preceded by its length
+as a 4 byte, big-endian unsigned integer. Requests carry an "id" which the
+server echoes back in a response envelope of the form
+{"id": ..., "response": ...}, so that many requests can be pipelined over one
+connection and their responses matched up regardless of completion order.
+"""
+
+import json
+import struct
+
+
+HEADER = struct.Struct("!I")
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode_frame(data):
+
+    payload = json.dumps(data).encode("utf-8")
+
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(
+            "message of {} bytes exceeds the maximum of {}"
+            .format(len(payload), MAX_FRAME_SIZE)
+        )
+
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder(object):
+    """
+    Accumulates bytes as they arrive, however they happen to be split up, and
+    yields each complete message.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+
+        self.buffer.extend(data)
+
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            size, = HEADER.unpack_from(self.buffer)
+            if size > MAX_FRAME_SIZE:
+                raise ProtocolError(
+                    "message of {} bytes exceeds the maximum of {}"
+                    .format(size, MAX_FRAME_SIZE)
+                )
+
+            end = HEADER.size + size
+            if len(self.buffer) < end:
+                break
+
+            payload = bytes(self.buffer[HEADER.size:end])
+            del self.buffer[:end]
+
+            try:
+                messages.append(json.loads(payload.decode("utf-8")))
+            except ValueError as ex:
+                raise ProtocolError("invalid message: {}".format(ex)) from ex
+
+        return messages
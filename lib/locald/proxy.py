@@ -0,0 +1,428 @@
+"""
+TCP (and unix socket) proxying for services.
+
+The server sits in front of services that set `listen_target` (see
+locald.activation) or `proxy_port`, accepting connections itself and relaying
+them to the service. Connections are relayed with splice(2) where the
+platform has it, so the data moves between the two sockets through a kernel
+pipe without being copied into the server, and with plain reads and writes
+elsewhere.
+
+With `proxy_port`, the server binds that port for the service, and the
+service is given another port to listen on in `$PORT` (which also replaces
+`{port}` in its command). On restart, a new run is started on the other of
+its two ports while the old one keeps serving. Once the new run is ready, new
+connections go to it, and the old run is stopped as soon as the connections
+it has finish, or after `proxy_drain_timeout` seconds (default 30). The ports
+to alternate between can be set with `proxy_backend_ports=8001,8002`, and are
+otherwise picked from the free ports on the machine.
+
+Listening sockets handed over by a previous server (see locald.state) are
+taken up again by whatever binds the same address first, rather than bound
+anew.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import stat
+
+
+logger = logging.getLogger()
+
+
+LISTEN_BACKLOG = 128
+
+RELAY_CHUNK_SIZE = 64 * 1024
+
+SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+
+# listening sockets handed over by a previous server, by address
+inherited_sockets = {}
+
+
+class ServiceProxy(object):
+    """
+    The port a service with `proxy_port` is reached on, and the ports its
+    runs take turns listening on.
+    """
+
+    def __init__(self, name, address, backend_ports=None, drain_timeout=30):
+        self.name = name
+        self.address = address
+        self.backend_ports = backend_ports or []
+        self.drain_timeout = drain_timeout
+        self.sockets = []
+        self.tasks = []
+        self.handle_connection = None
+
+    def __str__(self):
+        return format_address(self.address)
+
+    @classmethod
+    def create(cls, name, config):
+        """
+        The service's proxy settings, or None if it does not set
+        `proxy_port`.
+        """
+
+        values = config["service"]
+
+        if not values.get("proxy_port"):
+            return None
+
+        backend_ports = [
+            int(p)
+            for p in values.get("proxy_backend_ports", "").split(",")
+            if p.strip()
+        ]
+
+        if backend_ports and len(backend_ports) != 2:
+            raise ValueError("proxy_backend_ports must list two ports")
+
+        return cls(
+            name,
+            parse_address(values["proxy_port"]),
+            backend_ports,
+            float(values.get("proxy_drain_timeout", "30")),
+        )
+
+    def matches(self, other):
+        return (
+            other is not None
+            and (self.address, self.backend_ports, self.drain_timeout)
+            == (other.address, other.backend_ports, other.drain_timeout)
+        )
+
+    def open(self, handle_connection):
+        """
+        Bind the proxy's port and start handing connections to it to
+        `handle_connection(client)`.
+        """
+
+        sock = bind(self.address)
+        self.sockets.append(sock)
+        self.handle_connection = handle_connection
+        self.resume()
+
+        logger.info(
+            "[locald] proxying {} for service {}"
+            .format(self, self.name)
+        )
+
+    def pause(self):
+        """
+        Stop accepting connections, leaving them to wait on the port.
+        """
+
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def resume(self):
+        """
+        Accept connections again after pause.
+        """
+
+        if self.tasks:
+            return
+
+        for sock in self.sockets:
+            self.tasks.append(
+                asyncio.ensure_future(serve(sock, self.handle_connection)),
+            )
+
+    def close(self):
+
+        self.pause()
+
+        if isinstance(self.address, str):
+            remove_socket_file(self.address)
+
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+
+    def get_next_port(self, port):
+        """
+        The port for a run to listen on, other than `port`, which the
+        current run listens on.
+        """
+
+        if self.backend_ports:
+            first, second = self.backend_ports
+            return second if port == first else first
+
+        return get_free_port()
+
+
+async def serve(sock, handle_connection):
+    """
+    Accept connections on the listening socket `sock` until cancelled,
+    calling `handle_connection(client)` for each one.
+    """
+
+    loop = asyncio.get_running_loop()
+    sock.setblocking(False)
+
+    while True:
+        try:
+            client, _ = await loop.sock_accept(sock)
+        except OSError as ex:
+            # most likely out of file descriptors, which may not last
+            logger.warning("[locald] unable to accept a connection: {}".format(ex))
+            await asyncio.sleep(0.1)
+            continue
+
+        set_nodelay(client)
+        asyncio.ensure_future(handle_connection(client))
+
+
+async def connect(address):
+    """
+    A non-blocking socket connected to `address`.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    if isinstance(address, str):
+        candidates = [(socket.AF_UNIX, address)]
+    else:
+        infos = await loop.getaddrinfo(*address, type=socket.SOCK_STREAM)
+        candidates = [(family, sockaddr) for family, _, _, _, sockaddr in infos]
+
+    error = None
+    for family, sockaddr in candidates:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+
+        try:
+            await loop.sock_connect(sock, sockaddr)
+        except OSError as ex:
+            sock.close()
+            error = ex
+            continue
+
+        set_nodelay(sock)
+
+        return sock
+
+    raise error or OSError("unable to resolve {}".format(format_address(address)))
+
+
+async def relay(client, upstream):
+    """
+    Pass data between two connected sockets in both directions until both
+    are done, then close them.
+    """
+
+    try:
+        await asyncio.gather(copy(client, upstream), copy(upstream, client))
+    finally:
+        client.close()
+        upstream.close()
+
+
+async def copy(source, destination):
+
+    try:
+        if hasattr(os, "splice"):
+            await splice(source, destination)
+        else:
+            await send_all(source, destination)
+
+        destination.shutdown(socket.SHUT_WR)
+    except OSError:
+        # one side went away, so the other direction is finished too
+        for sock in (source, destination):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+async def splice(source, destination):
+    """
+    Move data from `source` to `destination` through a pipe, without it
+    passing through user space.
+    """
+
+    read_fd, write_fd = os.pipe()
+
+    try:
+        while True:
+            try:
+                count = os.splice(
+                    source.fileno(),
+                    write_fd,
+                    RELAY_CHUNK_SIZE,
+                    flags=SPLICE_FLAGS,
+                )
+            except BlockingIOError:
+                await wait_for_fd(source.fileno(), readable=True)
+                continue
+
+            if not count:
+                return
+
+            while count:
+                try:
+                    count -= os.splice(
+                        read_fd,
+                        destination.fileno(),
+                        count,
+                        flags=SPLICE_FLAGS,
+                    )
+                except BlockingIOError:
+                    await wait_for_fd(destination.fileno(), readable=False)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+async def send_all(source, destination):
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        data = await loop.sock_recv(source, RELAY_CHUNK_SIZE)
+        if not data:
+            return
+
+        await loop.sock_sendall(destination, data)
+
+
+async def wait_for_fd(fd, readable):
+
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def ready():
+        if not future.done():
+            future.set_result(None)
+
+    if readable:
+        loop.add_reader(fd, ready)
+    else:
+        loop.add_writer(fd, ready)
+
+    try:
+        await future
+    finally:
+        if readable:
+            loop.remove_reader(fd)
+        else:
+            loop.remove_writer(fd)
+
+
+def set_nodelay(sock):
+
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def get_free_port():
+    """
+    A port nothing is listening on right now.
+    """
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def parse_address(value):
+    """
+    A unix socket path, or a (host, port) tuple for "port" or "host:port".
+    """
+
+    value = value.strip()
+
+    if value.startswith("/"):
+        return value
+
+    if ":" in value:
+        host, port = value.rsplit(":", 1)
+    else:
+        host, port = "localhost", value
+
+    host = host.strip("[]") or "localhost"
+
+    try:
+        return (host, int(port))
+    except ValueError:
+        raise ValueError("invalid address '{}'".format(value))
+
+
+def format_address(address):
+
+    if isinstance(address, str):
+        return address
+
+    return "{}:{}".format(*address)
+
+
+def bind(address):
+
+    sock = inherited_sockets.pop(format_address(address), None)
+    if sock is not None:
+        return sock
+
+    if isinstance(address, str):
+        remove_socket_file(address)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(address)
+            sock.listen(LISTEN_BACKLOG)
+        except OSError:
+            sock.close()
+            raise
+
+        return sock
+
+    return socket.create_server(address, backlog=LISTEN_BACKLOG)
+
+
+def inherit_socket(address, fd):
+    """
+    Take up the listening socket `fd` for `address` from a previous server,
+    to be returned by the next bind of that address.
+    """
+
+    sock = socket.socket(fileno=fd)
+    sock.set_inheritable(False)
+
+    inherited_sockets[address] = sock
+
+
+def close_inherited_sockets():
+    """
+    Close the sockets handed over by a previous server that nothing took up.
+    """
+
+    for address, sock in list(inherited_sockets.items()):
+        logger.info(
+            "[locald] no longer listening on {}"
+            .format(address)
+        )
+
+        if address.startswith("/"):
+            remove_socket_file(address)
+
+        sock.close()
+
+    inherited_sockets.clear()
+
+
+def remove_socket_file(path):
+    """
+    Remove a unix socket left behind at `path`, but nothing else.
+    """
+
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
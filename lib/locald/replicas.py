@@ -0,0 +1,533 @@
+"""
+Replicas of services.
+
+A service may set, in its `[service]` section:
+
+    replicas=3                  # run this many instances of it
+    replica_base_port=9001      # ports of the instances, counting up from this
+    proxy_port=9000             # balance connections over the instances
+    proxy_balance=round_robin   # or least_connections
+
+Each instance is a service of its own, named after the service and its number
+(`web@1`, `web@2`, ...), with its own process, restarts, readiness, metrics
+and log. It is given its number in `$LOCALD_INSTANCE` and a port in `$PORT`,
+which also replace `{instance}` and `{port}` in every setting of the service,
+such as `command` or `ready_http`. Ports count up from `replica_base_port`, or
+are picked from the free ports on the machine. A `log_path` without
+`{instance}` in it gets the instance's number, so `/tmp/web.log` becomes
+`/tmp/web@1.log`.
+
+With `proxy_port`, the server binds that port and passes each connection on
+to one of the ready instances, taking turns (round_robin, the default) or
+picking the one with the fewest open connections (least_connections).
+Instances without readiness probes are ready once their port accepts
+connections.
+
+Restarting a running service restarts one instance at a time, and with
+`proxy_port` each one only gets new connections again once it is ready, and
+is only stopped once its connections finish or `proxy_drain_timeout` seconds
+(default 30) pass, so the other instances keep serving throughout.
+
+`locald scale <service> <count>` changes the number of instances until the
+server is stopped, starting or stopping instances straight away if the service
+is running.
+"""
+
+import asyncio
+import collections
+import itertools
+import logging
+import os
+import time
+
+from .proxy import ServiceProxy, connect, get_free_port, relay
+from .service import Service
+
+
+logger = logging.getLogger()
+
+
+BALANCE_POLICIES = ("round_robin", "least_connections")
+
+# settings that belong to the service as a whole rather than its instances
+REPLICA_SETTINGS = (
+    "replicas",
+    "replica_base_port",
+    "proxy_port",
+    "proxy_balance",
+    "proxy_backend_ports",
+    "proxy_drain_timeout",
+)
+
+PROBE_SETTINGS = ("ready_tcp", "ready_http", "ready_file", "ready_log")
+
+
+class ReplicaError(ValueError):
+    pass
+
+
+class ReplicaSet(object):
+    """
+    The instances of a service that sets `replicas`, and the proxy balancing
+    connections over them. Handled by the server like a single service.
+    """
+
+    def __init__(self, name, config, scheduler, cgroups=None):
+        self.name = name
+        self.config = config
+        self.scheduler = scheduler
+        self.cgroups = cgroups
+        self.instances = []
+        self.count = None
+        self.proxy = None
+        self.balance = "round_robin"
+        self.connections = collections.Counter()
+        self.draining = set()
+        self.turns = itertools.count()
+        self.stopping = False
+
+    @property
+    def activation(self):
+        # replicas cannot be socket activated
+        return None
+
+    @property
+    def idle(self):
+        return bool(self.instances) and all(i.idle for i in self.instances)
+
+    @property
+    def restart_count(self):
+        return sum(i.restart_count for i in self.instances)
+
+    @property
+    def memory_restarts(self):
+        return sum(i.memory_restarts for i in self.instances)
+
+    @property
+    def rss_alerts(self):
+        return sum(i.rss_alerts for i in self.instances)
+
+    @property
+    def rss_growth(self):
+        rates = [i.rss_growth for i in self.instances if i.rss_growth is not None]
+        return sum(rates) if rates else None
+
+    @property
+    def last_returncode(self):
+        return None
+
+    def get_count(self):
+        """
+        The number of instances to run: as scaled, or as configured.
+        """
+
+        if self.count is not None:
+            return self.count
+
+        return parse_count(self.config["service"].get("replicas", "1"))
+
+    def get_instance(self, number):
+        for instance in self.instances:
+            if instance.instance == number:
+                return instance
+
+        return None
+
+    def get_instance_config(self, number, port):
+        """
+        The configuration of one instance: the service's own, with
+        `{instance}` and `{port}` filled in.
+        """
+
+        values = {}
+        for key, value in self.config["service"].items():
+            if key in REPLICA_SETTINGS:
+                continue
+
+            if isinstance(value, str):
+                value = value.replace("{instance}", str(number))
+                value = value.replace("{port}", str(port))
+
+            values[key] = value
+
+        log_path = self.config["service"].get("log_path")
+        if log_path and "{instance}" not in log_path:
+            base, ext = os.path.splitext(log_path)
+            values["log_path"] = "{}@{}{}".format(base, number, ext)
+
+        # connections only go to instances that are listening
+        if self.proxy is not None and not any(values.get(k) for k in PROBE_SETTINGS):
+            values["ready_tcp"] = "localhost:{}".format(port)
+
+        return dict(self.config, service=values)
+
+    def get_port(self, number, instance=None):
+
+        base_port = self.config["service"].get("replica_base_port")
+        if base_port:
+            return int(base_port) + number - 1
+
+        if instance is not None and instance.instance_port is not None:
+            return instance.instance_port
+
+        return get_free_port()
+
+    def prepare_instance(self, number, port=None):
+        """
+        The instance numbered `number`, created if need be, with its
+        configuration brought up to date for its next start, on `port` if
+        given.
+        """
+
+        instance = self.get_instance(number)
+
+        if port is None:
+            port = self.get_port(number, instance)
+
+        config = self.get_instance_config(number, port)
+
+        if instance is None:
+            instance = Service(
+                "{}@{}".format(self.name, number),
+                config,
+                self.scheduler,
+                self.cgroups,
+            )
+            instance.instance = number
+            self.instances.append(instance)
+
+        instance.config = config
+        instance.instance_port = port
+        instance.environment = {
+            "PORT": str(port),
+            "LOCALD_INSTANCE": str(number),
+        }
+
+        return instance
+
+    def start(self):
+
+        self.apply_settings()
+        self.open_proxy()
+
+        for number in range(1, self.get_count() + 1):
+            self.prepare_instance(number).start()
+
+    def apply_settings(self):
+
+        values = self.config["service"]
+
+        if values.get("listen"):
+            raise ReplicaError(
+                "'{}' cannot set both listen and replicas"
+                .format(self.name)
+            )
+
+        balance = values.get("proxy_balance", "round_robin")
+        if balance not in BALANCE_POLICIES:
+            raise ReplicaError(
+                "invalid proxy_balance '{}' for '{}'"
+                .format(balance, self.name)
+            )
+
+        self.balance = balance
+
+    def adopt_instance(self, number, port):
+        """
+        The instance numbered `number`, to take over a run of it started by
+        a previous server on `port`, see locald.state.
+        """
+
+        self.apply_settings()
+        self.open_proxy()
+
+        return self.prepare_instance(number, port)
+
+    def open_proxy(self):
+
+        proxy = ServiceProxy.create(self.name, self.config)
+
+        if proxy is None:
+            self.close_sockets()
+            return
+
+        if not proxy.matches(self.proxy):
+            self.close_sockets()
+            proxy.open(self.handle_connection)
+            self.proxy = proxy
+
+    def close_sockets(self):
+
+        if self.proxy is not None:
+            self.proxy.close()
+            self.proxy = None
+
+    async def wait_until_ready(self):
+        await asyncio.gather(*(
+            i.wait_until_ready()
+            for i in self.instances
+            if i.is_running()
+        ))
+
+    async def stop(self, close_sockets=True):
+        """
+        Stop every instance, returning True if none of them had to be killed.
+        """
+
+        if close_sockets:
+            self.close_sockets()
+
+        self.stopping = True
+
+        try:
+            results = await asyncio.gather(*(
+                i.stop(close_sockets) for i in self.instances
+            ))
+        finally:
+            self.stopping = False
+
+        # instances scaled away are only kept until they have stopped
+        self.remove_instances(self.get_count())
+
+        return all(results)
+
+    def remove_instances(self, count):
+        self.instances = [
+            i for i in self.instances
+            if i.instance <= count or i.is_running()
+        ]
+
+    def kill(self):
+        for instance in self.instances:
+            instance.kill()
+
+    def tend(self):
+        for instance in self.instances:
+            instance.tend()
+
+    def is_running(self):
+        return any(i.is_running() for i in self.instances)
+
+    def can_swap(self):
+        return self.is_running() and not self.stopping
+
+    async def swap(self):
+        """
+        Restart the instances one at a time, so that the others keep running
+        while each one restarts, and start any that are not running.
+        """
+
+        self.open_proxy()
+
+        for number in range(1, self.get_count() + 1):
+            await self.restart_instance(number)
+
+    async def restart_instance(self, number):
+        """
+        Restart one instance, waiting for it to finish the connections it has
+        first and for it to become ready again after.
+        """
+
+        self.draining.add(number)
+
+        try:
+            instance = self.prepare_instance(number)
+
+            if instance.is_running():
+                await self.drain(instance)
+                await instance.restart()
+            else:
+                instance.start()
+
+            await instance.wait_until_ready()
+        finally:
+            self.draining.discard(number)
+
+    async def stop_instance(self, number):
+        """
+        Stop one instance, leaving the others running. Returns True if it did
+        not have to be killed.
+        """
+
+        instance = self.get_instance(number)
+
+        self.draining.add(number)
+
+        try:
+            await self.drain(instance)
+            return await instance.stop()
+        finally:
+            self.draining.discard(number)
+
+    async def drain(self, instance):
+
+        if self.proxy is None:
+            return
+
+        deadline = self.scheduler.time() + self.proxy.drain_timeout
+        while self.connections[instance.instance] and self.scheduler.time() < deadline:
+            await self.scheduler.sleep(0.1)
+
+    async def scale(self, count):
+        """
+        Run `count` instances from now on, starting or stopping instances
+        right away if the service is running. Returns the numbers of the
+        instances started and stopped.
+        """
+
+        previous = self.get_count()
+        self.count = count
+
+        if not self.is_running():
+            self.remove_instances(count)
+            return [], []
+
+        started = list(range(previous + 1, count + 1))
+        stopped = [
+            i.instance
+            for i in self.instances
+            if i.instance > count and i.is_running()
+        ]
+
+        for number in started:
+            self.prepare_instance(number).start()
+
+        await asyncio.gather(*(self.stop_instance(n) for n in stopped))
+        self.remove_instances(count)
+
+        await asyncio.gather(*(
+            self.get_instance(n).wait_until_ready() for n in started
+        ))
+
+        return started, stopped
+
+    def is_available(self, instance):
+        """
+        Whether new connections can go to `instance`.
+        """
+
+        return (
+            instance.instance not in self.draining
+            and instance.instance <= self.get_count()
+            and instance.is_running()
+            and not instance.stopping
+            and instance.ready.done()
+            and instance.ready.result() is None
+        )
+
+    def is_starting(self):
+        """
+        Whether an instance may soon be available, if none is now.
+        """
+
+        return bool(self.draining) or any(
+            i.is_running() and not i.ready.done()
+            for i in self.instances
+        )
+
+    async def pick(self):
+        """
+        The instance to pass the next connection on to, waiting for one while
+        instances are starting or restarting.
+        """
+
+        while True:
+            available = [i for i in self.instances if self.is_available(i)]
+            if available or not self.is_starting():
+                break
+
+            await self.scheduler.sleep(0.05)
+
+        if not available:
+            raise Exception("no instance of '{}' is ready".format(self.name))
+
+        turn = next(self.turns)
+
+        if self.balance == "least_connections":
+            # ties are taken in turns too, so idle instances share the load
+            start = turn % len(available)
+            available = available[start:] + available[:start]
+            return min(available, key=lambda i: self.connections[i.instance])
+
+        return available[turn % len(available)]
+
+    async def handle_connection(self, client):
+        """
+        Pass a connection to the proxy port on to one of the instances.
+        """
+
+        instance = None
+
+        try:
+            instance = await self.pick()
+
+            # counted from before connecting, so an instance is not stopped
+            # with a connection to it on the way
+            self.connections[instance.instance] += 1
+            instance.connections += 1
+            instance.last_activity = time.monotonic()
+
+            upstream = await connect(("localhost", instance.instance_port))
+            await relay(client, upstream)
+        except Exception as ex:
+            logger.warning(
+                "[locald] unable to pass a connection on to service {}: {}"
+                .format(self.name, ex)
+            )
+            client.close()
+        finally:
+            if instance is not None:
+                self.connections[instance.instance] -= 1
+                if not self.connections[instance.instance]:
+                    del self.connections[instance.instance]
+
+                instance.connections -= 1
+                instance.last_activity = time.monotonic()
+
+    def get_status(self):
+        """
+        The status shared by every instance, or DEGRADED when they differ.
+        """
+
+        statuses = set(i.get_status() for i in self.instances)
+
+        if not statuses:
+            return "STOPPED"
+
+        if len(statuses) == 1:
+            return statuses.pop()
+
+        return "DEGRADED"
+
+    def get_next_restart(self):
+
+        restarts = [
+            i.get_next_restart()
+            for i in self.instances
+            if i.get_next_restart() is not None
+        ]
+
+        return min(restarts) if restarts else None
+
+    def get_uptime(self):
+
+        uptimes = [i.get_uptime() for i in self.instances if i.is_running()]
+
+        return max(uptimes) if uptimes else None
+
+
+def parse_count(value):
+
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+
+    if count < 1:
+        raise ReplicaError("invalid number of replicas '{}'".format(value))
+
+    return count
+
+
+def is_replicated(config):
+    return "replicas" in config["service"]
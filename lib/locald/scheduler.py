@@ -0,0 +1,149 @@
+"""
+A single timer heap for everything the server needs to do at a later time:
+pending restarts, readiness probe checks, stop escalations and the like.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import traceback
+
+
+logger = logging.getLogger()
+
+
+class ScheduledCall(object):
+
+    def __init__(self, when, seq, key, callback, args):
+        self.when = when
+        self.seq = seq
+        self.key = key
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+
+class Scheduler(object):
+    """
+    Deadlines are kept in a heap, and only one event loop timer is armed at a
+    time, for the nearest of them. Each wakeup runs just the calls that are
+    due, so the cost is proportional to the number of due events rather than
+    the number of services.
+
+    Calls may be given a key. Scheduling a call with a key that is already
+    pending replaces it, and a key can be used to cancel or look up a call.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.keys = {}
+        self.seq = itertools.count()
+        self.timer = None
+        self.timer_when = None
+
+    def time(self):
+        return asyncio.get_running_loop().time()
+
+    def call_later(self, delay, callback, *args, key=None):
+        return self.call_at(self.time() + delay, callback, *args, key=key)
+
+    def call_at(self, when, callback, *args, key=None):
+
+        if key is not None:
+            self.cancel(key)
+
+        call = ScheduledCall(when, next(self.seq), key, callback, args)
+        heapq.heappush(self.heap, call)
+
+        if key is not None:
+            self.keys[key] = call
+
+        if self.timer_when is None or when < self.timer_when:
+            self.arm()
+
+        return call
+
+    def cancel(self, key):
+        """
+        Cancel the pending call scheduled under `key`, if there is one.
+        Cancelled calls are dropped lazily as they reach the top of the heap.
+        """
+
+        call = self.keys.pop(key, None)
+        if call is not None:
+            call.cancelled = True
+
+    def when(self, key):
+        """
+        The wall clock time at which the call scheduled under `key` is due,
+        or None if there is no such call.
+        """
+
+        call = self.keys.get(key)
+        if call is None:
+            return None
+
+        return time.time() + (call.when - self.time())
+
+    async def sleep(self, delay):
+
+        future = asyncio.get_running_loop().create_future()
+
+        def wake():
+            if not future.done():
+                future.set_result(None)
+
+        call = self.call_later(delay, wake)
+        try:
+            await future
+        finally:
+            call.cancelled = True
+
+    def arm(self):
+
+        while self.heap and self.heap[0].cancelled:
+            heapq.heappop(self.heap)
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            self.timer_when = None
+
+        if not self.heap:
+            return
+
+        when = self.heap[0].when
+
+        loop = asyncio.get_running_loop()
+        self.timer = loop.call_at(when, self.run_due)
+        self.timer_when = when
+
+    def run_due(self):
+
+        self.timer = None
+        self.timer_when = None
+
+        now = self.time()
+
+        while self.heap and self.heap[0].when <= now:
+            call = heapq.heappop(self.heap)
+            if call.cancelled:
+                continue
+
+            if call.key is not None and self.keys.get(call.key) is call:
+                del self.keys[call.key]
+
+            try:
+                call.callback(*call.args)
+            except Exception:
+                logger.error(
+                    "[locald] scheduled call failed: {}"
+                    .format(traceback.format_exc())
+                )
+
+        self.arm()
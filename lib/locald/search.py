@@ -0,0 +1,295 @@
+"""
+Searching service log files on disk.
+
+Next to its log file each service keeps a sparse index (`<log_path>.idx`) of
+(capture time, offset) entries, see ServiceLog.write. Every line up to the
+next entry is treated as having been captured at the entry's time.
+
+Time range queries bisect the index to find where to start and stop reading,
+rather than scanning whole files, and segments that fall entirely outside the
+range are not opened at all.
+"""
+
+import bisect
+import gzip
+import io
+import mmap
+import os
+import re
+
+from .logs import (
+    INDEX_ENTRY,
+    find_segment,
+    get_index_path,
+    get_segment_base,
+    get_segments,
+    zstandard,
+)
+
+
+class LogQuery(object):
+    """
+    Which lines to return: those captured between `since` and `until` (both
+    seconds since the epoch, either may be None) that match the regular
+    expression `pattern`, if one is given.
+    """
+
+    def __init__(self, since=None, until=None, pattern=None):
+        self.since = since
+        self.until = until
+
+        self.pattern = None
+        self.file_pattern = None
+        if pattern:
+            self.pattern = re.compile(pattern.encode("utf-8"))
+
+            # for searching whole files, where ^ and $ should still match at
+            # the start and end of each line
+            self.file_pattern = re.compile(pattern.encode("utf-8"), re.MULTILINE)
+
+    def is_empty(self):
+        return self.since is None and self.until is None and self.pattern is None
+
+    def matches_time(self, timestamp):
+
+        if self.since is not None and timestamp < self.since:
+            return False
+
+        if self.until is not None and timestamp > self.until:
+            return False
+
+        return True
+
+    def matches(self, entry):
+
+        timestamp, _, line = entry
+
+        if not self.matches_time(timestamp):
+            return False
+
+        if self.pattern is not None and not self.pattern.search(line):
+            return False
+
+        return True
+
+
+def read_index(index_fp):
+    """
+    Return the timestamps and offsets recorded in a log file's index, as two
+    parallel lists.
+    """
+
+    if index_fp is None:
+        return [], []
+
+    with index_fp:
+        data = index_fp.read()
+
+    # ignore a partially written trailing entry
+    data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+
+    timestamps = []
+    offsets = []
+    for timestamp, offset in INDEX_ENTRY.iter_unpack(data):
+        timestamps.append(timestamp)
+        offsets.append(offset)
+
+    return timestamps, offsets
+
+
+def get_range(timestamps, offsets, query):
+    """
+    The offsets to read between for `query`, with None for the end meaning
+    the end of the file. Returns None if nothing in the segment can match.
+    """
+
+    start = 0
+    end = None
+
+    if query.since is not None:
+        i = bisect.bisect_left(timestamps, query.since)
+        if i == len(timestamps):
+            return None
+
+        start = offsets[i]
+
+    if query.until is not None:
+        j = bisect.bisect_right(timestamps, query.until)
+        if j == 0:
+            return None
+
+        if j < len(offsets):
+            end = offsets[j]
+
+    return start, end
+
+
+def open_index(path):
+    try:
+        return open(get_index_path(path), "rb")
+    except OSError:
+        return None
+
+
+def open_segment(path):
+
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise OSError("zstandard is required to read {}".format(path))
+
+        return zstandard.open(path, "rb")
+
+    return open(path, "rb")
+
+
+def search_segment(path, name, query):
+
+    # a segment may have been compressed since it was listed
+    if not os.path.exists(path):
+        path = find_segment(get_segment_base(path))
+
+    index_fp = open_index(path)
+
+    try:
+        fp = open_segment(path)
+    except OSError:
+        if index_fp is not None:
+            index_fp.close()
+        return
+
+    yield from search_file(fp, index_fp, name, query)
+
+
+def search_file(fp, index_fp, name, query, limit=None):
+    """
+    Yield (timestamp, name, line) for each line of the open log file `fp`
+    that matches `query`, reading no further than offset `limit`. Both `fp`
+    and `index_fp` are closed when done.
+    """
+
+    with fp:
+        timestamps, offsets = read_index(index_fp)
+
+        if not timestamps:
+            # written before indexing, all that is known is when it changed
+            timestamps, offsets = [os.fstat(fp.fileno()).st_mtime], [0]
+
+        bounds = get_range(timestamps, offsets, query)
+        if bounds is None:
+            return
+
+        start, end = bounds
+        if limit is not None and (end is None or end > limit):
+            end = limit
+
+        if isinstance(fp, io.BufferedReader):
+            lines = iter_mapped_lines(fp, start, end, query.file_pattern)
+        else:
+            lines = iter_stream_lines(fp, start, end)
+
+        # lines come in offset order, so the entry covering each one only
+        # ever moves forward
+        i = max(bisect.bisect_right(offsets, start) - 1, 0)
+
+        for offset, line in lines:
+            while i + 1 < len(offsets) and offsets[i + 1] <= offset:
+                i += 1
+
+            entry = (timestamps[i], name, line)
+            if query.matches(entry):
+                yield entry
+
+
+def iter_mapped_lines(fp, start, end, pattern=None):
+    """
+    Yield (offset, line) for the lines of a plain file between `start` and
+    `end`. With a `pattern`, the mapped file is searched directly and only
+    lines that might match are split out.
+    """
+
+    try:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # an empty file cannot be mapped
+        return
+
+    with mm:
+        if end is None or end > len(mm):
+            end = len(mm)
+
+        position = start
+        while position < end:
+            if pattern is not None:
+                match = pattern.search(mm, position, end)
+                if match is None:
+                    return
+
+                line_start = mm.rfind(b"\n", position, match.start())
+                if line_start != -1:
+                    position = line_start + 1
+
+            line_end = mm.find(b"\n", position, end)
+            if line_end == -1:
+                line_end = end
+
+            yield position, mm[position:line_end]
+
+            position = line_end + 1
+
+
+def iter_stream_lines(fp, start, end):
+    """
+    Yield (offset, line) for the lines of a compressed file between `start`
+    and `end`, decompressing as it goes.
+    """
+
+    offset = 0
+    while offset < start:
+        skipped = len(fp.read(min(start - offset, 1024 * 1024)))
+        if not skipped:
+            return
+
+        offset += skipped
+
+    for line in fp:
+        if end is not None and offset >= end:
+            return
+
+        yield offset, line.rstrip(b"\n")
+
+        offset += len(line)
+
+
+def search_log(log_path, name, query, end=None):
+    """
+    Return an iterator of (timestamp, name, line) for every line of the
+    service's log that matches `query`, oldest first, across rotated
+    segments and then the current file, which is read no further than
+    offset `end`.
+
+    The files to read are found, and the current one opened, before this
+    returns, so that a rotation while the iterator is being consumed does
+    not cause anything to be skipped.
+    """
+
+    segments = get_segments(log_path)
+
+    try:
+        current = (open(log_path, "rb"), open_index(log_path))
+    except OSError:
+        current = None
+
+    return iter_log(segments, current, name, query, end)
+
+
+def iter_log(segments, current, name, query, end):
+
+    for path in segments:
+        yield from search_segment(path, name, query)
+
+    if current is not None:
+        fp, index_fp = current
+        yield from search_file(fp, index_fp, name, query, end)
@@ -1,21 +1,90 @@
-import json
+import asyncio
+import collections
+import heapq
+import itertools
 import logging
 import logging.config
 import os
-import queue
-import select
+import re
+import signal
 import socket
+import subprocess
+import sys
 import traceback
 
+import psutil
 from daemonize import Daemonize
 
-from .config import get_config_for_service, get_service_configs
-from .service import Service
+from .cgroups import Cgroup, CgroupManager
+from .config import ServiceConfigRegistry, expand_service_names, get_config
+from .graph import (
+    DependencyError,
+    find_cycle,
+    get_requires,
+    get_reverse_graph,
+    resolve_dependencies,
+    run_in_dependency_order,
+)
+from .logs import Subscription
+from .metrics import MetricsHistory, ProcessSampler
+from .protocol import FrameDecoder, ProtocolError, encode_frame
+from .proxy import close_inherited_sockets, format_address, inherit_socket
+from .replicas import ReplicaError, ReplicaSet, is_replicated, parse_count
+from .scheduler import Scheduler
+from .search import LogQuery, search_log
+from .service import RestartPolicy, Service, set_result
+from .state import (
+    AdoptedProcess,
+    get_state_path,
+    read_state,
+    reap,
+    remove_state,
+    reopen_output,
+    write_state,
+)
+from .watch import FileWatcher, WatchSpec
 
 
 logger = logging.getLogger()
 
 
+# lines of log history sent per response
+LOG_CHUNK_LINES = 1000
+
+# seconds between checks of whether the state file needs writing
+STATE_INTERVAL = 1
+
+# run in place of the server by server-reload, see locald.state
+RESUME_SCRIPT = """\
+import sys
+from locald.server import resume_server
+resume_server(sys.argv[1])
+"""
+
+# run by server-reload before the server is replaced, to check that a new
+# one would start with the code and configuration as they are now
+CHECK_SCRIPT = """\
+import sys
+try:
+    from locald.server import create_server, get_config
+    create_server(get_config(sys.argv[1]))
+except Exception as ex:
+    sys.exit("{}: {}".format(type(ex).__name__, ex))
+"""
+
+# resource usage reported for services that are not running
+EMPTY_SAMPLE = {
+    "pid": None,
+    "processes": 0,
+    "cpu_percent": None,
+    "rss": None,
+    "fds": None,
+    "threads": None,
+    "read_bytes": None,
+    "write_bytes": None,
+}
+
+
 class Socket(object):
 
     def __init__(self, path):
@@ -53,26 +122,111 @@ class Socket(object):
             pass
 
 
+class Connection(object):
+    """
+    A client connected to the control socket. Requests on one connection are
+    handled concurrently, so responses are written under a lock and tagged
+    with the id of the request they answer.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.decoder = FrameDecoder()
+        self.lock = asyncio.Lock()
+        self.peer = writer.get_extra_info("peername")
+
+    async def send(self, request_id, response, more=False):
+        """
+        Send `response` to the request with `request_id`. Streamed responses
+        set `more` on every frame but the last.
+        """
+
+        logger.debug(
+            "[locald] sending '{}' to {}"
+            .format(response, self.peer)
+        )
+
+        envelope = {
+            "id": request_id,
+            "response": response,
+        }
+
+        if more:
+            envelope["more"] = True
+
+        try:
+            data = encode_frame(envelope)
+        except (TypeError, ValueError) as ex:
+            # too big or not JSON, the client still needs an answer
+            logger.error(
+                "[locald] unable to send response to {}: {}"
+                .format(self.peer, ex)
+            )
+
+            message = "unable to send response: {}".format(ex)
+
+            # the command stops and answers with the error instead
+            if more:
+                raise ProtocolError(message) from ex
+
+            data = encode_frame({
+                "id": request_id,
+                "response": {"messages": [message]},
+            })
+
+        async with self.lock:
+            try:
+                self.writer.write(data)
+                await self.writer.drain()
+            except OSError:
+                logger.info(
+                    "[locald] unable to send response to {}, client went away"
+                    .format(self.peer)
+                )
+
+
 class Server(object):
 
     def __init__(self, config):
         self.config = config
         self.processes = {}
+        self.service_configs = ServiceConfigRegistry(config)
+        self.scheduler = Scheduler()
+        self.sampler = ProcessSampler()
+        self.samples = {}
+        self.samples_at = None
+        self.sampling = None
+        self.metrics = {}
+        self.metrics_updated = None
+        self.cgroups = None
+        self.watcher = None
+        self.watch_lock = asyncio.Lock()
+        self.state_path = get_state_path(config)
+        self.saved_state = None
+        self.strays = set()
+        self.main_task = None
+        self.reloading = False
+        self.reload_requested = None
 
     def start(self):
 
         logging.config.fileConfig(self.config["locald"]["config_path"])
 
         try:
-            return self._run()
+            return asyncio.run(self._run())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            logger.info("[locald] server stopped")
+
+            # whatever shutdown did not get to, if it was interrupted
+            for proc in self.processes.values():
+                proc.kill()
         except:
+            # the services are left running for the next server to take
+            # over, see locald.state
             logger.error(traceback.format_exc())
             raise
-        finally:
-            for proc in self.processes.values():
-                proc.kill()
 
-    def _run(self):
+    async def _run(self):
 
         if "working_dir" in self.config["locald"]:
             os.chdir(self.config["locald"]["working_dir"])
@@ -86,183 +240,640 @@ class Server(object):
             .format(socket_path)
         )
 
-        timeout = 1  # 1 second
+        self.cgroups = CgroupManager.create(self.config)
+        self.watcher = FileWatcher.create(
+            self.config,
+            self.scheduler,
+            self.files_changed,
+        )
+
+        # child exits are noticed as they happen rather than on a tick
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGCHLD, self.tend_processes)
+
+        # SIGINT already cancels the main task, SIGTERM should shut down just
+        # as gracefully
+        self.main_task = asyncio.current_task()
+        loop.add_signal_handler(signal.SIGTERM, self.main_task.cancel)
+
+        self.adopt_services()
+
+        self.schedule_metrics()
+        self.schedule_state()
+
+        stopped = False
+
+        try:
+            while True:
+                await self.serve(socket_path)
+
+                await self.finish_connections()
+
+                # only returns if the new server could not be started, in
+                # which case this one carries on
+                self.hand_over()
+                self.carry_on()
+        except asyncio.CancelledError:
+            stopped = True
+            raise
+        finally:
+            loop.remove_signal_handler(signal.SIGTERM)
+            self.scheduler.cancel("state")
+
+            try:
+                if stopped:
+                    await self.shutdown()
+                else:
+                    self.save_state()
+            finally:
+                loop.remove_signal_handler(signal.SIGCHLD)
+
+                if self.watcher is not None:
+                    self.watcher.close()
+
+                for proc in self.processes.values():
+                    proc.close_sockets()
+
+                for _, proc in self.iter_services():
+                    proc.log.close()
+                    proc.close_zygotes()
+
+                    if proc.cgroup is not None:
+                        proc.cgroup.remove()
+
+                if stopped:
+                    if self.cgroups is not None:
+                        self.cgroups.close()
+
+                    remove_state(self.state_path)
+
+    async def serve(self, socket_path):
+        """
+        Answer clients on the control socket until the server is stopped, or
+        return once it has answered a server-reload.
+        """
+
+        self.reload_requested = asyncio.get_running_loop().create_future()
 
         with Socket(socket_path) as sock:
+            server = await asyncio.start_unix_server(
+                self.handle_connection,
+                sock=sock.socket,
+            )
 
-            inputs = [sock.socket]
-            outputs = []
-            messages_queue = {}
+            async with server:
+                await self.reload_requested
 
-            while inputs:
+    async def shutdown(self):
+        """
+        Stop every running service, in reverse dependency order, giving up
+        and killing whatever is left after `shutdown_timeout` seconds.
+        """
 
-                readable, writable, exceptional = select.select(
-                    inputs,
-                    outputs,
-                    inputs,
-                    timeout,
-                )
+        names = [
+            name
+            for name, proc in self.processes.items()
+            if proc.is_running()
+        ]
 
-                for s in readable:
-                    if s is sock.socket:
-                        connection, client_address = s.accept()
-                        logger.info(
-                            "[locald] new connection from {}"
-                            .format(client_address)
-                        )
+        if not names:
+            return
 
-                        connection.setblocking(0)
-                        inputs.append(connection)
-
-                        messages_queue[connection] = queue.Queue()
-                    else:
-                        data = s.recv(1024 * 1024)
-                        if data:
-                            logger.debug(
-                                "[locald] received '{}' from {}"
-                                .format(data, s.getpeername())
-                            )
-                            messages_queue[s].put(data)
-
-                            if s not in outputs:
-                                outputs.append(s)
-                        else:
-                            logger.info(
-                                "[locald] closing {} after reading no data"
-                                .format(s.getpeername())
-                            )
-
-                            if s in outputs:
-                                outputs.remove(s)
-
-                            inputs.remove(s)
-                            s.close()
-
-                            del messages_queue[s]
-
-                for s in writable:
-
-                    response = None
-
-                    try:
-                        next_message = messages_queue[s].get_nowait()
-                        response = self.process_message(next_message)
-                    except KeyError:
-                        logger.warning(
-                            "[locald] output queue for {} is missing"
-                            .format(s)
-                        )
-                    except queue.Empty:
-                        try:
-                            peer = s.getpeername()
-                        except OSError:
-                            peer = None
-
-                        logger.info(
-                            "[locald] output queue for {} is empty"
-                            .format(peer)
-                        )
-                        outputs.remove(s)
-                    else:
-                        logger.debug(
-                            "[locald] sending '{}' to {}"
-                            .format(response, s.getpeername())
-                        )
-                        s.send(response)
+        timeout = float(self.config["locald"].get("shutdown_timeout", "30"))
+
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+
+        logger.info(
+            "[locald] stopping {} services before exiting"
+            .format(len(names))
+        )
+
+        try:
+            await asyncio.wait_for(self.stop_services(names), timeout)
+        except asyncio.TimeoutError:
+            remaining = [n for n in names if self.processes[n].is_running()]
+
+            logger.warning(
+                "[locald] shutdown did not finish within {} seconds, killing {}"
+                .format(timeout, ", ".join(remaining))
+            )
+
+            for name in remaining:
+                self.processes[name].kill()
 
-                for s in exceptional:
-                    try:
-                        peer = s.getpeername()
-                    except OSError:
-                        peer = None
+        logger.info(
+            "[locald] stopped {} services in {:.2f} seconds"
+            .format(len(names), loop.time() - start_time)
+        )
+
+    async def handle_connection(self, reader, writer):
+
+        connection = Connection(writer)
+
+        logger.info(
+            "[locald] new connection from {}"
+            .format(connection.peer)
+        )
 
-                    logger.info(
-                        "[locald] handling exceptional condition for {}"
-                        .format(peer)
+        tasks = set()
+        streams = set()
+
+        try:
+            while True:
+                data = await reader.read(1024 * 1024)
+                if not data:
+                    break
+
+                try:
+                    messages = connection.decoder.feed(data)
+                except ProtocolError as ex:
+                    logger.warning(
+                        "[locald] {} from {}"
+                        .format(ex, connection.peer)
                     )
-                    inputs.remove(s)
-                    if s in outputs:
-                        outputs.remove(s)
-                    s.close()
+                    break
 
-                    del messages_queue[s]
+                for message in messages:
+                    logger.debug(
+                        "[locald] received '{}' from {}"
+                        .format(message, connection.peer)
+                    )
 
-                self.tend_processes()
+                    task = asyncio.ensure_future(
+                        self.respond(connection, message),
+                    )
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
 
-    def process_message(self, message):
+                    if is_stream(message):
+                        streams.add(task)
+                        task.add_done_callback(streams.discard)
+        except OSError:
+            pass
+        finally:
+            # streams only end when the client goes away
+            for task in streams:
+                task.cancel()
+
+            # the client may have only shut down its writing side, so finish
+            # answering what it already sent before hanging up
+            if tasks:
+                await asyncio.wait(tasks)
+
+            logger.info(
+                "[locald] closing {}"
+                .format(connection.peer)
+            )
+            writer.close()
 
-        message = message.decode("utf-8")
-        data = json.loads(message)
+    async def respond(self, connection, message):
 
-        if "command" in data:
+        request_id = None
+        if isinstance(message, dict):
+            request_id = message.get("id")
+
+        async def send(response):
+            await connection.send(request_id, response, more=True)
+
+        try:
+            response = await self.process_message(message, send)
+        except Exception as ex:
+            logger.error(
+                "[locald] command failed: {}"
+                .format(traceback.format_exc())
+            )
+            response = {
+                "messages": ["command failed: {}".format(ex)],
+            }
+
+        await connection.send(request_id, response)
+
+        # the server is only replaced once the client has been told
+        if is_server_reload(message) and response.get("reloading"):
+            set_result(self.reload_requested)
+
+    async def process_message(self, data, send=None):
+
+        if isinstance(data, dict) and "command" in data:
             command = data["command"]
 
             if command == "start":
-                response = self.handle_start(data)
+                response = await self.handle_start(data)
             elif command == "stop":
-                response = self.handle_stop(data)
+                response = await self.handle_stop(data)
             elif command == "restart":
-                response = self.handle_restart(data)
+                response = await self.handle_restart(data)
             elif command == "status":
-                response = self.handle_status(data)
+                response = await self.handle_status(data)
+            elif command == "reload":
+                response = await self.handle_reload(data)
+            elif command == "scale":
+                response = await self.handle_scale(data)
+            elif command == "server-reload":
+                response = await self.handle_server_reload(data)
+            elif command == "logs":
+                response = await self.handle_logs(data, send)
+            elif command == "top":
+                response = await self.handle_top(data, send)
             else:
-                response = self.handle_unknown(data)
+                response = await self.handle_unknown(data)
         else:
-            response = self.handle_unknown(data)
+            response = await self.handle_unknown(data)
 
-        response = json.dumps(response).encode("utf-8")
         return response
 
-    def handle_start(self, command):
+    def split_names(self, names, instances=False):
+        """
+        Expand a comma separated list of names (or ALL) from a command,
+        returning the known names and a message for each unknown one. With
+        `instances`, names of instances of services with replicas, such as
+        `web@2`, are known too.
+        """
 
-        name = command["name"]
+        known = []
+        messages = []
+
+        for name in expand_service_names(self.config, names):
+            if name in self.config:
+                known.append(name)
+            elif instances and "@" in name and self.get_process(name) is not None:
+                known.append(name)
+            else:
+                messages.append("unknown service '{}'".format(name))
+
+        return known, messages
+
+    def get_process(self, name):
+        """
+        The started service called `name`, which may be an instance of a
+        service with replicas, or None.
+        """
+
+        proc = self.processes.get(name)
+        if proc is not None:
+            return proc
+
+        service_name, number = split_instance_name(name)
+
+        proc = self.processes.get(service_name)
+        if not isinstance(proc, ReplicaSet) or number is None:
+            return None
+
+        return proc.get_instance(number)
+
+    def expand_instances(self, names):
+        """
+        `names`, each followed by the names of its instances if it is a
+        service with replicas.
+        """
+
+        expanded = []
+
+        for name in names:
+            expanded.append(name)
+
+            proc = self.processes.get(name)
+            if isinstance(proc, ReplicaSet):
+                expanded.extend(i.name for i in proc.instances)
+
+        return expanded
+
+    def iter_services(self, names=None):
+        """
+        Yield a (name, Service) pair for each started service in `names`
+        (default all of them), with the instances of a service with replicas
+        in place of the service itself.
+        """
+
+        if names is None:
+            names = list(self.processes)
+
+        for name in names:
+            proc = self.get_process(name)
+
+            if isinstance(proc, ReplicaSet):
+                for instance in proc.instances:
+                    yield instance.name, instance
+            elif proc is not None:
+                yield name, proc
+
+    async def handle_start(self, command):
+
+        names, messages = self.split_names(command["name"])
         dependencies_only = command.get("dependencies_only", False)
 
-        if name not in self.config:
+        if not names:
             return {
-                "messages": ["unknown service '{}'".format(name)],
+                "messages": messages,
+            }
+
+        try:
+            graph = self.prepare_start(names, dependencies_only)
+        except DependencyError as ex:
+            return {
+                "messages": messages + [str(ex)],
             }
 
-        messages, _ = self.start_service(name, dependencies_only)
+        response = await self.run_start(graph, names)
+        messages.extend(response["messages"])
 
         return {
             "messages": messages,
         }
 
-    def start_service(self, name, dependencies_only=False):
+    def prepare_start(self, names, dependencies_only=False):
+
+        graph, service_configs = resolve_dependencies(
+            self.config,
+            names,
+            self.service_configs.get,
+        )
+
+        if dependencies_only:
+            required = set()
+            for requires in graph.values():
+                required.update(requires)
+
+            for name in names:
+                if name not in required:
+                    del graph[name]
+
+        for service_name, service_config in service_configs.items():
+            if service_name not in graph:
+                continue
+
+            proc = self.processes.get(service_name)
+
+            # a definition that gained or lost replicas needs a new kind of
+            # service, once the old one has stopped
+            replaced = (
+                proc is not None
+                and isinstance(proc, ReplicaSet) != is_replicated(service_config)
+                and not proc.is_running()
+            )
+
+            if proc is not None and not replaced:
+                # pick up any changes to the definition for the next start
+                proc.config = service_config
+            else:
+                if replaced:
+                    proc.close_sockets()
+
+                if is_replicated(service_config):
+                    cls = ReplicaSet
+                else:
+                    cls = Service
+
+                self.processes[service_name] = cls(
+                    service_name,
+                    service_config,
+                    self.scheduler,
+                    self.cgroups,
+                )
+
+        return graph
+
+    async def run_start(self, graph, names, restarted=(), swapped=()):
+        """
+        Start everything in `graph`, reporting on each service. Services
+        that were already running are only mentioned if they are in `names`,
+        the ones asked for rather than their dependencies.
+        """
 
-        service_config = get_config_for_service(self.config, name)
+        async def start(service_name):
+            proc = self.processes[service_name]
 
-        requires = []
-        if "requires" in service_config["service"]:
-            requires = service_config["service"]["requires"]
-            requires = [r.strip() for r in requires.split(",") if r.strip()]
+            if service_name in swapped:
+                await proc.swap()
+                return True
 
-        for require in requires:
-            if require not in self.config:
-                return ["unknown required service '{}'".format(require)], True
+            was_running = proc.is_running()
+            proc.start()
+            self.watch_service(service_name)
+            await proc.wait_until_ready()
+
+            return not was_running
+
+        results = await run_in_dependency_order(
+            graph,
+            start,
+            self.get_max_parallel_starts(),
+        )
 
         messages = []
 
-        for require in requires:
-            sub_messages, is_error = self.start_service(require)
-            messages.extend(sub_messages)
-            if is_error:
-                return messages, True
+        for service_name, started, exception in results:
+            if exception is not None:
+                logger.error(
+                    "[locald] failed to start service {}: {}"
+                    .format(service_name, exception)
+                )
+                messages.append(
+                    "failed to start '{}': {}"
+                    .format(service_name, exception)
+                )
+            elif service_name in restarted:
+                messages.append("restarted '{}'".format(service_name))
+            elif started and self.processes[service_name].get_status() == "LISTENING":
+                messages.append(
+                    "listening on {} for '{}'"
+                    .format(self.processes[service_name].activation, service_name)
+                )
+            elif started:
+                messages.append("started '{}'".format(service_name))
+            elif service_name in names:
+                messages.append("'{}' is already running".format(service_name))
+
+        return {
+            "messages": messages,
+        }
+
+    def get_max_parallel_starts(self):
+        return int(self.config["locald"].get("max_parallel_starts", "8"))
+
+    async def handle_stop(self, command):
+
+        names, messages = self.split_names(command["name"], instances=True)
+
+        started = []
+        instances = []
+        for name in names:
+            if name not in self.config:
+                instances.append(name)
+            elif name in self.processes:
+                started.append(name)
+            else:
+                messages.append("'{}' is not running".format(name))
+
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+
+        # stopped by hand, so changes should not bring them back
+        for name in started:
+            self.unwatch_service(name)
+
+        results = await self.stop_services(started)
+        results.extend(await self.stop_instances(instances))
+
+        for name, graceful, exception in results:
+            if exception is not None:
+                messages.append(
+                    "failed to stop '{}': {}"
+                    .format(name, exception)
+                )
+            elif graceful:
+                messages.append("stopped '{}'".format(name))
+            else:
+                messages.append(
+                    "killed '{}' after it did not stop in time"
+                    .format(name)
+                )
+
+        if len(results) > 1:
+            messages.append(
+                "stopped {} services in {:.2f} seconds"
+                .format(len(results), loop.time() - start_time)
+            )
+
+        return {
+            "messages": messages,
+        }
+
+    def get_stop_graph(self, names):
+
+        graph = {
+            name: get_requires(self.processes[name].config)
+            for name in names
+        }
+
+        graph = get_reverse_graph(graph)
+
+        # a cycle could never have been started, so there is no meaningful
+        # order to stop it in
+        if find_cycle(graph) is not None:
+            graph = {name: [] for name in graph}
+
+        return graph
+
+    async def stop_services(self, names, close_sockets=True):
+        """
+        Stop the already started services in `names`, stopping dependents
+        before the services they require and anything independent
+        concurrently. Returns a (name, graceful, exception) tuple for each
+        service, see Service.stop. With `close_sockets` false, socket
+        activated services keep their sockets.
+        """
+
+        async def stop(service_name):
+            return await self.processes[service_name].stop(close_sockets)
+
+        graph = self.get_stop_graph(names)
+
+        results = await run_in_dependency_order(
+            graph,
+            stop,
+            max(len(graph), 1),
+            stop_on_error=False,
+        )
+
+        for service_name, _, exception in results:
+            if exception is not None:
+                logger.error(
+                    "[locald] failed to stop service {}: {}"
+                    .format(service_name, exception)
+                )
+
+        return results
+
+    async def stop_instances(self, names):
+        """
+        Stop the instances of services with replicas in `names`, returning a
+        (name, graceful, exception) tuple for each like stop_services.
+        """
+
+        async def stop(name):
+            service_name, number = split_instance_name(name)
+            return await self.processes[service_name].stop_instance(number)
 
-        if not dependencies_only:
+        results = await asyncio.gather(
+            *(stop(name) for name in names),
+            return_exceptions=True,
+        )
+
+        stopped = []
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    "[locald] failed to stop service {}: {}"
+                    .format(name, result)
+                )
+                stopped.append((name, None, result))
+            else:
+                stopped.append((name, result, None))
 
-            if name not in self.processes:
-                proc = Service(name, service_config)
-                self.processes[name] = proc
+        return stopped
 
-            self.processes[name].start()
+    async def handle_restart(self, command):
 
-            messages.append("started '{}'".format(name))
+        names, messages = self.split_names(command["name"], instances=True)
 
-        return messages, False
+        # single instances of services with replicas are restarted on their own
+        for name in [n for n in names if n not in self.config]:
+            names.remove(name)
+
+            service_name, number = split_instance_name(name)
+
+            try:
+                await self.processes[service_name].restart_instance(number)
+            except Exception as ex:
+                logger.error(
+                    "[locald] failed to restart service {}: {}"
+                    .format(name, ex)
+                )
+                messages.append("failed to restart '{}': {}".format(name, ex))
+            else:
+                messages.append("restarted '{}'".format(name))
 
-    def handle_stop(self, command):
+        if not names:
+            return {
+                "messages": messages,
+            }
+
+        try:
+            graph = self.prepare_start(names)
+        except DependencyError as ex:
+            return {
+                "messages": messages + [str(ex)],
+            }
+
+        restarted = [n for n in names if self.processes[n].is_running()]
+
+        # services behind their own proxy are swapped for a new run instead,
+        # once everything they require has been started
+        swapped = [n for n in restarted if self.processes[n].can_swap()]
+        stopped = [n for n in restarted if n not in swapped]
+
+        # socket activated services keep their sockets, so connections made
+        # while they restart wait instead of being refused
+        for name, _, exception in await self.stop_services(stopped, close_sockets=False):
+            if exception is not None:
+                messages.append(
+                    "failed to stop '{}': {}"
+                    .format(name, exception)
+                )
+
+        response = await self.run_start(graph, names, restarted, swapped)
+        messages.extend(response["messages"])
+
+        return {
+            "messages": messages,
+        }
+
+    async def handle_scale(self, command):
+        """
+        Change the number of instances of a service with replicas.
+        """
 
         name = command["name"]
 
@@ -271,62 +882,613 @@ class Server(object):
                 "messages": ["unknown service '{}'".format(name)],
             }
 
-        if name not in self.processes:
-            message = "'{}' is not running".format(name)
-        else:
-            self.processes[name].kill()
+        try:
+            count = parse_count(str(command.get("count")))
+        except ReplicaError as ex:
+            return {
+                "messages": [str(ex)],
+            }
+
+        service_config = self.service_configs.get(name)
+        if not is_replicated(service_config):
+            return {
+                "messages": ["'{}' does not set replicas".format(name)],
+            }
+
+        proc = self.processes.get(name)
+
+        if proc is None:
+            proc = self.processes[name] = ReplicaSet(
+                name,
+                service_config,
+                self.scheduler,
+                self.cgroups,
+            )
+        elif not isinstance(proc, ReplicaSet):
+            return {
+                "messages": [
+                    "'{}' must be restarted before it can be scaled"
+                    .format(name),
+                ],
+            }
 
-            message = "kill signal sent to '{}'".format(name)
+        try:
+            started, stopped = await proc.scale(count)
+        except Exception as ex:
+            logger.error(
+                "[locald] failed to scale service {}: {}"
+                .format(name, ex)
+            )
+            return {
+                "messages": ["failed to scale '{}': {}".format(name, ex)],
+            }
+
+        messages = ["scaled '{}' to {} instances".format(name, count)]
+        messages.extend("started '{}@{}'".format(name, n) for n in started)
+        messages.extend("stopped '{}@{}'".format(name, n) for n in stopped)
 
         return {
-            "messages": [message],
+            "messages": messages,
         }
 
-    def handle_restart(self, command):
+    async def handle_server_reload(self, command):
+        """
+        Replace the server with a new one without stopping any services,
+        once the response has been sent, see locald.state.
+        """
+
+        busy = set()
+
+        for name, proc in self.processes.items():
+            if isinstance(proc, ReplicaSet) and (proc.stopping or proc.draining):
+                busy.add(name)
+
+        for name, service in self.iter_services():
+            if (
+                service.stopping
+                or service.swapping
+                or service.draining
+                or service.forking is not None
+            ):
+                busy.add(name)
+
+        # a run being stopped or replaced would be left behind
+        if busy:
+            return {
+                "messages": [
+                    "not reloading the server while {} {} being stopped or "
+                    "restarted"
+                    .format(
+                        ", ".join("'{}'".format(n) for n in sorted(busy)),
+                        "is" if len(busy) == 1 else "are",
+                    ),
+                ],
+                "reloading": False,
+            }
 
-        name = command["name"]
+        # a new server that fails to start would leave the services without
+        # one, so whatever would stop it is caught here
+        error = await check_server(self.config["locald"]["config_path"])
+        if error is not None:
+            return {
+                "messages": [
+                    "not reloading the server, a new one would not start: {}"
+                    .format(error),
+                ],
+                "reloading": False,
+            }
 
-        if name not in self.processes:
-            return self.handle_start(command)
-        else:
-            self.processes[name].restart()
+        logger.info("[locald] reloading the server")
 
-            message = "restarted '{}'".format(name)
+        self.reloading = True
 
         return {
-            "messages": [message],
+            "messages": ["reloading the server"],
+            "reloading": True,
         }
 
     def get_service_status(self, name):
 
-        if name not in self.config:
+        proc = self.get_process(name)
+
+        if name not in self.config and proc is None:
             status = "UNKNOWN_SERVICE"
-        elif name in self.processes:
-            if self.processes[name].is_running():
-                status = "RUNNING"
-            else:
-                status = "STOPPED"
+        elif proc is not None:
+            status = proc.get_status()
         else:
             status = "NOT_STARTED"
 
         return status
 
-    def handle_status(self, command):
-
-        name = command["name"]
+    def get_service_details(self, name, samples):
+
+        details = {
+            "status": self.get_service_status(name),
+            "restarts": 0,
+            "next_restart": None,
+            "uptime": None,
+            "exit_code": None,
+            "memory_restarts": 0,
+            "rss_alerts": 0,
+            "rss_growth": None,
+        }
 
-        if name == "ALL":
-            names = get_service_configs(self.config).keys()
+        proc = self.get_process(name)
+
+        if proc is not None:
+            details["restarts"] = proc.restart_count
+            details["next_restart"] = proc.get_next_restart()
+            details["uptime"] = proc.get_uptime()
+            details["exit_code"] = proc.last_returncode
+            details["memory_restarts"] = proc.memory_restarts
+            details["rss_alerts"] = proc.rss_alerts
+            details["rss_growth"] = proc.rss_growth
+
+        if isinstance(proc, ReplicaSet):
+            details.update(combine_samples(
+                get_current_sample(i.name, i, samples) for i in proc.instances
+            ))
         else:
-            names = [name]
+            details.update(get_current_sample(name, proc, samples))
+
+        return details
+
+    async def get_samples(self):
+        """
+        Resource usage of every running service, sampled in one pass. The
+        result is reused for `status_cache_ttl` seconds (default 1), and
+        callers asking while a sample is being taken share it.
+        """
+
+        loop = asyncio.get_running_loop()
+        ttl = float(self.config["locald"].get("status_cache_ttl", "1"))
+
+        # a service started since the last sample makes it stale regardless
+        fresh = (
+            self.samples_at is not None
+            and loop.time() - self.samples_at < ttl
+            and all(
+                name in self.samples
+                and self.samples[name]["pid"] == proc.process.pid
+                for name, proc in self.iter_services()
+                if proc.is_running()
+            )
+        )
+
+        if fresh:
+            return self.samples
+
+        if self.sampling is None:
+            self.sampling = asyncio.ensure_future(self.take_samples())
+
+        return await asyncio.shield(self.sampling)
+
+    async def take_samples(self):
+
+        pids = {}
+        cgroups = {}
+        for name, proc in self.iter_services():
+            if proc.is_running():
+                pids[name] = proc.process.pid
 
-        status = {name: self.get_service_status(name) for name in names}
+                if proc.cgroup is not None:
+                    cgroups[name] = proc.cgroup
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            self.samples = await loop.run_in_executor(
+                None,
+                self.sampler.sample,
+                pids,
+                cgroups,
+            )
+            self.samples_at = loop.time()
+        finally:
+            self.sampling = None
+
+        return self.samples
+
+    async def handle_status(self, command):
+
+        names = self.expand_instances(
+            expand_service_names(self.config, command["name"]),
+        )
+
+        if command.get("details"):
+            samples = await self.get_samples()
+            status = {
+                name: self.get_service_details(name, samples)
+                for name in names
+            }
+        else:
+            status = {name: self.get_service_status(name) for name in names}
 
         return status
 
-    def handle_unknown(self, command):
+    async def handle_reload(self, command):
+
+        try:
+            changed = self.service_configs.reload()
+        except Exception as ex:
+            return {
+                "messages": ["failed to reload service definitions: {}".format(ex)],
+                "changed": [],
+            }
+
+        for name in changed:
+            if name in self.processes:
+                self.processes[name].config = self.service_configs.get(name)
+
+        if changed:
+            messages = [
+                "definition changed for '{}'".format(name)
+                for name in changed
+            ]
+        else:
+            messages = ["no service definitions changed"]
+
+        return {
+            "messages": messages,
+            "changed": changed,
+        }
+
+    async def handle_logs(self, command, send):
+        """
+        Send the lines of each service in `name` captured between `since` and
+        `until` and matching `grep`, or only the last `lines` of them, merged
+        by time. Queries are answered from the log files of services with a
+        `log_path`, and from the in-memory buffers otherwise. With `follow`,
+        the history is sent as partial responses and new lines are then
+        streamed as they arrive, until the client disconnects.
+        """
+
+        requested, messages = self.split_names(command["name"], instances=True)
+        count = command.get("lines")
+
+        try:
+            query = LogQuery(
+                since=command.get("since"),
+                until=command.get("until"),
+                pattern=command.get("grep"),
+            )
+        except re.error as ex:
+            return {
+                "messages": messages + ["invalid pattern: {}".format(ex)],
+                "lines": [],
+            }
+
+        follow = bool(command.get("follow")) and query.until is None
+
+        names = []
+        logs = []
+        for name in requested:
+            proc = self.get_process(name)
+
+            if proc is not None:
+                for service_name, service in self.iter_services([name]):
+                    names.append(service_name)
+                    logs.append(service.log)
+            elif self.get_log_path(name):
+                names.append(name)
+                logs.append(None)
+            else:
+                messages.append("'{}' has not been started".format(name))
+
+        follow = follow and any(log is not None for log in logs)
+
+        # subscribe before taking the history, so that nothing captured
+        # while it is being read is missed or sent twice
+        subscription = Subscription()
+        if follow:
+            for log in logs:
+                if log is not None:
+                    log.subscribe(subscription)
+
+        try:
+            sources = []
+            for name, log in zip(names, logs):
+                sources.append(self.get_log_source(name, log, query, count))
+
+            lines = heapq.merge(*sources, key=lambda line: line[0])
+
+            loop = asyncio.get_running_loop()
+
+            if count is not None:
+                lines = iter(await loop.run_in_executor(
+                    None,
+                    collections.deque,
+                    lines,
+                    count,
+                ))
+
+            while True:
+                chunk = await loop.run_in_executor(
+                    None,
+                    list,
+                    itertools.islice(lines, LOG_CHUNK_LINES),
+                )
+
+                response = {
+                    "messages": messages,
+                    "lines": format_lines(chunk),
+                    "names": names,
+                }
+                messages = []
+
+                if len(chunk) < LOG_CHUNK_LINES and not follow:
+                    return response
+
+                await send(response)
+
+                if len(chunk) < LOG_CHUNK_LINES:
+                    break
+
+            while True:
+                lines, dropped = await subscription.get()
+
+                lines = [line for line in lines if query.matches(line)]
+                if not lines and not dropped:
+                    continue
+
+                await send({
+                    "messages": [],
+                    "lines": format_lines(lines),
+                    "dropped": dropped,
+                })
+        finally:
+            for log in logs:
+                if log is not None:
+                    log.unsubscribe(subscription)
+
+    def get_log_path(self, name):
+        return self.service_configs.get(name)["service"].get("log_path")
+
+    def get_log_source(self, name, log, query, count=None):
+        """
+        The lines of one service matching `query`, oldest first. Sources are
+        iterated lazily and merged by time, so only a bounded number of lines
+        is ever held at once. `count` is a hint that only the last that many
+        lines are wanted.
+        """
+
+        if log is None:
+            return search_log(self.get_log_path(name), name, query)
+
+        if query.is_empty():
+            return log.get_lines(count)
+
+        if not log.log_path:
+            return [line for line in log.get_lines() if query.matches(line)]
+
+        # only read as far as what has been captured so far, anything after
+        # that reaches a follower through its subscription
+        log.flush()
+        end = log.log_size if log.log_fp is not None else None
+
+        return search_log(log.log_path, name, query, end)
+
+    def schedule_metrics(self):
+
+        interval = self.get_metrics_interval()
+        if interval <= 0:
+            return
+
+        self.scheduler.call_later(
+            interval,
+            self.sample_metrics,
+            key="metrics",
+        )
+
+    def get_metrics_interval(self):
+        return float(self.config["locald"].get("metrics_interval", "3"))
+
+    def sample_metrics(self):
+        asyncio.ensure_future(self.record_metrics())
+
+    async def record_metrics(self):
+        """
+        Take a sample of every running service for its metrics history, then
+        wake anyone waiting on the next one.
+        """
+
+        size = int(self.config["locald"].get("metrics_history", "120"))
+
+        try:
+            samples = await self.get_samples()
+
+            for name, sample in samples.items():
+                history = self.metrics.get(name)
+                if history is None or history.size != size:
+                    history = self.metrics[name] = MetricsHistory(size)
+
+                # a sample taken for status may already have been recorded
+                latest = history.get_latest()
+                if latest is None or latest["time"] != sample["time"]:
+                    history.append(sample)
+
+                    proc = self.get_process(name)
+                    if proc is not None and not proc.check_memory(history):
+                        service_name, _ = split_instance_name(name)
+                        proc.check_idle(
+                            history,
+                            required=bool(self.get_running_dependents(service_name)),
+                        )
+
+            # the history of a run is no use once it is over, and services
+            # and instances come and go
+            for name in list(self.metrics):
+                proc = self.get_process(name)
+                if proc is None or not proc.is_running():
+                    del self.metrics[name]
+        except Exception:
+            logger.error(
+                "[locald] sampling metrics failed: {}"
+                .format(traceback.format_exc())
+            )
+        finally:
+            if self.metrics_updated is not None:
+                set_result(self.metrics_updated)
+                self.metrics_updated = None
+
+            self.schedule_metrics()
+
+    async def wait_for_metrics(self):
+
+        if self.metrics_updated is None:
+            loop = asyncio.get_running_loop()
+            self.metrics_updated = loop.create_future()
+
+        # shared by every waiter, so one of them going away must not cancel
+        # it for the rest
+        await asyncio.shield(self.metrics_updated)
+
+    def get_top(self, names, count):
+        """
+        The latest resource usage and the last `count` samples of CPU and
+        memory usage of each running service in `names`.
+        """
+
+        top = {}
+
+        for name, proc in self.iter_services(names):
+            if not proc.is_running():
+                continue
+
+            history = self.metrics.get(name)
+            latest = history.get_latest() if history is not None else None
+
+            if latest is None or latest["pid"] != proc.process.pid:
+                entry = dict(EMPTY_SAMPLE, read_rate=None, write_rate=None)
+                entry["pid"] = proc.process.pid
+                entry["cpu_history"] = []
+                entry["rss_history"] = []
+            else:
+                entry = dict(latest)
+                entry["cpu_history"] = history.get("cpu_percent", count)
+                entry["rss_history"] = history.get("rss", count)
+
+            entry["status"] = proc.get_status()
+            entry["uptime"] = proc.get_uptime()
+
+            top[name] = entry
+
+        return top
+
+    async def handle_top(self, command, send):
+        """
+        Send resource usage for the services in `name`, and with `follow`
+        send it again after each time the services are sampled, until the
+        client disconnects.
+        """
+
+        names = expand_service_names(self.config, command.get("name", "ALL"))
+        count = command.get("history", 30)
+        interval = self.get_metrics_interval()
+
+        while True:
+            response = {
+                "interval": interval,
+                "services": self.get_top(names, count),
+            }
+
+            if not command.get("follow"):
+                return response
+
+            await send(response)
+
+            if interval > 0:
+                await self.wait_for_metrics()
+            else:
+                # nothing is sampled in the background, so sample on demand
+                await self.scheduler.sleep(2)
+                await self.record_metrics()
+
+    def watch_service(self, name):
+
+        spec = WatchSpec.create(self.processes[name].config, os.getcwd())
+
+        if self.watcher is None:
+            if spec is not None:
+                logger.warning(
+                    "[locald] file watching is not available, not watching "
+                    "files for service {}"
+                    .format(name)
+                )
+            return
+
+        if spec is None:
+            self.watcher.unwatch(name)
+        else:
+            asyncio.ensure_future(self.watcher.watch(name, spec))
+
+    def unwatch_service(self, name):
+        if self.watcher is not None:
+            self.watcher.unwatch(name)
+
+    def files_changed(self, names):
+        asyncio.ensure_future(self.restart_changed(names))
+
+    async def restart_changed(self, names):
+        """
+        Restart the services in `names` after their watched files changed,
+        along with the running services that require them for those that set
+        `watch_dependents`. One batch of restarts is done at a time.
+        """
+
+        async with self.watch_lock:
+            restart = set()
+            for name in names:
+                # may have been stopped in the meantime, and a service stopped
+                # for being idle should stay that way until it is needed
+                spec = self.watcher.specs.get(name)
+                if spec is None or self.processes[name].idle:
+                    continue
+
+                restart.add(name)
+                if spec.dependents:
+                    restart.update(self.get_running_dependents(name))
+
+            if not restart:
+                return
+
+            logger.info(
+                "[locald] files changed, restarting {}"
+                .format(", ".join(sorted(restart)))
+            )
+
+            response = await self.handle_restart({"name": ",".join(sorted(restart))})
+
+            for message in response["messages"]:
+                logger.info("[locald] {}".format(message))
 
-        if "command" in command:
+    def get_running_dependents(self, name):
+        """
+        The running services that require `name`, directly or not.
+        """
+
+        graph = get_reverse_graph({
+            n: get_requires(proc.config)
+            for n, proc in self.processes.items()
+        })
+
+        dependents = set()
+
+        pending = [name]
+        while pending:
+            for dependent in graph.get(pending.pop(), []):
+                if dependent in dependents:
+                    continue
+
+                if self.processes[dependent].is_running():
+                    dependents.add(dependent)
+                    pending.append(dependent)
+
+        return dependents
+
+    async def handle_unknown(self, command):
+
+        if isinstance(command, dict) and "command" in command:
             message = "unknown command '{}'".format(command["command"])
         else:
             message = "invalid command '{}' received from client".format(command)
@@ -336,9 +1498,410 @@ class Server(object):
         }
 
     def tend_processes(self):
-        for proc in self.processes.values():
+        for proc in list(self.processes.values()):
             proc.tend()
 
+        if self.strays:
+            self.strays = reap(self.strays)
+
+    def adopt_services(self):
+        """
+        Take over the services a previous server left behind in the state
+        file, see locald.state.
+        """
+
+        state = read_state(self.state_path)
+        if state is None:
+            return
+
+        # only a server that re-executed itself hands over file descriptors,
+        # and it keeps its pid doing so
+        handoff = state.get("pid") == os.getpid()
+
+        if handoff:
+            for address, fd in state.get("sockets", {}).items():
+                inherit_socket(address, fd)
+
+            self.strays = set(state.get("strays", []))
+
+        for name, entry in state.get("services", {}).items():
+            try:
+                self.adopt_service(name, entry, handoff)
+            except Exception:
+                logger.error(
+                    "[locald] unable to take over service {}: {}"
+                    .format(name, traceback.format_exc())
+                )
+
+        for name, count in state.get("replicas", {}).items():
+            proc = self.processes.get(name)
+            if isinstance(proc, ReplicaSet):
+                proc.count = count
+
+        for name in self.processes:
+            self.watch_service(name)
+
+        close_inherited_sockets()
+
+        # any that exited during the reload did so without a SIGCHLD
+        self.strays = reap(self.strays)
+
+    def adopt_service(self, name, entry, handoff=False):
+
+        service_name, number = split_instance_name(name)
+
+        if service_name not in self.config:
+            if "pid" in entry:
+                logger.warning(
+                    "[locald] service {} is no longer defined, leaving pid {} "
+                    "running"
+                    .format(name, entry["pid"])
+                )
+            return
+
+        proc = self.processes.get(service_name)
+
+        if proc is None:
+            if number is not None:
+                cls = ReplicaSet
+            else:
+                cls = Service
+
+            proc = self.processes[service_name] = cls(
+                service_name,
+                self.service_configs.get(service_name),
+                self.scheduler,
+                self.cgroups,
+            )
+
+        if isinstance(proc, ReplicaSet):
+            service = proc.adopt_instance(number, entry.get("instance_port"))
+        else:
+            service = proc
+
+        service.restart_count = entry.get("restart_count", 0)
+
+        if handoff:
+            service.log.restore(
+                (timestamp, line.encode("latin-1"))
+                for timestamp, line in entry.get("lines", [])
+            )
+
+        stdout = None
+        if handoff and "stdout" in entry:
+            stdout = open(entry["stdout"], "rb")
+        elif "pid" in entry and entry.get("output") is not None:
+            stdout = reopen_output(entry["pid"], entry["output"])
+
+        process = None
+        if "pid" in entry:
+            process = AdoptedProcess.open(
+                entry["pid"],
+                entry["create_time"],
+                stdout,
+                on_exit=service.tend,
+            )
+
+        if process is not None:
+            cgroup = None
+            if entry.get("cgroup") and os.path.isdir(entry["cgroup"]):
+                cgroup = Cgroup(entry["cgroup"])
+
+            service.adopt(
+                process,
+                cgroup,
+                entry.get("port"),
+                entry.get("ready", True),
+                entry.get("config_hash"),
+            )
+            return
+
+        if stdout is not None:
+            stdout.close()
+
+        exited = "pid" in entry
+
+        # still a child if it exited during a reload
+        if exited and handoff:
+            self.strays.add(entry["pid"])
+        if exited:
+            logger.info(
+                "[locald] service {} pid {} exited while no server was running"
+                .format(name, entry["pid"])
+            )
+
+        if entry.get("start") or (exited and RestartPolicy(service.config).always):
+            service.start()
+
+    def schedule_state(self):
+        self.scheduler.call_later(
+            STATE_INTERVAL,
+            self.save_state,
+            key="state",
+        )
+
+    def save_state(self):
+        """
+        Write the state file if anything it records has changed.
+        """
+
+        try:
+            state = self.get_state()
+
+            if state != self.saved_state:
+                write_state(self.state_path, state)
+                self.saved_state = state
+        except Exception:
+            logger.error(
+                "[locald] writing the state file failed: {}"
+                .format(traceback.format_exc())
+            )
+        finally:
+            self.schedule_state()
+
+    def get_state(self, handoff=False):
+        """
+        What the next server needs to take over the services, see
+        locald.state. With `handoff`, for a new server in this process, it
+        also gets the file descriptors to carry on with.
+        """
+
+        services = {}
+        for name, service in self.iter_services():
+            entry = service.get_state(handoff)
+            if entry is not None:
+                services[name] = entry
+
+        state = {
+            "services": services,
+            "replicas": {
+                name: proc.count
+                for name, proc in self.processes.items()
+                if isinstance(proc, ReplicaSet) and proc.count is not None
+            },
+        }
+
+        if not handoff:
+            return state
+
+        sockets = {}
+        for proc in self.processes.values():
+            if proc.activation is not None:
+                for address, sock in zip(proc.activation.addresses, proc.activation.sockets):
+                    sockets[format_address(address)] = sock.fileno()
+
+            if proc.proxy is not None:
+                for sock in proc.proxy.sockets:
+                    sockets[format_address(proc.proxy.address)] = sock.fileno()
+
+        # left to be reaped by the new server, such as zygotes
+        pids = set(entry["pid"] for entry in services.values() if "pid" in entry)
+        strays = [p.pid for p in psutil.Process().children() if p.pid not in pids]
+
+        state.update({
+            "pid": os.getpid(),
+            "sockets": sockets,
+            "strays": strays,
+        })
+
+        return state
+
+    async def finish_connections(self):
+        """
+        Stop accepting connections for services, leaving new ones to wait for
+        the next server, and give those already being passed on to them up
+        to `reload_timeout` seconds (default 10) to finish.
+        """
+
+        for proc in self.processes.values():
+            if proc.activation is not None:
+                proc.activation.pause()
+
+            if proc.proxy is not None:
+                proc.proxy.pause()
+
+        timeout = float(self.config["locald"].get("reload_timeout", "10"))
+        deadline = self.scheduler.time() + timeout
+
+        while self.scheduler.time() < deadline and any(
+            service.connections for _, service in self.iter_services()
+        ):
+            await self.scheduler.sleep(0.05)
+
+    def hand_over(self):
+        """
+        Re-execute the server in place, handing the services over to the new
+        one. Only returns if that fails.
+        """
+
+        try:
+            state = self.get_state(handoff=True)
+            write_state(self.state_path, state)
+        except Exception:
+            logger.error(
+                "[locald] unable to hand services over to a new server: {}"
+                .format(traceback.format_exc())
+            )
+            return
+
+        fds = list(state["sockets"].values())
+        fds.extend(
+            entry["stdout"]
+            for entry in state["services"].values()
+            if "stdout" in entry
+        )
+
+        for fd in fds:
+            os.set_inheritable(fd, True)
+
+        for _, service in self.iter_services():
+            service.log.close_log_file()
+
+        logger.info(
+            "[locald] handing {} services over to a new server"
+            .format(len(state["services"]))
+        )
+
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+
+        try:
+            os.execv(sys.executable, [
+                sys.executable,
+                "-c",
+                RESUME_SCRIPT,
+                self.config["locald"]["config_path"],
+            ])
+        except OSError as ex:
+            logger.error(
+                "[locald] unable to start a new server: {}"
+                .format(ex)
+            )
+
+            for fd in fds:
+                os.set_inheritable(fd, False)
+
+    def carry_on(self):
+        """
+        Go back to serving after hand_over failed.
+        """
+
+        logger.warning("[locald] the server was not reloaded, carrying on")
+
+        self.reloading = False
+
+        # the state file now holds what was meant for the new server
+        self.saved_state = None
+        self.schedule_state()
+
+        for proc in self.processes.values():
+            if proc.proxy is not None:
+                proc.proxy.resume()
+
+            activation = proc.activation
+            if activation is not None and (
+                activation.target is not None or proc.process is None
+            ):
+                proc.wait_for_connection()
+
+
+async def check_server(config_path):
+    """
+    Load the configuration and create a server in a new interpreter, the
+    way resume_server does. Returns the error if that fails, or None.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    def run():
+        return subprocess.run(
+            [sys.executable, "-c", CHECK_SCRIPT, config_path],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+    try:
+        result = await loop.run_in_executor(None, run)
+    except OSError as ex:
+        return str(ex)
+
+    if not result.returncode:
+        return None
+
+    error = " ".join(result.stderr.decode("utf-8", "replace").split())
+
+    return error or "exit code {}".format(result.returncode)
+
+
+def is_server_reload(message):
+    return isinstance(message, dict) and message.get("command") == "server-reload"
+
+
+def is_stream(message):
+    return (
+        isinstance(message, dict)
+        and message.get("command") in ("logs", "top")
+        and bool(message.get("follow"))
+    )
+
+
+def format_lines(lines):
+    return [
+        [timestamp, name, line.decode("utf-8", "replace")]
+        for timestamp, name, line in lines
+    ]
+
+
+def split_instance_name(name):
+    """
+    The service name and instance number of an instance name such as
+    "web@2", or the name itself and None for anything else.
+    """
+
+    service_name, sep, number = name.rpartition("@")
+
+    if not sep or not number.isdigit():
+        return name, None
+
+    return service_name, int(number)
+
+
+def get_current_sample(name, proc, samples):
+    """
+    The sample in `samples` of the run `proc` is on now, or EMPTY_SAMPLE if
+    it is not running or the sample was taken of an earlier run.
+    """
+
+    sample = samples.get(name)
+
+    if (
+        sample is None
+        or proc is None
+        or not proc.is_running()
+        or sample["pid"] != proc.process.pid
+    ):
+        return EMPTY_SAMPLE
+
+    return sample
+
+
+def combine_samples(samples):
+    """
+    The resource usage of several instances of a service added together.
+    """
+
+    combined = dict(EMPTY_SAMPLE)
+
+    for sample in samples:
+        for key, value in sample.items():
+            if key in ("pid", "time") or value is None:
+                continue
+
+            combined[key] = (combined.get(key) or 0) + value
+
+    return combined
+
 
 def get_pid(pid_path):
 
@@ -386,27 +1949,44 @@ def create_daemon(config, server):
     return daemon
 
 
+def run_server(config, server):
+
+    pid_path = config["locald"]["pid_path"]
+    try:
+        with open(pid_path, "wt") as pid_fp:
+            pid_fp.write(str(os.getpid()))
+            pid_fp.flush()
+            server.start()
+    finally:
+        try:
+            os.unlink(pid_path)
+        except:
+            pass
+
+
 def ensure_server(config, args):
     if not is_server_running(config):
         server = create_server(config)
 
         if args.no_daemonize:
-            pid_path = config["locald"]["pid_path"]
-            try:
-                with open(pid_path, "wt") as pid_fp:
-                    pid_fp.write(str(os.getpid()))
-                    pid_fp.flush()
-                    server.start()
-            finally:
-                try:
-                    os.unlink(pid_path)
-                except:
-                    pass
+            run_server(config, server)
         else:
             daemon = create_daemon(config, server)
             daemon.start()
 
 
+def resume_server(config_path):
+    """
+    Run the server, in the foreground, in place of one that re-executed
+    itself to hand its services over, see locald.state.
+    """
+
+    config = get_config(config_path)
+    server = create_server(config)
+
+    run_server(config, server)
+
+
 def stop_server(config):
 
     if not os.path.exists(config["locald"]["pid_path"]):
@@ -1,25 +1,130 @@
+import asyncio
+import collections
 import datetime
+import functools
 import logging
+import os
+import random
 import shlex
 import signal
 import subprocess
+import time
+import traceback
 
 import psutil
 
+from .activation import SocketActivation, get_activation_args
+from .cgroups import (
+    ResourceLimits,
+    apply_limits,
+    get_cgroup_args,
+    prepare_cgroup,
+    spawn,
+)
+from .logs import RotationPolicy, ServiceLog
+from .preload import (
+    PreloadError,
+    PythonCommand,
+    Zygote,
+    check_platform,
+    get_preload_modules,
+)
+from .probes import TCPProbe, get_probes, wait_until_ready
+from .proxy import ServiceProxy, connect, format_address, relay
+from .state import (
+    create_output_pipe,
+    get_config_hash,
+    get_create_time,
+    get_output_inode,
+)
+from .watchdog import MemoryPolicy, format_rate, get_growth_rate
+
 
 logger = logging.getLogger()
 
 
+# zygotes kept per service, one for each of the two environments a service
+# with proxy_backend_ports alternates between
+MAX_ZYGOTES = 2
+
+# what restarts back off from when restart_seconds is not set, so that a
+# service that keeps crashing is still slowed down
+BACKOFF_SECONDS = 1
+
+
 class Service(object):
 
-    def __init__(self, name, config):
+    def __init__(self, name, config, scheduler, cgroups=None):
         self.name = name
         self.config = config
+        self.scheduler = scheduler
+        self.cgroups = cgroups
+        self.cgroup = None
+        self.log = ServiceLog(
+            name,
+            scheduler,
+            max_lines=int(config["service"].get("log_buffer_lines", "1000")),
+        )
         self.process = None
         self.dead_since = None
         self.was_killed = False
+        self.exited = None
+        self.ready = None
+        self.stopping = False
+        self.started_at = None
+        self.last_returncode = None
+        self.restart_policy = None
+        self.restart_count = 0
+        self.recent_restarts = collections.deque()
+        self.backoff_step = 0
+        self.crashloop = False
+        self.memory_policy = None
+        self.memory_restarts = 0
+        self.rss_alerts = 0
+        self.rss_growth = None
+        self.activation = None
+        self.idle_policy = None
+        self.idle = False
+        self.last_activity = None
+        self.activity_seq = 0
+        self.connections = 0
+        self.proxy = None
+        self.port = None
+        self.backend_port = None
+        self.backend_connections = collections.Counter()
+        self.draining = []
+        self.swapping = False
+        self.instance = None
+        self.instance_port = None
+        self.environment = {}
+        self.zygotes = []
+        self.forking = None
+        self.config_hash = None
 
     def tend(self):
+        """
+        Clean up after the process if it has exited, and schedule a restart
+        if the policy calls for one. Called by the server whenever it receives
+        SIGCHLD.
+        """
+
+        for run in list(self.draining):
+            returncode = run.process.poll()
+            if returncode is None:
+                continue
+
+            logger.info(
+                "[locald] replaced run of service {} pid {} exited with {}"
+                .format(self.name, run.process.pid, returncode)
+            )
+
+            self.draining.remove(run)
+
+            if run.cgroup is not None:
+                run.cgroup.remove()
+
+            set_result(run.exited, returncode)
+
         returncode = self.get_returncode()
         if returncode is not None:
             logger.info(
@@ -27,68 +132,804 @@ class Service(object):
                 .format(self.name, self.process.pid, returncode)
             )
 
-            if self.process is not None:
+            # the output pipe is left to the log, which closes it once
+            # everything has been read from it
+            self.process = None
+            self.last_returncode = returncode
 
-                file_handles = [
-                    self.process.stdout,
-                    self.process.stderr,
-                ]
+            if self.backend_port == self.port:
+                self.backend_port = None
 
-                for file_handle in file_handles:
-                    if hasattr(file_handle, "close"):
-                        try:
-                            file_handle.close()
-                        except:
-                            pass
+            # only goes away once nothing the service spawned is left in it
+            if self.cgroup is not None:
+                self.cgroup.remove()
 
-            self.process = None
-            if not self.was_killed:
+            # a new run that fails during a swap is dealt with by swap
+            if not self.was_killed and not self.swapping:
                 self.dead_since = datetime.datetime.now()
-        else:
-            if self.dead_since:
-                restart = self.config["service"].get("restart", "never")
-                if restart == "always":
-
-                    restart_seconds = int(self.config["service"].get("restart_seconds", "0"))
+                self.schedule_restart()
 
-                    restart_time = (
-                        self.dead_since
-                        + datetime.timedelta(seconds=restart_seconds)
-                    )
+                # with nothing about to restart it, the next connection will
+                if (
+                    self.activation is not None
+                    and not self.crashloop
+                    and self.get_next_restart() is None
+                ):
+                    self.wait_for_connection()
 
-                    if datetime.datetime.now() >= restart_time:
-                        self.start()
+            if not self.exited.done():
+                self.exited.set_result(returncode)
 
         return returncode
 
+    def schedule_restart(self):
+        """
+        Apply the restart policy after the service exited on its own.
+        """
+
+        policy = self.restart_policy
+        if not policy.always:
+            return
+
+        now = time.monotonic()
+
+        # a run that stayed up long enough wipes the slate clean
+        if now - self.started_at >= policy.reset_seconds:
+            self.backoff_step = 0
+
+        while self.recent_restarts and now - self.recent_restarts[0] > policy.window:
+            self.recent_restarts.popleft()
+
+        if policy.limit and len(self.recent_restarts) >= policy.limit:
+            logger.warning(
+                "[locald] service {} restarted {} times within {} seconds, "
+                "not restarting it again until it is started manually"
+                .format(self.name, len(self.recent_restarts), policy.window)
+            )
+            self.crashloop = True
+            return
+
+        delay = policy.get_delay(self.backoff_step)
+
+        logger.info(
+            "[locald] restarting service {} in {:.2f} seconds"
+            .format(self.name, delay)
+        )
+
+        self.scheduler.call_later(
+            delay,
+            self.restart_after_exit,
+            key=(self.name, "restart"),
+        )
+
+    def restart_after_exit(self):
+        if self.process is not None or self.forking is not None:
+            return
+
+        self.recent_restarts.append(time.monotonic())
+        self.restart_count += 1
+        self.backoff_step += 1
+        self.spawn()
+
+    def get_next_restart(self):
+        return self.scheduler.when((self.name, "restart"))
+
     def start(self):
-        if self.process is not None:
+        if self.process is not None or self.forking is not None:
             logger.info(
                 "[locald] service {} is already running, not starting"
                 .format(self.name)
             )
             return
 
+        # starting by hand gets a service out of a crash loop
+        self.crashloop = False
+        self.idle = False
+        self.backoff_step = 0
+        self.recent_restarts.clear()
+
+        if self.listen():
+            return
+
+        self.open_proxy()
+        self.spawn()
+
+    def listen(self):
+        """
+        Bind the service's `listen` sockets, if it has any, and leave spawning
+        it to the first connection. Returns False if the service is not
+        socket activated.
+        """
+
+        activation = SocketActivation.create(self.name, self.config)
+
+        if activation is None:
+            if self.activation is not None:
+                self.close_sockets()
+            return False
+
+        if self.config["service"].get("proxy_port"):
+            raise ValueError(
+                "'{}' cannot set both listen and proxy_port"
+                .format(self.name)
+            )
+
+        if not activation.matches(self.activation):
+            self.close_sockets()
+            activation.open()
+            self.activation = activation
+
+        # the socket accepts connections, which is as ready as it gets
+        # until one arrives
+        loop = asyncio.get_running_loop()
+        self.ready = loop.create_future()
+        self.ready.set_result(None)
+
+        self.wait_for_connection()
+
+        return True
+
+    def wait_for_connection(self):
+
+        if self.activation.target is None:
+            self.activation.arm(self.activate)
+        else:
+            self.activation.serve(self.handle_connection)
+
+    def open_proxy(self):
+        """
+        Bind the service's `proxy_port`, if it has one.
+        """
+
+        proxy = ServiceProxy.create(self.name, self.config)
+
+        if proxy is None:
+            if self.proxy is not None:
+                self.close_sockets()
+            return
+
+        if not proxy.matches(self.proxy):
+            self.close_sockets()
+            proxy.open(self.handle_connection)
+            self.proxy = proxy
+
+    def activate(self):
+
+        if self.process is not None or self.forking is not None:
+            return
+
+        logger.info(
+            "[locald] connection for service {}, starting it"
+            .format(self.name)
+        )
+
+        self.spawn()
+
+    async def handle_connection(self, client):
+        """
+        Pass a connection on to the service: to its `listen_target`,
+        starting it first if need be, or with `proxy_port` to whichever run
+        new connections currently go to.
+        """
+
+        self.connections += 1
+        self.last_activity = time.monotonic()
+
+        port = None
+
+        try:
+            # a restart in progress, wait for the new run
+            if self.stopping and self.backend_port is None:
+                await self.wait()
+
+            if self.activation is not None:
+                if self.process is None:
+                    self.activate()
+
+                await self.wait_until_ready()
+                target = self.activation.target
+            else:
+                if self.backend_port is None:
+                    await self.wait_until_ready()
+
+                port = self.backend_port
+                if port is None:
+                    raise Exception("'{}' is not running".format(self.name))
+
+                target = ("localhost", port)
+
+                # counted from before connecting, so a run is not stopped
+                # with a connection to it on the way
+                self.backend_connections[port] += 1
+
+            upstream = await connect(target)
+            await relay(client, upstream)
+        except Exception as ex:
+            logger.warning(
+                "[locald] unable to pass a connection on to service {}: {}"
+                .format(self.name, ex)
+            )
+            client.close()
+        finally:
+            if port is not None:
+                self.backend_connections[port] -= 1
+                if not self.backend_connections[port]:
+                    del self.backend_connections[port]
+
+            self.connections -= 1
+            self.last_activity = time.monotonic()
+
+    def close_sockets(self):
+
+        if self.activation is not None:
+            self.activation.close()
+            self.activation = None
+
+        if self.proxy is not None:
+            self.proxy.close()
+            self.proxy = None
+
+    def spawn(self, keep_output=False):
+
         logger.info(
             "[locald] going to start service {}"
             .format(self.name)
         )
 
-        popen_args = {}
-        if self.config["service"].get("log_path"):
-            log_fp = open(self.config["service"]["log_path"], "ab+", buffering=0)
-            popen_args = {
-                "stdout": log_fp,
-                "stderr": subprocess.STDOUT,
-            }
+        # created before spawning so a log probe only looks at new output
+        probes = get_probes(self.config, self.log)
+        rotation = RotationPolicy(self.config)
+        limits = ResourceLimits(self.config)
 
         args = shlex.split(self.config["service"]["command"])
-        self.process = subprocess.Popen(
-            args,
-            **popen_args,
+        pass_fds = ()
+        env = dict(os.environ, **self.environment) if self.environment else None
+        port = None
+        cgroup_name = self.name
+
+        activation = self.activation
+        if activation is not None:
+            activation.disarm()
+
+            if activation.target is None:
+                pass_fds = activation.get_fds()
+                args = get_activation_args(args, pass_fds)
+            elif not probes and not isinstance(activation.target, str):
+                # connections are only proxied once the target is up
+                probes.append(TCPProbe(format_address(activation.target)))
+
+        if self.proxy is not None:
+            port = self.proxy.get_next_port(self.port)
+            args = [arg.replace("{port}", str(port)) for arg in args]
+            env = dict(env or os.environ, PORT=str(port))
+
+            # the run it replaces is still in the service's own cgroup
+            cgroup_name = "{}@{}".format(self.name, port)
+
+            if not probes:
+                probes.append(TCPProbe("localhost:{}".format(port)))
+
+        # sockets for socket activation are not passed on to a zygote
+        zygote, command = None, None
+        if not pass_fds:
+            zygote, command = self.prepare_fork(args, env)
+
+        def popen(cgroup):
+            stdout, fd = create_output_pipe()
+
+            try:
+                process = subprocess.Popen(
+                    args if cgroup is None else get_cgroup_args(args, cgroup),
+                    stdout=fd,
+                    stderr=subprocess.STDOUT,
+                    pass_fds=pass_fds,
+                    env=env,
+                )
+            except BaseException:
+                stdout.close()
+                raise
+            finally:
+                os.close(fd)
+
+            process.stdout = stdout
+            return process
+
+        track = functools.partial(
+            self.track,
+            port=port,
+            probes=probes,
+            rotation=rotation,
+            keep_output=keep_output,
+        )
+
+        if zygote is None:
+            process, cgroup = spawn(cgroup_name, limits, self.cgroups, popen)
+
+            self.prepare_run()
+            track(process, cgroup)
+            return
+
+        # the zygote reports the pid of what it forked when it gets to it,
+        # the run is tracked from then on
+        self.prepare_run()
+        self.forking = asyncio.ensure_future(
+            self.fork(zygote, command, cgroup_name, limits, popen, track),
         )
+
+    def prepare_run(self):
+        """
+        The futures for the next run of the service, created before it is
+        tracked so they can be waited on while it is being forked.
+        """
+
+        loop = asyncio.get_running_loop()
+        self.exited = loop.create_future()
+        self.ready = loop.create_future()
+
+    def track(self, process, cgroup, port, probes, rotation, keep_output=False):
+        """
+        Make `process` the current run of the service, reading its output and
+        ready once `probes` pass.
+        """
+
+        self.process = process
+        self.cgroup = cgroup
+        self.port = port
+        self.config_hash = get_config_hash(self.config)
+
+        # the configuration may have changed since the log was created
+        self.log.resize(int(self.config["service"].get("log_buffer_lines", "1000")))
+
+        if process.stdout is not None:
+            self.log.attach(
+                process.stdout,
+                self.config["service"].get("log_path"),
+                rotation,
+                keep=keep_output,
+            )
+
         self.dead_since = None
         self.was_killed = False
+        self.started_at = time.monotonic()
+
+        # parsed once per run rather than every time the service exits
+        self.restart_policy = RestartPolicy(self.config)
+        self.memory_policy = MemoryPolicy(self.config)
+        self.rss_growth = None
+        self.idle_policy = IdlePolicy(self.config)
+        self.last_activity = time.monotonic()
+        self.activity_seq = self.log.seq
+
+        if port is not None:
+            self.ready.add_done_callback(functools.partial(self.route, port))
+
+        if probes:
+            asyncio.ensure_future(
+                self.probe(probes, self.process, self.ready),
+            )
+        else:
+            self.ready.set_result(None)
+
+    def adopt(self, process, cgroup, port=None, ready=True, config_hash=None):
+        """
+        Take over a run of the service started by a previous server, see
+        locald.state. Unless it was `ready` then, its probes are run again.
+        `config_hash` is that of the definition it was started with.
+        """
+
+        activation = SocketActivation.create(self.name, self.config)
+
+        if activation is not None:
+            # a service handed its socket still has it open, so it may not
+            # be possible to bind it again until the service exits
+            try:
+                activation.open()
+            except OSError as ex:
+                logger.warning(
+                    "[locald] unable to listen on {} for service {} until it "
+                    "is started again: {}"
+                    .format(activation, self.name, ex)
+                )
+            else:
+                self.activation = activation
+
+                if activation.target is not None:
+                    activation.serve(self.handle_connection)
+
+        self.open_proxy()
+
+        probes = []
+        if not ready:
+            probes = get_probes(self.config, self.log)
+
+            if not probes and port is not None:
+                probes.append(TCPProbe("localhost:{}".format(port)))
+
+        self.prepare_run()
+        self.track(process, cgroup, port, probes, RotationPolicy(self.config))
+        self.started_at = time.monotonic() - (time.time() - process.create_time)
+
+        logger.info(
+            "[locald] took over service {} pid {}"
+            .format(self.name, process.pid)
+        )
+
+        if config_hash is not None and config_hash != self.config_hash:
+            logger.info(
+                "[locald] definition of service {} changed since it was "
+                "started, the change takes effect when it is restarted"
+                .format(self.name)
+            )
+
+            self.config_hash = config_hash
+
+    def get_state(self, handoff=False):
+        """
+        What the next server needs to know to take over the service, see
+        locald.state. With `handoff`, it also gets the pipe the service's
+        output is read from and the output held in memory.
+        """
+
+        state = {
+            "restart_count": self.restart_count,
+        }
+
+        if self.is_running():
+            create_time = get_create_time(self.process.pid)
+            if create_time is None:
+                return None
+
+            state.update({
+                "pid": self.process.pid,
+                "create_time": create_time,
+                "config_hash": self.config_hash,
+                "cgroup": self.cgroup.path if self.cgroup is not None else None,
+                "port": self.port,
+                "instance_port": self.instance_port,
+                "ready": self.ready.done() and self.ready.result() is None,
+            })
+
+            if self.process.stdout is not None:
+                state["output"] = get_output_inode(self.process.stdout)
+        elif (
+            self.activation is not None
+            or self.get_next_restart() is not None
+            or self.forking is not None
+        ):
+            state["start"] = True
+        else:
+            return None
+
+        if handoff:
+            for output in self.log.outputs:
+                if self.process is not None and output.pipe is self.process.stdout:
+                    state["stdout"] = output.pipe.fileno()
+
+            state["lines"] = [
+                [timestamp, line.decode("latin-1")]
+                for timestamp, _, line in self.log.get_lines()
+            ]
+
+        return state
+
+    def prepare_fork(self, args, env):
+        """
+        The zygote to fork the service from and its command as the zygote
+        runs it, if it sets `preload` and a zygote started with the same
+        environment is ready and up to date. Otherwise (None, None), and a
+        new zygote is started for the next time if need be.
+        """
+
+        modules = get_preload_modules(self.config)
+        if not modules:
+            self.close_zygotes()
+            return None, None
+
+        try:
+            check_platform()
+            command = PythonCommand.parse(args, os.environ if env is None else env)
+
+            # each run would need a zygote started with its own $PORT
+            if self.proxy is not None and not self.proxy.backend_ports:
+                raise PreloadError("proxy_port needs proxy_backend_ports to preload")
+        except PreloadError as ex:
+            logger.warning(
+                "[locald] not preloading modules for service {}: {}"
+                .format(self.name, ex)
+            )
+            self.close_zygotes()
+            return None, None
+
+        # modules may read the environment as they are imported, so a zygote
+        # only forks runs with the environment it was started with
+        for zygote in list(self.zygotes):
+            if (zygote.interpreter, zygote.modules) != (command.interpreter, modules):
+                self.close_zygote(zygote)
+                continue
+
+            if not zygote.matches(command.interpreter, modules, command.env):
+                continue
+
+            # still preloading, this start has to do without
+            if not zygote.ready.done():
+                return None, None
+
+            if not zygote.is_ready():
+                self.close_zygote(zygote)
+            elif zygote.is_stale():
+                logger.info(
+                    "[locald] modules preloaded for service {} have changed, "
+                    "preloading them again"
+                    .format(self.name)
+                )
+                self.close_zygote(zygote)
+            else:
+                # the most recently used are kept
+                self.zygotes.remove(zygote)
+                self.zygotes.append(zygote)
+                return zygote, command
+
+            break
+
+        zygote = Zygote(self.name, command.interpreter, modules, command.env)
+        zygote.open()
+        asyncio.ensure_future(self.wait_for_zygote(zygote))
+
+        self.zygotes.append(zygote)
+        while len(self.zygotes) > MAX_ZYGOTES:
+            self.close_zygote(self.zygotes[0])
+
+        return None, None
+
+    async def wait_for_zygote(self, zygote):
+
+        error = await zygote.ready
+        if error is not None:
+            logger.warning(
+                "[locald] unable to preload modules for service {}: {}"
+                .format(self.name, error)
+            )
+
+    async def fork(self, zygote, command, cgroup_name, limits, popen, track):
+        """
+        Fork a run of the service from `zygote`, or start it with `popen` if
+        the zygote does not fork it, then `track(process, cgroup)` it. If it
+        cannot be started at all, the run is not ready and exits at once.
+        """
+
+        try:
+            cgroup, unapplied = prepare_cgroup(cgroup_name, limits, self.cgroups)
+            cgroup_path = cgroup.path if cgroup is not None else None
+
+            started_at = time.monotonic()
+
+            try:
+                process = await zygote.fork(command, cgroup_path, on_exit=self.tend)
+            except PreloadError as ex:
+                logger.warning(
+                    "[locald] unable to fork service {} from its zygote, "
+                    "running its command instead: {}"
+                    .format(self.name, ex)
+                )
+                self.close_zygote(zygote)
+
+                process = popen(cgroup)
+            else:
+                logger.info(
+                    "[locald] forked service {} from its zygote in {:.1f} ms"
+                    .format(self.name, (time.monotonic() - started_at) * 1000)
+                )
+
+            apply_limits(cgroup_name, limits, unapplied, process)
+        except asyncio.CancelledError:
+            self.forking = None
+            set_result(self.ready, Exception("'{}' was not started".format(self.name)))
+            set_result(self.exited)
+            raise
+        except Exception as ex:
+            logger.error(
+                "[locald] unable to start service {}: {}"
+                .format(self.name, ex)
+            )
+
+            self.forking = None
+            set_result(self.ready, ex)
+            set_result(self.exited)
+            return
+
+        self.forking = None
+        track(process, cgroup)
+
+    def close_zygote(self, zygote):
+
+        zygote.close()
+
+        if zygote in self.zygotes:
+            self.zygotes.remove(zygote)
+
+    def close_zygotes(self):
+
+        for zygote in list(self.zygotes):
+            self.close_zygote(zygote)
+
+    async def probe(self, probes, process, ready):
+        """
+        Resolve `ready` with None once the probes pass, or with the exception
+        describing why they did not.
+        """
+
+        def is_alive():
+            return process.poll() is None
+
+        try:
+            await wait_until_ready(
+                self.name,
+                self.config,
+                probes,
+                is_alive,
+                sleep=self.scheduler.sleep,
+            )
+        except Exception as ex:
+            logger.warning("[locald] {}".format(ex))
+            ready.set_result(ex)
+        else:
+            logger.info("[locald] service {} is ready".format(self.name))
+            ready.set_result(None)
+
+    def route(self, port, ready):
+        """
+        Send new connections to the run listening on `port` once it is ready,
+        if it is still the current run.
+        """
+
+        if ready.result() is not None or self.process is None or self.port != port:
+            return
+
+        self.backend_port = port
+
+        logger.info(
+            "[locald] sending connections for service {} to port {}"
+            .format(self.name, port)
+        )
+
+    def can_swap(self):
+        """
+        Whether a restart can be a swap: the service has a proxy whose
+        settings have not changed since it was bound, and is running.
+        """
+
+        if not self.is_running() or self.stopping:
+            return False
+
+        try:
+            proxy = ServiceProxy.create(self.name, self.config)
+        except ValueError:
+            return False
+
+        return proxy is not None and proxy.matches(self.proxy)
+
+    async def swap(self):
+        """
+        Restart the service without dropping a connection: start a new run
+        on the other port while the current one keeps serving, send new
+        connections to the new run once it is ready, then stop the old run
+        once the connections it has finish. If the new run does not become
+        ready, it is stopped instead and the old one carries on.
+        """
+
+        old = Run(self)
+
+        logger.info(
+            "[locald] starting a new run of service {} to replace pid {}"
+            .format(self.name, old.process.pid)
+        )
+
+        self.draining.append(old)
+        self.swapping = True
+
+        try:
+            self.spawn(keep_output=True)
+            error = await self.ready
+        finally:
+            self.swapping = False
+
+        # stopped meanwhile, which retires the old run and stops the new one
+        if old not in self.draining or self.stopping:
+            if error is not None:
+                raise error
+            return
+
+        if error is None and self.process is not None:
+            await self.retire(old, self.proxy.drain_timeout)
+            return
+
+        new = Run(self)
+
+        self.draining.remove(old)
+        old.restore(self)
+
+        # if it has exited, tend already cleaned up after it
+        if new.process is not None and new.process.poll() is None:
+            self.draining.append(new)
+            await self.retire(new)
+
+        raise error or Exception(
+            "'{}' exited before becoming ready"
+            .format(self.name)
+        )
+
+    async def retire(self, run, drain_timeout=0):
+        """
+        Stop a run that is no longer the current one, waiting up to
+        `drain_timeout` seconds for the connections to it to finish first.
+        """
+
+        deadline = self.scheduler.time() + drain_timeout
+        while self.backend_connections[run.port] and self.scheduler.time() < deadline:
+            await self.scheduler.sleep(0.1)
+
+        logger.info(
+            "[locald] stopping replaced run of service {} pid {}"
+            .format(self.name, run.process.pid)
+        )
+
+        survivors = await self.terminate(
+            get_process_tree(run.process, run.cgroup),
+            run.exited,
+        )
+
+        if survivors:
+            signal_processes(survivors, signal.SIGKILL)
+
+            if run.cgroup is not None:
+                run.cgroup.kill()
+
+            run.process.kill()
+            await run.exited
+
+    async def wait_until_ready(self):
+        """
+        Wait until the current run of the service passes its readiness
+        probes, re-raising the probe failure if it does not.
+        """
+
+        if self.ready is None:
+            raise Exception("'{}' is not running".format(self.name))
+
+        error = await self.ready
+        if error is not None:
+            raise error
+
+    def get_status(self):
+        if self.forking is not None:
+            return "STARTING"
+
+        if not self.is_running():
+            if self.crashloop:
+                return "CRASHLOOP"
+            elif self.get_next_restart() is not None:
+                return "BACKOFF"
+            elif self.activation is not None:
+                return "LISTENING"
+            elif self.idle:
+                return "IDLE"
+            else:
+                return "STOPPED"
+
+        if self.stopping:
+            return "STOPPING"
+        elif not self.ready.done():
+            return "STARTING"
+        elif self.ready.result() is not None:
+            return "NOT_READY"
+        else:
+            return "READY"
+
+    def get_uptime(self):
+        if not self.is_running():
+            return None
+
+        return time.monotonic() - self.started_at
 
     def get_returncode(self):
         if self.process is None:
@@ -96,27 +937,451 @@ class Service(object):
 
         return self.process.poll()
 
+    def get_process_tree(self):
+        return get_process_tree(self.process, self.cgroup)
+
     def kill(self):
+        # make sure a pending restart is dropped
+        self.scheduler.cancel((self.name, "restart"))
+
+        # a run still being forked is killed once it has been, see Zygote
+        if self.forking is not None:
+            self.forking.cancel()
+
+        for run in self.draining:
+            if run.cgroup is not None:
+                run.cgroup.kill()
+
+            run.process.kill()
+
+        # also catches anything left over after the service itself exited
+        if self.cgroup is not None:
+            self.cgroup.kill()
+
         if self.process is None:
             return
 
-        parent = psutil.Process(self.process.pid)
-        to_kill = parent.children(recursive=True)
-        to_kill.append(parent)
-
-        for p in to_kill:
-            p.send_signal(signal.SIGKILL)
+        signal_processes(self.get_process_tree(), signal.SIGKILL)
 
         self.process.kill()
         self.was_killed = True
 
+    async def stop(self, close_sockets=True):
+        """
+        Stop the service according to its stop policy: send `stop_signal`
+        (default SIGTERM) to the whole process tree, allow `stop_timeout`
+        seconds (default 10) for everything in it to exit, then SIGKILL
+        whatever is left. Returns True if nothing had to be killed.
+
+        A socket activated service's sockets, and its zygote, are closed too,
+        unless it is about to be started again.
+        """
+
+        self.crashloop = False
+
+        # a run still being forked is stopped once it has been
+        if self.forking is not None:
+            await asyncio.wait([self.forking])
+
+        if close_sockets:
+            self.close_sockets()
+            self.close_zygotes()
+        elif self.activation is not None:
+            self.activation.disarm()
+
+        # replaced runs still draining go straight away
+        for run in list(self.draining):
+            await self.retire(run)
+
+        if self.process is None:
+            self.kill()
+            return True
+
+        logger.info("[locald] stopping service {}".format(self.name))
+
+        self.was_killed = True
+        self.stopping = True
+
+        try:
+            survivors = await self.terminate(self.get_process_tree(), self.exited)
+            if not survivors:
+                return True
+
+            signal_processes(survivors, signal.SIGKILL)
+            self.kill()
+            await self.wait()
+
+            return False
+        finally:
+            self.stopping = False
+
+    async def terminate(self, tree, exited):
+        """
+        Send `stop_signal` to the processes in `tree` and wait up to
+        `stop_timeout` seconds for them to exit, `exited` being resolved once
+        the first of them has. Returns those still alive after that.
+        """
+
+        stop_signal = get_signal(self.config["service"].get("stop_signal", "SIGTERM"))
+        stop_timeout = float(self.config["service"].get("stop_timeout", "10"))
+
+        if not tree:
+            return []
+
+        loop = asyncio.get_running_loop()
+        deadline = self.scheduler.time() + stop_timeout
+        key = (self.name, "escalate", tree[0].pid)
+
+        logger.info(
+            "[locald] sending {} to service {} pid {}"
+            .format(stop_signal.name, self.name, tree[0].pid)
+        )
+
+        signal_processes(tree, stop_signal)
+
+        escalate = loop.create_future()
+        self.scheduler.call_at(deadline, set_result, escalate, key=key)
+
+        try:
+            await asyncio.wait(
+                [exited, escalate],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            self.scheduler.cancel(key)
+
+        # anything the service spawned gets the rest of the grace period,
+        # it may still be shutting down after its parent has gone
+        while self.scheduler.time() < deadline and any(is_alive(p) for p in tree):
+            await self.scheduler.sleep(0.05)
+
+        survivors = [p for p in tree if is_alive(p)]
+        if survivors:
+            logger.warning(
+                "[locald] service {} pid {} did not stop within {} seconds, killing"
+                .format(self.name, tree[0].pid, stop_timeout)
+            )
+
+        return survivors
+
     def is_running(self):
         if self.process is None:
             return False
 
         return self.get_returncode() is None
 
-    def restart(self):
-        self.kill()
-        self.tend()
+    async def wait(self):
+        """
+        Wait for the current run of the service, if any, to exit.
+        """
+
+        if self.exited is not None:
+            await self.exited
+
+    async def restart(self):
+
+        if self.can_swap():
+            await self.swap()
+            return
+
+        await self.stop(close_sockets=False)
         self.start()
+
+    def check_memory(self, history):
+        """
+        Apply the memory policy to the service's metrics history, called by
+        the server after each sample. Restarts the service once it uses more
+        than `max_rss`, returning True if it does, and warns when its memory
+        use grows faster than `rss_growth_alert`.
+        """
+
+        policy = self.memory_policy
+        if policy is None or not policy.is_enabled():
+            return
+
+        if not self.is_running() or self.stopping:
+            return
+
+        latest = history.get_latest()
+        if latest is None or latest["pid"] != self.process.pid:
+            return
+
+        if policy.max_rss is not None and latest["rss"] > policy.max_rss:
+            logger.warning(
+                "[locald] service {} is using {} bytes of memory, more than "
+                "max_rss ({}), restarting it"
+                .format(self.name, latest["rss"], policy.max_rss)
+            )
+
+            self.memory_restarts += 1
+            self.restart_count += 1
+
+            # the service is marked as stopping well before the next sample,
+            # which then leaves it alone
+            asyncio.ensure_future(self.restart_for_memory())
+            return True
+
+        if policy.growth_alert is not None:
+            self.check_growth(history, latest["time"])
+
+    def check_growth(self, history, now):
+
+        policy = self.memory_policy
+
+        # only once it has run for the whole window, so that neither an
+        # earlier run nor memory used while starting up counts
+        if self.get_uptime() < policy.growth_window:
+            return
+
+        cutoff = now - policy.growth_window
+
+        times = []
+        values = []
+        for timestamp, rss in zip(history.get("time"), history.get("rss")):
+            if timestamp >= cutoff:
+                times.append(timestamp)
+                values.append(rss)
+
+        rate = get_growth_rate(times, values)
+        if rate is None or rate <= policy.growth_alert:
+            self.rss_growth = None
+            return
+
+        # warn once each time the growth goes over the limit
+        if self.rss_growth is None:
+            logger.warning(
+                "[locald] memory use of service {} has grown at {} over the "
+                "last {:.0f} seconds, more than rss_growth_alert ({})"
+                .format(
+                    self.name,
+                    format_rate(rate),
+                    now - times[0],
+                    format_rate(policy.growth_alert),
+                )
+            )
+            self.rss_alerts += 1
+
+        self.rss_growth = rate
+
+    def check_idle(self, history, required=False):
+        """
+        Stop the service once it has been idle for `idle_timeout` seconds,
+        called by the server after each sample. Proxied connections, output
+        and CPU usage over `idle_cpu_percent` all count as activity. A
+        service that is `required` by running services is left alone unless
+        it is socket activated, since they could not wake it up again.
+        """
+
+        policy = self.idle_policy
+        if policy is None or policy.timeout is None:
+            return
+
+        if not self.is_running() or self.stopping:
+            return
+
+        latest = history.get_latest()
+        if latest is None or latest["pid"] != self.process.pid:
+            return
+
+        now = time.monotonic()
+
+        active = (
+            self.connections > 0
+            or self.log.seq != self.activity_seq
+            or latest["cpu_percent"] > policy.cpu_percent
+        )
+
+        if active:
+            self.last_activity = now
+            self.activity_seq = self.log.seq
+            return
+
+        idle_for = now - self.last_activity
+        if idle_for < policy.timeout:
+            return
+
+        if required and self.activation is None:
+            return
+
+        logger.info(
+            "[locald] service {} has been idle for {:.0f} seconds, stopping it"
+            .format(self.name, idle_for)
+        )
+
+        asyncio.ensure_future(self.stop_for_idle())
+
+    async def stop_for_idle(self):
+
+        try:
+            if self.activation is not None:
+                # back to waiting for a connection
+                await self.restart()
+            else:
+                await self.stop()
+                self.idle = True
+        except Exception:
+            logger.error(
+                "[locald] failed to stop idle service {}: {}"
+                .format(self.name, traceback.format_exc())
+            )
+
+    async def restart_for_memory(self):
+        try:
+            await self.restart()
+        except Exception:
+            logger.error(
+                "[locald] failed to restart service {}: {}"
+                .format(self.name, traceback.format_exc())
+            )
+
+
+class Run(object):
+    """
+    One run of a service: its process and what goes with it, kept while it
+    is replaced by a new run.
+    """
+
+    def __init__(self, service):
+        self.process = service.process
+        self.cgroup = service.cgroup
+        self.exited = service.exited
+        self.ready = service.ready
+        self.started_at = service.started_at
+        self.port = service.port
+
+    def restore(self, service):
+        service.process = self.process
+        service.cgroup = self.cgroup
+        service.exited = self.exited
+        service.ready = self.ready
+        service.started_at = self.started_at
+        service.port = self.port
+
+
+class RestartPolicy(object):
+    """
+    A service's restart settings, parsed from its configuration.
+    """
+
+    def __init__(self, config):
+        values = config["service"]
+
+        self.always = values.get("restart", "never") == "always"
+        self.seconds = float(values.get("restart_seconds", "0"))
+        self.backoff = float(values.get("restart_backoff", "2"))
+        self.max_seconds = float(values.get("restart_max_seconds", "60"))
+        self.jitter = float(values.get("restart_jitter", "0.1"))
+        self.limit = int(values.get("restart_limit", "5"))
+        self.window = float(values.get("restart_window", "60"))
+        self.reset_seconds = float(values.get("restart_reset_seconds", "60"))
+
+    def get_delay(self, backoff_step):
+        """
+        The first restart after a stable run waits `restart_seconds`, each one
+        after that backs off by a factor of `restart_backoff` up to
+        `restart_max_seconds`, randomized by +/- `restart_jitter`. Without
+        `restart_seconds` the backoff starts from BACKOFF_SECONDS.
+        """
+
+        if backoff_step == 0:
+            delay = self.seconds
+        else:
+            base = self.seconds if self.seconds > 0 else BACKOFF_SECONDS
+            delay = base * self.backoff ** backoff_step
+            delay = min(delay, self.max_seconds)
+
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+
+        return max(delay, 0)
+
+
+class IdlePolicy(object):
+    """
+    A service's idle settings, parsed from its configuration.
+    """
+
+    def __init__(self, config):
+        values = config["service"]
+
+        self.timeout = None
+        if values.get("idle_timeout"):
+            self.timeout = float(values["idle_timeout"])
+
+        self.cpu_percent = float(values.get("idle_cpu_percent", "1"))
+
+
+def set_result(future, result=None):
+    if not future.done():
+        future.set_result(result)
+
+
+def get_signal(value):
+    """
+    Parse a signal given by name (SIGTERM or TERM) or number.
+    """
+
+    value = value.strip().upper()
+
+    if value.isdigit():
+        return signal.Signals(int(value))
+
+    if not value.startswith("SIG"):
+        value = "SIG" + value
+
+    return signal.Signals[value]
+
+
+def signal_processes(processes, signum):
+    for p in processes:
+        try:
+            p.send_signal(signum)
+        except psutil.NoSuchProcess:
+            pass
+
+
+def get_processes(pid, pids):
+    """
+    psutil processes for `pids`, with `pid` first.
+    """
+
+    processes = []
+
+    for other in [pid] + [p for p in pids if p != pid]:
+        try:
+            processes.append(psutil.Process(other))
+        except psutil.NoSuchProcess:
+            pass
+
+    return processes
+
+
+def get_process_tree(process, cgroup):
+    """
+    A service process and all of its descendants, as psutil processes. In a
+    cgroup, that is everything in the cgroup, including processes that have
+    been reparented.
+    """
+
+    if process is None:
+        return []
+
+    if cgroup is not None:
+        return get_processes(process.pid, cgroup.get_pids())
+
+    try:
+        parent = psutil.Process(process.pid)
+        tree = parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        # already exited and reaped, but not yet tended to
+        return []
+
+    tree.insert(0, parent)
+
+    return tree
+
+
+def is_alive(p):
+    try:
+        return p.is_running() and p.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
@@ -0,0 +1,337 @@
+"""
+Handing services over from one server to the next.
+
+The server keeps a record of the services it runs in a state file: the pid,
+start time and definition hash of each one's process, its cgroup and port,
+and which services are waiting for a connection or a restart. It is written
+whenever any of that changes, and removed when the server stops (and stops its
+services) as usual. The path can be set in the `[locald]` section:
+
+    state_path=/tmp/myproject.state     # default: pid_path with .state added
+
+When the server starts and finds a state file, it takes over the services in
+it that are still running instead of starting them again, so a server that
+crashed or was killed picks up where it left off. A server that fails with an
+unexpected error leaves its services running and the state file in place for
+the next one too. The processes are no longer its children, so they are
+watched through a pidfd (or checked every second where there are none), and
+their exit codes are unknown.
+
+Each run writes its output to a pipe that it also holds open for reading (see
+create_output_pipe), so it is not killed by SIGPIPE when the server goes away.
+The next server opens the pipe again through /proc, and captures what was
+written in the meantime: up to PIPE_SIZE is kept, after which the service
+blocks writing until a server reads it. Services waiting for a connection or a
+restart are started again, as are those with `restart=always` that exited in
+the meantime.
+
+`locald server-reload` replaces the running server without any of that, for
+instance after upgrading locald: the server re-executes itself in place,
+keeping its pid, and hands its listening sockets, the output pipes of its
+services and their recent output to the new server along with the state. The
+services stay its children, so nothing about them is lost, and connections
+made in the meantime wait rather than being refused. Connections the server
+is passing on to services are given `reload_timeout` seconds (default 10) to
+finish first. Services forked by a zygote (see locald.preload) are the
+zygote's children instead, and it does not report to the new server, so they
+are watched as after a crash and their exit codes are unknown.
+
+Before reloading, the server checks in a new interpreter that the
+configuration loads and that a server can be created with the locald now
+installed, and refuses to reload if not. Should the new server fail to be
+executed all the same, the old one goes back to serving.
+
+Definitions that changed since a service was started take effect the next
+time it is restarted, as with `locald reload`.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import select
+import shutil
+import signal
+import stat
+import tempfile
+
+import psutil
+
+
+logger = logging.getLogger()
+
+
+# reported as the exit code of adopted processes that are not children
+UNKNOWN_RETURNCODE = "unknown"
+
+# bytes of output a service can write while no server is reading it, where
+# the pipe can be made that large
+PIPE_SIZE = 1024 * 1024
+
+
+class AdoptedProcess(object):
+    """
+    A service process started by a previous server, in place of a
+    subprocess.Popen. After a reload it is still the server's child and is
+    reaped as usual, otherwise its exit is noticed through its pidfd.
+    """
+
+    def __init__(self, pid, create_time, pidfd=None, stdout=None, on_exit=None):
+        self.pid = pid
+        self.create_time = create_time
+        self.pidfd = pidfd
+        self.stdout = stdout
+        self.on_exit = on_exit
+        self.returncode = None
+
+        if pidfd is not None:
+            asyncio.get_running_loop().add_reader(pidfd, self.poll)
+
+    @classmethod
+    def open(cls, pid, create_time, stdout=None, on_exit=None):
+        """
+        The process with `pid`, if it is still the one that was started at
+        `create_time`, or None.
+        """
+
+        pidfd = None
+        if hasattr(os, "pidfd_open"):
+            try:
+                pidfd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                return None
+            except OSError:
+                pass
+
+        # checked once the pidfd is open, so that it refers to the process
+        # that was checked rather than one that reused its pid
+        if not is_same_process(pid, create_time):
+            if pidfd is not None:
+                os.close(pidfd)
+            return None
+
+        return cls(pid, create_time, pidfd, stdout, on_exit)
+
+    def poll(self):
+
+        if self.returncode is not None:
+            return self.returncode
+
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            if self.is_alive():
+                return None
+
+            self.set_returncode(UNKNOWN_RETURNCODE)
+        else:
+            if not pid:
+                return None
+
+            self.set_returncode(os.waitstatus_to_exitcode(status))
+
+        return self.returncode
+
+    def is_alive(self):
+
+        if self.pidfd is not None:
+            readable, _, _ = select.select([self.pidfd], [], [], 0)
+            return not readable
+
+        return is_same_process(self.pid, self.create_time)
+
+    def send_signal(self, signum):
+
+        # once it has exited, the pid may belong to something else
+        if self.returncode is not None:
+            return
+
+        try:
+            if self.pidfd is not None:
+                signal.pidfd_send_signal(self.pidfd, signum)
+            else:
+                os.kill(self.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def set_returncode(self, returncode):
+
+        if self.returncode is not None:
+            return
+
+        self.returncode = returncode
+
+        if self.pidfd is not None:
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.pidfd)
+            os.close(self.pidfd)
+            self.pidfd = None
+
+        if self.on_exit is not None:
+            asyncio.get_running_loop().call_soon(self.on_exit)
+
+
+def create_output_pipe():
+    """
+    A pipe for the output of a new run, as the file its output is read from
+    and the file descriptor to make its stdout and stderr. That is opened for
+    reading as well as writing, so the pipe outlives the server.
+    """
+
+    # the fifo is only ever used through its file descriptors
+    directory = tempfile.mkdtemp(prefix="locald-")
+    try:
+        path = os.path.join(directory, "output")
+        os.mkfifo(path, 0o600)
+
+        read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            write_fd = os.open(path, os.O_RDWR)
+        except OSError:
+            os.close(read_fd)
+            raise
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    try:
+        fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+    except (AttributeError, OSError):
+        pass
+
+    return open(read_fd, "rb"), write_fd
+
+
+def get_output_inode(stdout):
+    """
+    What identifies the pipe a run's output is read from, for
+    reopen_output.
+    """
+
+    try:
+        return os.fstat(stdout.fileno()).st_ino
+    except (OSError, ValueError):
+        return None
+
+
+def reopen_output(pid, inode):
+    """
+    Open the output pipe of a process started by a previous server for
+    reading again, if its stdout is still the pipe identified by `inode`.
+    Returns None if not, or if there is no /proc to open it through.
+    """
+
+    path = "/proc/{}/fd/1".format(pid)
+
+    try:
+        st = os.stat(path)
+        if not stat.S_ISFIFO(st.st_mode) or st.st_ino != inode:
+            return None
+
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_NOCTTY)
+    except OSError:
+        return None
+
+    return open(fd, "rb")
+
+
+def get_state_path(config):
+    return (
+        config["locald"].get("state_path")
+        or "{}.state".format(config["locald"]["pid_path"])
+    )
+
+
+def read_state(path):
+    """
+    The state left by a previous server, or None if there is none.
+    """
+
+    try:
+        with open(path, "rt") as fp:
+            state = json.load(fp)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as ex:
+        logger.warning(
+            "[locald] unable to read the state file {}: {}"
+            .format(path, ex)
+        )
+        return None
+
+    if not isinstance(state, dict):
+        return None
+
+    return state
+
+
+def write_state(path, state):
+
+    # replaced at once, so a server that dies while writing it leaves the
+    # previous state behind rather than half of it
+    tmp_path = "{}.tmp".format(path)
+
+    with open(tmp_path, "wt") as fp:
+        json.dump(state, fp)
+
+    os.replace(tmp_path, path)
+
+
+def remove_state(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_config_hash(config):
+    """
+    A digest of a service's definition, to tell whether it changed.
+    """
+
+    data = json.dumps(config["service"], sort_keys=True, default=str)
+
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def get_create_time(pid):
+    try:
+        return psutil.Process(pid).create_time()
+    except psutil.NoSuchProcess:
+        return None
+
+
+def is_same_process(pid, create_time):
+
+    try:
+        process = psutil.Process(pid)
+        return (
+            process.create_time() == create_time
+            and process.status() != psutil.STATUS_ZOMBIE
+        )
+    except psutil.NoSuchProcess:
+        return False
+
+
+def reap(pids):
+    """
+    Reap whichever of `pids`, children left to the server by the one before
+    it, have exited. Returns those that have not.
+    """
+
+    remaining = set()
+
+    for pid in pids:
+        try:
+            reaped, _ = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            continue
+
+        if not reaped:
+            remaining.add(pid)
+
+    return remaining
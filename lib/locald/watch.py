@@ -0,0 +1,640 @@
+"""
+Restarting services when their source files change.
+
+A service may set, in its `[service]` section:
+
+    watch=src/**/*.py, templates/**   # globs of files to watch
+    ignore=node_modules, *.log        # globs of files or directories to skip
+    watch_dependents=true             # also restart services that require it
+
+Relative globs are relative to the server's working directory, the same as
+service commands. In a glob, `*` and `?` do not match `/` while `**` matches
+any number of directories. An ignore pattern without a `/` matches any single
+file or directory name, so `ignore=node_modules` skips every node_modules
+directory; with a `/` it matches whole paths, like the watch globs.
+DEFAULT_IGNORE is always ignored.
+
+One inotify instance is shared by every service. It needs a watch for each
+directory rather than for each file, so the number of watches is bounded by
+the number of directories, and by `watch_max_directories` in the `[locald]`
+section (default 10000). Changes are coalesced: a restart happens once
+nothing has changed for `watch_debounce` seconds (default 0.2), or at most
+MAX_DEBOUNCE_FACTOR times that after the first change, so a large checkout
+restarts each service once. Nothing is polled, so watching costs no CPU while
+nothing changes.
+
+inotify is only available on Linux. Elsewhere the settings are ignored with a
+warning.
+"""
+
+import asyncio
+import collections
+import ctypes
+import errno
+import logging
+import os
+import re
+import struct
+
+
+logger = logging.getLogger()
+
+
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.inotify_init1
+    libc.inotify_add_watch
+    libc.inotify_rm_watch
+except (OSError, AttributeError):
+    libc = None
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+    | IN_EXCL_UNLINK
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# how much longer than watch_debounce a stream of changes may hold off a
+# restart
+MAX_DEBOUNCE_FACTOR = 10
+
+# editor and tooling noise that should never cause a restart
+DEFAULT_IGNORE = [
+    ".git",
+    ".hg",
+    "__pycache__",
+    "*.pyc",
+    "*.swp",
+    "*.swx",
+    "*~",
+    ".#*",
+    "4913",
+]
+
+
+class WatchSpec(object):
+    """
+    A service's watch settings, parsed from its configuration, with globs
+    resolved against `base`. None is returned by create if the service does
+    not watch anything.
+    """
+
+    def __init__(self, watch, ignore, base, dependents=False):
+        self.base = base
+        self.dependents = dependents
+
+        self.globs = [os.path.normpath(os.path.join(base, g)) for g in watch]
+        self.ignore = list(ignore)
+
+        self.roots = {}
+        self.patterns = []
+        for pattern in self.globs:
+            root, pattern, recursive = split_glob(pattern)
+            self.roots[root] = self.roots.get(root, False) or recursive
+            self.patterns.append(compile_glob(pattern))
+
+        self.names = []
+        self.paths = []
+        for pattern in DEFAULT_IGNORE + self.ignore:
+            if "/" in pattern:
+                pattern = os.path.normpath(os.path.join(base, pattern))
+                self.paths.append(compile_glob(pattern))
+            else:
+                self.names.append(compile_glob(pattern))
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, WatchSpec)
+            and (self.globs, self.ignore, self.dependents)
+            == (other.globs, other.ignore, other.dependents)
+        )
+
+    @classmethod
+    def create(cls, config, base):
+
+        values = config["service"]
+
+        watch = split_list(values.get("watch", ""))
+        if not watch:
+            return None
+
+        dependents = values.get("watch_dependents", "false").lower() in (
+            "1",
+            "true",
+            "yes",
+            "on",
+        )
+
+        return cls(watch, split_list(values.get("ignore", "")), base, dependents)
+
+    def is_ignored(self, path):
+
+        name = os.path.basename(path)
+        if any(p.match(name) for p in self.names):
+            return True
+
+        # a path is ignored along with any directory it is in
+        while path != os.path.dirname(path):
+            if any(p.match(path) for p in self.paths):
+                return True
+
+            path = os.path.dirname(path)
+
+        return False
+
+    def matches(self, path):
+        return (
+            any(p.match(path) for p in self.patterns)
+            and not self.is_ignored(path)
+        )
+
+    def get_directories(self, limit):
+        """
+        Every directory that needs watching, up to `limit` of them, leaving
+        out ignored ones and anything in them.
+        """
+
+        directories = []
+
+        for root, recursive in sorted(self.roots.items()):
+            if not os.path.isdir(root):
+                logger.warning(
+                    "[locald] not watching {}, it is not a directory"
+                    .format(root)
+                )
+                continue
+
+            if not recursive:
+                directories.append(root)
+                continue
+
+            for path, subdirectories, _ in os.walk(root):
+                directories.append(path)
+
+                subdirectories[:] = [
+                    d
+                    for d in subdirectories
+                    if not self.is_ignored(os.path.join(path, d))
+                ]
+
+                if len(directories) >= limit:
+                    return directories[:limit]
+
+        return directories[:limit]
+
+    def get_new_directories(self, path, limit):
+        """
+        The directories from `path` down that need watching, up to `limit`
+        of them, and whether any of the files already in them match.
+        """
+
+        directories = []
+        matched = False
+
+        for directory, subdirectories, files in os.walk(path):
+            directories.append(directory)
+
+            subdirectories[:] = [
+                d
+                for d in subdirectories
+                if not self.is_ignored(os.path.join(directory, d))
+            ]
+
+            if not matched:
+                matched = any(
+                    self.matches(os.path.join(directory, f)) for f in files
+                )
+
+            if len(directories) >= limit:
+                break
+
+        return directories, matched
+
+
+class FileWatcher(object):
+    """
+    Watches the directories of every service's WatchSpec with a single
+    inotify file descriptor, and calls `callback` with the names of the
+    services that had files change once things settle down.
+    """
+
+    def __init__(self, fd, scheduler, callback, debounce, max_directories):
+        self.fd = fd
+        self.scheduler = scheduler
+        self.callback = callback
+        self.debounce = debounce
+        self.max_directories = max_directories
+
+        self.specs = {}
+        self.paths = {}
+        self.wds = {}
+        self.owners = collections.defaultdict(set)
+        self.directories = collections.defaultdict(set)
+        self.changed = set()
+        self.first_change = None
+        self.full = False
+        self.adding = set()
+
+    @classmethod
+    def create(cls, config, scheduler, callback):
+        """
+        Start watching, returning None if inotify is not available.
+        """
+
+        if libc is None:
+            return None
+
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            error = ctypes.get_errno()
+            logger.warning(
+                "[locald] unable to start watching files: {}"
+                .format(os.strerror(error))
+            )
+            return None
+
+        values = config["locald"]
+
+        watcher = cls(
+            fd,
+            scheduler,
+            callback,
+            float(values.get("watch_debounce", "0.2")),
+            int(values.get("watch_max_directories", "10000")),
+        )
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(fd, watcher.read_events)
+
+        return watcher
+
+    def close(self):
+
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self.fd)
+
+        self.scheduler.cancel("watch")
+
+        for task in self.adding:
+            task.cancel()
+
+        os.close(self.fd)
+
+    async def watch(self, name, spec):
+        """
+        Watch the files of service `name` according to `spec`, replacing
+        whatever it watched before. Finding the directories to watch can take
+        a while in a big tree, so it is done in the executor.
+        """
+
+        if spec == self.specs.get(name):
+            return
+
+        self.unwatch(name)
+
+        if spec is None:
+            return
+
+        self.specs[name] = spec
+
+        loop = asyncio.get_running_loop()
+        directories = await loop.run_in_executor(
+            None,
+            spec.get_directories,
+            self.max_directories,
+        )
+
+        # replaced or removed while looking
+        if self.specs.get(name) is not spec:
+            return
+
+        for path in directories:
+            if not self.add_directory(name, path):
+                break
+
+        logger.info(
+            "[locald] watching {} directories for service {}"
+            .format(len(self.directories[name]), name)
+        )
+
+    def unwatch(self, name):
+
+        self.specs.pop(name, None)
+        self.changed.discard(name)
+
+        for path in self.directories.pop(name, ()):
+            owners = self.owners[path]
+            owners.discard(name)
+
+            if not owners:
+                self.remove_directory(path)
+
+    def add_directory(self, name, path):
+        """
+        Watch `path` on behalf of service `name`, returning False once no more
+        directories can be watched.
+        """
+
+        if path in self.directories[name]:
+            return True
+
+        if path not in self.wds:
+            if len(self.wds) >= self.max_directories:
+                self.warn_full("watch_max_directories ({}) reached".format(self.max_directories))
+                return False
+
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    self.warn_full("fs.inotify.max_user_watches reached")
+                    return False
+
+                # gone already, or not a directory after all
+                if error not in (errno.ENOENT, errno.ENOTDIR):
+                    logger.warning(
+                        "[locald] unable to watch {}: {}"
+                        .format(path, os.strerror(error))
+                    )
+                return True
+
+            self.wds[path] = wd
+            self.paths[wd] = path
+
+        self.owners[path].add(name)
+        self.directories[name].add(path)
+
+        return True
+
+    def remove_directory(self, path):
+
+        self.owners.pop(path, None)
+
+        wd = self.wds.pop(path, None)
+        if wd is None:
+            return
+
+        self.paths.pop(wd, None)
+        libc.inotify_rm_watch(self.fd, wd)
+
+        self.full = False
+
+    def forget_directory(self, path):
+        """
+        Stop watching `path` and everything under it for every service.
+        """
+
+        prefix = path + "/"
+
+        for directory in list(self.wds):
+            if directory == path or directory.startswith(prefix):
+                for owner in self.owners.get(directory, ()):
+                    self.directories[owner].discard(directory)
+
+                self.remove_directory(directory)
+
+    def warn_full(self, reason):
+
+        # once is enough until watches are freed up again
+        if not self.full:
+            logger.warning(
+                "[locald] not watching any more directories, {}"
+                .format(reason)
+            )
+            self.full = True
+
+    def read_events(self):
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+
+            if not data:
+                return
+
+            self.handle_events(data)
+
+    def handle_events(self, data):
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so anything could have changed
+                logger.warning("[locald] file change events were lost")
+                self.changed.update(self.specs)
+                continue
+
+            directory = self.paths.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                # the directory is gone, and its watch with it
+                self.paths.pop(wd, None)
+                self.wds.pop(directory, None)
+                for owner in self.owners.pop(directory, ()):
+                    self.directories[owner].discard(directory)
+                continue
+
+            if not name:
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name))
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_new_directory(directory, path)
+                continue
+
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                # the watches would follow it to wherever it went
+                self.forget_directory(path)
+                continue
+
+            for owner in self.owners.get(directory, ()):
+                if self.specs[owner].matches(path):
+                    self.changed.add(owner)
+
+        if self.changed:
+            self.schedule()
+
+    def add_new_directory(self, parent, path):
+        """
+        Start watching a directory that has just appeared, for services that
+        watch the one it is in recursively. It may be a whole tree moved into
+        place, so it is walked in the executor, like in watch.
+        """
+
+        owners = []
+
+        for owner in self.owners.get(parent, ()):
+            spec = self.specs[owner]
+
+            if spec.is_ignored(path):
+                continue
+
+            if not any(
+                recursive and (parent + "/").startswith(root.rstrip("/") + "/")
+                for root, recursive in spec.roots.items()
+            ):
+                continue
+
+            owners.append((owner, spec))
+
+        if not owners:
+            return
+
+        task = asyncio.ensure_future(self.watch_new_directory(path, owners))
+        self.adding.add(task)
+        task.add_done_callback(self.adding.discard)
+
+    async def watch_new_directory(self, path, owners):
+
+        loop = asyncio.get_running_loop()
+
+        for owner, spec in owners:
+            directories, matched = await loop.run_in_executor(
+                None,
+                spec.get_new_directories,
+                path,
+                self.max_directories,
+            )
+
+            # replaced or removed while looking
+            if self.specs.get(owner) is not spec:
+                continue
+
+            for directory in directories:
+                if not self.add_directory(owner, directory):
+                    break
+
+            # files may have been created in it before the watch was added,
+            # so those count as changes
+            if matched:
+                self.changed.add(owner)
+                self.schedule()
+
+    def schedule(self):
+        """
+        Call back once changes stop for the debounce period, but no more
+        than MAX_DEBOUNCE_FACTOR debounce periods after the first one.
+        """
+
+        now = self.scheduler.time()
+
+        if self.first_change is None:
+            self.first_change = now
+
+        when = min(
+            now + self.debounce,
+            self.first_change + self.debounce * MAX_DEBOUNCE_FACTOR,
+        )
+
+        self.scheduler.call_at(when, self.flush, key="watch")
+
+    def flush(self):
+
+        changed = self.changed
+        self.changed = set()
+        self.first_change = None
+
+        if changed:
+            self.callback(sorted(changed))
+
+
+def split_list(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def split_glob(pattern):
+    """
+    Split an absolute glob into the directory to watch, the glob to match
+    paths in it against and whether subdirectories need watching too. A glob
+    that names a directory watches everything in it.
+    """
+
+    parts = pattern.split("/")
+
+    static = []
+    for part in parts:
+        if re.search(r"[*?\[]", part):
+            break
+
+        static.append(part)
+
+    if len(static) == len(parts):
+        if os.path.isdir(pattern):
+            return pattern, os.path.join(pattern, "**"), True
+
+        return os.path.dirname(pattern), pattern, False
+
+    root = "/".join(static) or "/"
+    rest = parts[len(static):]
+
+    recursive = len(rest) > 1 or "**" in rest[0]
+
+    return root, pattern, recursive
+
+
+def compile_glob(pattern):
+    """
+    Compile a glob into a regular expression matching whole paths, in which
+    `*` and `?` do not match "/" and `**` matches any number of directories.
+    """
+
+    parts = []
+
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+
+            parts.append("[{}]".format(body.replace("\\", "\\\\")))
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+
+    return re.compile("".join(parts) + r"\Z")
@@ -0,0 +1,101 @@
+"""
+Memory watchdog for services.
+
+A service may set, in its `[service]` section:
+
+    max_rss=1G                 # restart once its process tree uses more memory
+    rss_growth_alert=100M/h    # warn when memory use keeps growing this fast
+    rss_growth_window=300      # seconds the growth is measured over (default 300)
+
+Both are checked against the samples the server takes every `metrics_interval`
+seconds, so they have no effect when that is 0. Growth is the slope of a least
+squares fit of RSS over the last `rss_growth_window` seconds of samples (or as
+many of them as the metrics history holds), so a single spike does not count
+as a leak.
+"""
+
+from .logs import parse_size
+
+
+RATE_UNITS = {
+    "s": 1,
+    "m": 60,
+    "h": 3600,
+}
+
+# fewest samples a growth rate is worked out from
+MIN_GROWTH_SAMPLES = 3
+
+
+class WatchdogConfigError(ValueError):
+    pass
+
+
+class MemoryPolicy(object):
+    """
+    A service's memory watchdog settings, parsed from its configuration.
+    """
+
+    def __init__(self, config):
+        values = config["service"]
+
+        self.max_rss = None
+        if values.get("max_rss"):
+            self.max_rss = parse_size(values["max_rss"])
+
+        self.growth_alert = None
+        if values.get("rss_growth_alert"):
+            self.growth_alert = parse_rate(values["rss_growth_alert"])
+
+        self.growth_window = float(values.get("rss_growth_window", "300"))
+
+    def is_enabled(self):
+        return self.max_rss is not None or self.growth_alert is not None
+
+
+def parse_rate(value):
+    """
+    Parse a rate of growth such as "100M/h" into bytes per second. Without a
+    unit of time, the rate is per hour.
+    """
+
+    size, _, unit = value.partition("/")
+    unit = unit.strip().lower() or "h"
+
+    if unit not in RATE_UNITS:
+        raise WatchdogConfigError("invalid rate '{}'".format(value))
+
+    return parse_size(size) / RATE_UNITS[unit]
+
+
+def get_growth_rate(times, values):
+    """
+    The slope of the least squares line through (times, values), in units of
+    value per second, or None if there are too few points to tell.
+    """
+
+    count = len(times)
+    if count < MIN_GROWTH_SAMPLES:
+        return None
+
+    mean_time = sum(times) / count
+    mean_value = sum(values) / count
+
+    variance = sum((t - mean_time) ** 2 for t in times)
+    if variance == 0:
+        return None
+
+    covariance = sum(
+        (t - mean_time) * (v - mean_value)
+        for t, v in zip(times, values)
+    )
+
+    return covariance / variance
+
+
+def format_rate(rate):
+    """
+    A rate in bytes per second as MB per hour, for log messages.
+    """
+
+    return "{:.1f}M/h".format(rate * RATE_UNITS["h"] / 1024 ** 2)
@@ -0,0 +1,148 @@
+import os
+
+import pytest
+
+from locald import cgroups
+from locald.cgroups import (
+    CgroupError,
+    CgroupManager,
+    ResourceLimits,
+    get_nice_for_weight,
+    parse_cpus,
+    prepare_cgroup,
+)
+
+
+@pytest.fixture
+def cgroup_root(tmp_path):
+    (tmp_path / "cgroup.controllers").write_text("cpu io memory pids\n")
+    (tmp_path / "cgroup.subtree_control").write_text("\n")
+    return tmp_path
+
+
+def get_limits(**values):
+    return ResourceLimits({"service": values})
+
+
+def test_parse_cpus():
+    assert parse_cpus("0") == [0]
+    assert parse_cpus("0-3,6") == [0, 1, 2, 3, 6]
+    assert parse_cpus(" 2, 0-1 ,1") == [0, 1, 2]
+
+
+@pytest.mark.parametrize("value", ["", ",", "a", "0-b", "1-2-3"])
+def test_parse_cpus_invalid(value):
+    with pytest.raises(CgroupError):
+        parse_cpus(value)
+
+
+def test_get_nice_for_weight():
+    assert get_nice_for_weight(100) == 0
+    assert get_nice_for_weight(125) == -1
+    assert get_nice_for_weight(80) == 1
+
+
+def test_get_nice_for_weight_limits():
+    assert get_nice_for_weight(10000) == -20
+    assert get_nice_for_weight(1) == 19
+
+
+def test_get_nice_for_weight_is_monotonic():
+    nices = [get_nice_for_weight(weight) for weight in range(1, 10001, 50)]
+
+    assert nices == sorted(nices, reverse=True)
+
+
+def test_limits_get_settings():
+    limits = get_limits(memory_max="512M", cpu_max="150%", io_weight="50")
+
+    assert limits.get_settings() == [
+        ("memory", "memory.max", str(512 * 1024 * 1024)),
+        ("cpu", "cpu.max", "150000 100000"),
+        ("io", "io.weight", "default 50"),
+    ]
+
+
+def test_limits_nice_needs_no_cgroup():
+    assert get_limits(nice="10").get_settings() == []
+
+
+def test_create_off(cgroup_root):
+    config = {"locald": {"cgroups": "no", "cgroup_path": str(cgroup_root)}}
+
+    assert CgroupManager.create(config) is None
+
+
+def test_create_auto_needs_delegation(cgroup_root, monkeypatch):
+    monkeypatch.setattr(cgroups, "get_own_cgroup", lambda: str(cgroup_root))
+    monkeypatch.setattr(cgroups, "is_delegated", lambda path: False)
+
+    assert CgroupManager.create({"locald": {}}) is None
+    assert not (cgroup_root / "locald.server").exists()
+
+
+def test_create_yes(cgroup_root, monkeypatch):
+    monkeypatch.setattr(cgroups, "get_own_cgroup", lambda: str(cgroup_root))
+    monkeypatch.setattr(cgroups, "is_delegated", lambda path: False)
+
+    manager = CgroupManager.create({"locald": {"cgroups": "yes"}})
+
+    assert manager.path == str(cgroup_root)
+    assert manager.controllers == {"cpu", "io", "memory"}
+    assert manager.enabled == {"cpu", "io", "memory"}
+    procs = cgroup_root / "locald.server" / "cgroup.procs"
+    assert procs.read_text() == str(os.getpid())
+
+
+def test_create_after_reload(cgroup_root, monkeypatch):
+    (cgroup_root / "cgroup.subtree_control").write_text("cpu memory\n")
+    server = cgroup_root / "locald.server"
+    server.mkdir()
+    monkeypatch.setattr(cgroups, "get_own_cgroup", lambda: str(server))
+    monkeypatch.setattr(cgroups, "is_delegated", lambda path: False)
+
+    manager = CgroupManager.create({"locald": {"cgroups": "yes"}})
+
+    assert manager.path == str(cgroup_root)
+    assert manager.enabled == {"cpu", "io", "memory"}
+
+
+def test_close_leaves_running_services(cgroup_root):
+    manager = CgroupManager(str(cgroup_root))
+    manager.setup()
+    service = cgroup_root / "web.service"
+    service.mkdir()
+    (service / "cgroup.procs").write_text("12345\n")
+    subtree_control = cgroup_root / "cgroup.subtree_control"
+    enabled = subtree_control.read_text()
+
+    manager.close()
+
+    assert subtree_control.read_text() == enabled
+    assert not (cgroup_root / "cgroup.procs").exists()
+
+
+def test_prepare_cgroup_without_settings(cgroup_root):
+    manager = CgroupManager(str(cgroup_root))
+
+    assert prepare_cgroup("web", get_limits(nice="5"), manager) == (None, [])
+    assert not (cgroup_root / "web.service").exists()
+
+
+def test_prepare_cgroup(cgroup_root):
+    manager = CgroupManager(str(cgroup_root))
+    manager.controllers = {"memory"}
+    limits = get_limits(memory_max="1M", cpu_weight="200")
+
+    cgroup, unapplied = prepare_cgroup("web", limits, manager)
+
+    assert cgroup.path == str(cgroup_root / "web.service")
+    memory_max = cgroup_root / "web.service" / "memory.max"
+    assert memory_max.read_text() == "1048576"
+    assert unapplied == ["cpu.weight"]
+
+
+def test_prepare_cgroup_without_manager():
+    limits = get_limits(memory_max="1M")
+
+    assert prepare_cgroup("web", limits, None) == (None, ["memory.max"])
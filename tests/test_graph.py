@@ -0,0 +1,193 @@
+import asyncio
+
+import pytest
+
+from locald.graph import (
+    DependencyError,
+    find_cycle,
+    resolve_dependencies,
+    run_in_dependency_order,
+)
+
+
+def get_service_config(services):
+    def get(name):
+        return {"service": {"requires": ", ".join(services[name])}}
+
+    return get
+
+
+def test_find_cycle_none():
+    graph = {"a": ["b", "c"], "b": ["c"], "c": []}
+
+    assert find_cycle(graph) is None
+
+
+def test_find_cycle():
+    graph = {"a": ["b"], "b": ["c"], "c": ["a"], "d": []}
+
+    assert find_cycle(graph) == ["a", "b", "c", "a"]
+
+
+def test_find_cycle_self():
+    assert find_cycle({"a": ["a"]}) == ["a", "a"]
+
+
+def test_find_cycle_not_through_root():
+    graph = {"a": ["b"], "b": ["c"], "c": ["b"]}
+
+    assert find_cycle(graph) == ["b", "c", "b"]
+
+
+def test_find_cycle_shared_dependency():
+    # reaching a finished node twice is not a cycle
+    graph = {"a": ["b", "c"], "b": ["d"], "c": ["d"], "d": []}
+
+    assert find_cycle(graph) is None
+
+
+def test_resolve_dependencies():
+    services = {
+        "web": ["api"],
+        "api": ["db", "cache"],
+        "db": [],
+        "cache": [],
+        "other": [],
+    }
+
+    graph, service_configs = resolve_dependencies(
+        services,
+        ["web"],
+        get_service_config(services),
+    )
+
+    assert graph == {
+        "web": ["api"],
+        "api": ["db", "cache"],
+        "db": [],
+        "cache": [],
+    }
+    assert sorted(service_configs) == ["api", "cache", "db", "web"]
+
+
+def test_resolve_dependencies_loads_each_config_once():
+    services = {"a": ["c"], "b": ["c"], "c": []}
+    loaded = []
+
+    def get(name):
+        loaded.append(name)
+        return get_service_config(services)(name)
+
+    resolve_dependencies(services, ["a", "b"], get)
+
+    assert sorted(loaded) == ["a", "b", "c"]
+
+
+def test_resolve_dependencies_unknown():
+    services = {"a": []}
+
+    with pytest.raises(DependencyError, match="unknown service 'b'"):
+        resolve_dependencies(services, ["b"], get_service_config(services))
+
+
+def test_resolve_dependencies_unknown_required():
+    services = {"a": ["b"]}
+
+    with pytest.raises(DependencyError, match="unknown required service 'b'"):
+        resolve_dependencies(services, ["a"], get_service_config(services))
+
+
+def test_resolve_dependencies_cycle():
+    services = {"a": ["b"], "b": ["a"]}
+
+    with pytest.raises(DependencyError, match="a -> b -> a"):
+        resolve_dependencies(services, ["a"], get_service_config(services))
+
+
+def run_graph(graph, func, max_concurrency=10, stop_on_error=True):
+    return asyncio.run(
+        run_in_dependency_order(graph, func, max_concurrency, stop_on_error),
+    )
+
+
+def test_run_in_dependency_order():
+    graph = {"web": ["api"], "api": ["db"], "db": [], "cache": []}
+    order = []
+
+    async def func(name):
+        order.append(name)
+        return name.upper()
+
+    results = run_graph(graph, func)
+
+    assert order.index("db") < order.index("api") < order.index("web")
+    assert sorted(results) == [
+        ("api", "API", None),
+        ("cache", "CACHE", None),
+        ("db", "DB", None),
+        ("web", "WEB", None),
+    ]
+
+
+def test_run_in_dependency_order_runs_branches_concurrently():
+    graph = {"a": [], "b": [], "c": ["a", "b"]}
+    running = set()
+    overlapped = []
+
+    async def func(name):
+        running.add(name)
+        await asyncio.sleep(0.01)
+        overlapped.append(set(running))
+        running.discard(name)
+
+    run_graph(graph, func)
+
+    assert {"a", "b"} in overlapped
+
+
+def test_run_in_dependency_order_max_concurrency():
+    graph = {name: [] for name in "abcdef"}
+    running = 0
+    most = 0
+
+    async def func(name):
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    run_graph(graph, func, max_concurrency=2)
+
+    assert most == 2
+
+
+def test_run_in_dependency_order_stop_on_error():
+    graph = {"web": ["api"], "api": ["db"], "db": []}
+    error = RuntimeError("db failed")
+
+    async def func(name):
+        if name == "db":
+            raise error
+
+    results = run_graph(graph, func)
+
+    # dependents of the failure are never run
+    assert results == [("db", None, error)]
+
+
+def test_run_in_dependency_order_carry_on_after_error():
+    graph = {"web": ["db"], "db": [], "cache": []}
+    error = RuntimeError("db failed")
+
+    async def func(name):
+        if name == "db":
+            raise error
+
+    results = run_graph(graph, func, stop_on_error=False)
+
+    assert sorted(results, key=lambda result: result[0]) == [
+        ("cache", None, None),
+        ("db", None, error),
+        ("web", None, None),
+    ]
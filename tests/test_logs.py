@@ -0,0 +1,176 @@
+import asyncio
+import gzip
+import os
+import time
+
+import pytest
+
+from locald.logs import (
+    INDEX_ENTRY,
+    LogConfigError,
+    RotationPolicy,
+    ServiceLog,
+    get_index_path,
+    get_segments,
+    parse_size,
+)
+from locald.scheduler import Scheduler
+
+
+def get_log(log_path, **values):
+    log = ServiceLog("test", Scheduler())
+    log.log_path = str(log_path)
+    log.rotation = RotationPolicy({"service": values})
+    return log
+
+
+async def wait_for_rotation(log):
+    while log.rotating is not None or log.rotated:
+        await asyncio.sleep(0.01)
+
+
+def test_parse_size():
+    assert parse_size("100") == 100
+    assert parse_size("4K") == 4 * 1024
+    assert parse_size("2mb") == 2 * 1024 * 1024
+    assert parse_size("1G") == 1024 * 1024 * 1024
+
+    with pytest.raises(LogConfigError):
+        parse_size("lots")
+
+
+def test_should_rotate():
+    policy = RotationPolicy({
+        "service": {"log_max_size": "1K", "log_max_age": "60"},
+    })
+
+    assert not policy.should_rotate(0, None)
+    assert policy.should_rotate(1024, None)
+    assert not policy.should_rotate(10, time.time() - 30)
+    assert policy.should_rotate(10, time.time() - 60)
+
+
+def test_rotate_by_size(tmp_path):
+    log_path = tmp_path / "service.log"
+
+    async def main():
+        log = get_log(log_path, log_max_size="100")
+
+        log.write(b"a" * 60, time.time())
+        log.flush()
+        assert get_segments(str(log_path)) == []
+
+        log.write(b"b" * 60, time.time())
+        log.flush()
+        await wait_for_rotation(log)
+
+        log.write(b"c", time.time())
+        log.close()
+
+    asyncio.run(main())
+
+    segments = get_segments(str(log_path))
+    assert len(segments) == 1
+    assert segments[0].endswith(".gz")
+    assert os.path.exists(get_index_path(segments[0]))
+
+    with gzip.open(segments[0]) as fp:
+        assert fp.read() == b"a" * 60 + b"\n" + b"b" * 60 + b"\n"
+
+    assert log_path.read_bytes() == b"c\n"
+
+
+def test_rotations_are_finished_one_at_a_time(tmp_path):
+    log_path = tmp_path / "service.log"
+    busy = []
+
+    async def main():
+        log = get_log(log_path, log_max_size="10", log_keep="2")
+
+        finish_rotation = log.finish_rotation
+
+        def track():
+            busy.append(log.rotating is not None)
+            finish_rotation()
+
+        log.finish_rotation = track
+
+        for i in range(6):
+            log.write(b"%d" % i * 20, time.time())
+            log.flush()
+
+        await wait_for_rotation(log)
+        log.close()
+
+    asyncio.run(main())
+
+    # later rotations wait for the one in progress instead of running
+    # alongside it
+    assert busy == [False] * len(busy)
+
+    segments = get_segments(str(log_path))
+    assert len(segments) == 2
+    assert all(segment.endswith(".gz") for segment in segments)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_age_is_taken_from_index(tmp_path):
+    log_path = tmp_path / "service.log"
+
+    # left behind by an earlier server, with output from two minutes ago
+    log_path.write_bytes(b"old\n")
+    with open(get_index_path(str(log_path)), "wb") as fp:
+        fp.write(INDEX_ENTRY.pack(time.time() - 120, 0))
+
+    async def main():
+        log = get_log(log_path, log_max_age="60")
+        log.open_log_file()
+
+        assert log.log_started_at < time.time() - 60
+
+        # nothing is written, the scheduler notices the age by itself
+        await asyncio.sleep(0.1)
+        await wait_for_rotation(log)
+        log.close()
+
+    asyncio.run(main())
+
+    assert len(get_segments(str(log_path))) == 1
+    assert not log_path.exists()
+
+
+def test_quiet_log_is_rotated_on_time(tmp_path):
+    log_path = tmp_path / "service.log"
+
+    async def main():
+        log = get_log(log_path, log_max_age="0.2")
+
+        log.write(b"once", time.time())
+        log.flush()
+
+        await asyncio.sleep(0.4)
+        await wait_for_rotation(log)
+        log.close()
+
+    asyncio.run(main())
+
+    assert len(get_segments(str(log_path))) == 1
+
+
+def test_new_file_is_not_aged(tmp_path):
+    log_path = tmp_path / "service.log"
+
+    async def main():
+        log = get_log(log_path, log_max_age="60")
+        log.open_log_file()
+
+        started_at = log.log_started_at
+
+        log.write(b"first", time.time())
+        log.flush()
+        log.close()
+
+        return started_at
+
+    assert asyncio.run(main()) is None
+    assert get_segments(str(log_path)) == []
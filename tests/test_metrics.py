@@ -0,0 +1,98 @@
+import os
+import subprocess
+
+from locald.metrics import (
+    PROC_CHILDREN,
+    MetricsHistory,
+    ProcessSampler,
+    has_changed,
+)
+
+
+def get_sample(time, cpu_percent=0.0, pid=1, read_bytes=0, write_bytes=0):
+    return {
+        "time": time,
+        "pid": pid,
+        "cpu_percent": cpu_percent,
+        "rss": 1024,
+        "threads": 1,
+        "read_bytes": read_bytes,
+        "write_bytes": write_bytes,
+    }
+
+
+def test_history_before_wrapping():
+    history = MetricsHistory(5)
+
+    assert history.get("cpu_percent") == []
+    assert history.get_latest() is None
+
+    for i in range(3):
+        history.append(get_sample(i, cpu_percent=i))
+
+    assert history.get("cpu_percent") == [0, 1, 2]
+    assert history.get("cpu_percent", 2) == [1, 2]
+    assert history.get("cpu_percent", 10) == [0, 1, 2]
+
+
+def test_history_wraps_around():
+    history = MetricsHistory(4)
+
+    for i in range(10):
+        history.append(get_sample(i, cpu_percent=i))
+
+    assert history.count == 4
+    assert history.get("cpu_percent") == [6, 7, 8, 9]
+    assert history.get("time", 3) == [7, 8, 9]
+    assert history.get_latest()["cpu_percent"] == 9
+
+
+def test_history_io_rates():
+    history = MetricsHistory(4)
+
+    history.append(get_sample(0, read_bytes=0, write_bytes=100))
+    history.append(get_sample(2, read_bytes=1000, write_bytes=100))
+
+    assert history.get("read_rate") == [0, 500]
+    assert history.get("write_rate") == [0, 0]
+
+
+def test_history_io_rates_new_run():
+    history = MetricsHistory(4)
+
+    history.append(get_sample(0, pid=1, read_bytes=5000))
+    history.append(get_sample(2, pid=2, read_bytes=1000))
+
+    # counters start over with a new process, so there is nothing to compare
+    assert history.get("read_rate") == [0, 0]
+
+
+def test_sample_own_tree():
+    sampler = ProcessSampler()
+
+    samples = sampler.sample({"self": os.getpid(), "gone": 2 ** 22 + 1})
+
+    assert list(samples) == ["self"]
+    assert samples["self"]["pid"] == os.getpid()
+    assert samples["self"]["processes"] >= 1
+    assert samples["self"]["rss"] > 0
+
+
+def test_has_changed():
+    sampler = ProcessSampler()
+    tree = sampler.get_trees([os.getpid()])[os.getpid()]
+
+    assert not has_changed(tree)
+
+
+def test_has_changed_new_child():
+    sampler = ProcessSampler()
+    tree = sampler.get_trees([os.getpid()])[os.getpid()]
+
+    process = subprocess.Popen(["sleep", "10"])
+    try:
+        # only noticed without a scan where the children can be listed
+        assert has_changed(tree) == PROC_CHILDREN
+    finally:
+        process.kill()
+        process.wait()
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+from locald import preload
+from locald.preload import PreloadError, PythonCommand, Zygote
+
+
+def parse(args, env=None):
+    return PythonCommand.parse(args, env or {})
+
+
+def test_parse_script():
+    command = parse([sys.executable, "-u", "app.py", "--port", "80"])
+
+    assert command.interpreter == sys.executable
+    assert command.kind == "path"
+    assert command.target == "app.py"
+    assert command.argv == ["app.py", "--port", "80"]
+    assert command.unbuffered
+    assert not command.dont_write_bytecode
+
+
+def test_parse_module():
+    command = parse([sys.executable, "-Bm", "http.server", "8000"])
+
+    assert command.kind == "module"
+    assert command.target == "http.server"
+    assert command.argv == ["http.server", "8000"]
+    assert command.dont_write_bytecode
+
+
+def test_parse_module_separate_argument():
+    command = parse([sys.executable, "-m", "http.server"])
+
+    assert command.kind == "module"
+    assert command.target == "http.server"
+
+
+def test_parse_code():
+    command = parse([sys.executable, "-c", "print(1)", "x"])
+
+    assert command.kind == "code"
+    assert command.target == "print(1)"
+    assert command.argv == ["-c", "x"]
+
+
+def test_parse_env():
+    command = parse(
+        ["/usr/bin/env", "A=1", sys.executable, "app.py"],
+        {"B": "2"},
+    )
+
+    assert command.env == {"A": "1", "B": "2"}
+    assert command.target == "app.py"
+
+
+def test_parse_interpreter_from_path(tmp_path):
+    interpreter = tmp_path / "python3"
+    interpreter.write_text("")
+    interpreter.chmod(0o755)
+
+    command = parse(["python3", "app.py"], {"PATH": str(tmp_path)})
+
+    assert command.interpreter == str(interpreter)
+
+
+@pytest.mark.parametrize("args", [
+    [],
+    ["node", "app.js"],
+    [sys.executable],
+    [sys.executable, "-"],
+    [sys.executable, "-u"],
+    [sys.executable, "-m"],
+    [sys.executable, "-X", "dev", "app.py"],
+    ["env", "-i", sys.executable, "app.py"],
+])
+def test_parse_unsupported(args):
+    with pytest.raises(PreloadError):
+        parse(args)
+
+
+def test_parse_missing_interpreter():
+    with pytest.raises(PreloadError, match="was not found"):
+        parse(["python3"], {"PATH": "/nonexistent"})
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def get_zygote(tmp_path):
+    path = tmp_path / "module.py"
+    path.write_text("")
+
+    zygote = Zygote("web", sys.executable, ("module",))
+    zygote.files = {str(path): os.stat(path).st_mtime_ns}
+
+    return zygote, path
+
+
+def test_is_stale(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(preload.time, "monotonic", clock)
+    zygote, path = get_zygote(tmp_path)
+
+    assert not zygote.is_stale()
+
+    os.utime(path, ns=(0, 0))
+    clock.now += preload.STALE_CHECK_INTERVAL
+
+    assert zygote.is_stale()
+
+
+def test_is_stale_checks_once_per_interval(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(preload.time, "monotonic", clock)
+    zygote, path = get_zygote(tmp_path)
+
+    assert not zygote.is_stale()
+
+    path.unlink()
+    clock.now += preload.STALE_CHECK_INTERVAL / 2
+
+    assert not zygote.is_stale()
+
+    clock.now += preload.STALE_CHECK_INTERVAL / 2
+
+    assert zygote.is_stale()
+
+
+class Process(object):
+
+    def __init__(self, exits_after):
+        self.exits_after = exits_after
+        self.polls = 0
+        self.killed = False
+
+    def poll(self):
+        self.polls += 1
+        if self.killed or self.polls > self.exits_after:
+            return 0
+        return None
+
+    def kill(self):
+        self.killed = True
+
+
+def test_reap_does_not_block(monkeypatch):
+    monkeypatch.setattr(preload, "EXIT_POLL_INTERVAL", 0.001)
+
+    async def main():
+        zygote = Zygote("web", sys.executable, ("module",))
+        zygote.process = Process(exits_after=3)
+
+        zygote.reap(asyncio.get_running_loop().time() + 10)
+        assert zygote.process.polls == 1
+
+        await asyncio.sleep(0.1)
+        assert zygote.process.polls == 4
+        assert not zygote.process.killed
+
+    asyncio.run(main())
+
+
+def test_reap_kills_after_deadline(monkeypatch):
+    monkeypatch.setattr(preload, "EXIT_POLL_INTERVAL", 0.001)
+
+    async def main():
+        zygote = Zygote("web", sys.executable, ("module",))
+        zygote.process = Process(exits_after=1000)
+
+        zygote.reap(asyncio.get_running_loop().time())
+        await asyncio.sleep(0.1)
+
+        assert zygote.process.killed
+
+    asyncio.run(main())
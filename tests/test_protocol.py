@@ -0,0 +1,73 @@
+import pytest
+
+from locald.protocol import (
+    HEADER,
+    MAX_FRAME_SIZE,
+    FrameDecoder,
+    ProtocolError,
+    encode_frame,
+)
+
+
+def test_round_trip():
+    decoder = FrameDecoder()
+
+    message = {"id": 1, "command": "status", "name": "ALL"}
+
+    assert decoder.feed(encode_frame(message)) == [message]
+    assert decoder.buffer == bytearray()
+
+
+def test_frames_split_byte_by_byte():
+    decoder = FrameDecoder()
+
+    data = encode_frame({"id": 1}) + encode_frame({"id": 2})
+
+    messages = []
+    for i in range(len(data)):
+        messages.extend(decoder.feed(data[i:i + 1]))
+
+    assert messages == [{"id": 1}, {"id": 2}]
+
+
+def test_partial_frame_is_kept():
+    decoder = FrameDecoder()
+
+    data = encode_frame({"id": 1, "response": "x" * 100})
+
+    assert decoder.feed(data[:2]) == []
+    assert decoder.feed(data[2:HEADER.size + 10]) == []
+    assert decoder.feed(data[HEADER.size + 10:]) == [
+        {"id": 1, "response": "x" * 100},
+    ]
+
+
+def test_several_frames_in_one_read():
+    decoder = FrameDecoder()
+
+    data = b"".join(encode_frame({"id": i}) for i in range(3))
+    first = encode_frame({"id": 3})
+
+    assert decoder.feed(data + first[:3]) == [{"id": 0}, {"id": 1}, {"id": 2}]
+    assert decoder.feed(first[3:]) == [{"id": 3}]
+
+
+def test_oversized_length_is_rejected():
+    decoder = FrameDecoder()
+
+    with pytest.raises(ProtocolError):
+        decoder.feed(HEADER.pack(MAX_FRAME_SIZE + 1))
+
+
+def test_oversized_message_is_not_encoded(monkeypatch):
+    monkeypatch.setattr("locald.protocol.MAX_FRAME_SIZE", 10)
+
+    with pytest.raises(ProtocolError):
+        encode_frame({"id": 1, "response": "x" * 10})
+
+
+def test_invalid_json_is_rejected():
+    decoder = FrameDecoder()
+
+    with pytest.raises(ProtocolError):
+        decoder.feed(HEADER.pack(3) + b"{{{")
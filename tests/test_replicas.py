@@ -0,0 +1,89 @@
+import pytest
+
+from locald.replicas import ReplicaError, ReplicaSet, parse_count
+from locald.server import split_instance_name
+
+
+def test_parse_count():
+    assert parse_count("1") == 1
+    assert parse_count("12") == 12
+
+
+@pytest.mark.parametrize("value", ["0", "-1", "two", "", "1.5"])
+def test_parse_count_invalid(value):
+    with pytest.raises(ReplicaError):
+        parse_count(value)
+
+
+def test_split_instance_name():
+    assert split_instance_name("web@2") == ("web", 2)
+    assert split_instance_name("my@web@10") == ("my@web", 10)
+
+
+@pytest.mark.parametrize("name", ["web", "web@", "web@x", "web@-1"])
+def test_split_instance_name_not_an_instance(name):
+    assert split_instance_name(name) == (name, None)
+
+
+def get_replica_set(**values):
+    values.setdefault("command", "serve --port {port} --id {instance}")
+    return ReplicaSet("web", {"service": values}, scheduler=None)
+
+
+def test_get_count():
+    replica_set = get_replica_set(replicas="3")
+
+    assert replica_set.get_count() == 3
+
+    # as scaled, until the server is stopped
+    replica_set.count = 5
+    assert replica_set.get_count() == 5
+
+
+def test_get_port():
+    replica_set = get_replica_set(replicas="3", replica_base_port="9001")
+
+    assert [replica_set.get_port(number) for number in (1, 2, 3)] == [
+        9001,
+        9002,
+        9003,
+    ]
+
+
+def test_get_instance_config():
+    replica_set = get_replica_set(
+        replicas="2",
+        proxy_port="9000",
+        log_path="/tmp/web.log",
+    )
+
+    config = replica_set.get_instance_config(2, 9002)["service"]
+
+    assert config["command"] == "serve --port 9002 --id 2"
+    assert config["log_path"] == "/tmp/web@2.log"
+
+    # settings of the service as a whole are left out
+    assert "replicas" not in config
+    assert "proxy_port" not in config
+
+
+def test_get_instance_config_log_path_with_instance():
+    replica_set = get_replica_set(
+        replicas="2",
+        log_path="/tmp/web-{instance}.log",
+    )
+
+    config = replica_set.get_instance_config(1, 9001)["service"]
+
+    assert config["log_path"] == "/tmp/web-1.log"
+
+
+def test_get_instance_config_probe():
+    replica_set = get_replica_set(
+        replicas="2",
+        ready_http="http://localhost:{port}/health",
+    )
+
+    config = replica_set.get_instance_config(1, 9001)["service"]
+
+    assert config["ready_http"] == "http://localhost:9001/health"
@@ -0,0 +1,138 @@
+import asyncio
+import time
+
+from locald.scheduler import Scheduler
+
+
+def run(coroutine):
+    return asyncio.run(coroutine())
+
+
+def test_calls_run_in_order():
+
+    async def main():
+        scheduler = Scheduler()
+        calls = []
+
+        scheduler.call_later(0.03, calls.append, "c")
+        scheduler.call_later(0.01, calls.append, "a")
+        scheduler.call_later(0.02, calls.append, "b")
+
+        # due at the same time, so run in the order they were scheduled
+        when = scheduler.time() + 0.04
+        scheduler.call_at(when, calls.append, "d")
+        scheduler.call_at(when, calls.append, "e")
+
+        await asyncio.sleep(0.1)
+
+        return calls
+
+    assert run(main) == ["a", "b", "c", "d", "e"]
+
+
+def test_key_replaces_pending_call():
+
+    async def main():
+        scheduler = Scheduler()
+        calls = []
+
+        scheduler.call_later(0.01, calls.append, "first", key="restart")
+        scheduler.call_later(0.02, calls.append, "second", key="restart")
+
+        await asyncio.sleep(0.05)
+
+        return calls, scheduler.when("restart")
+
+    assert run(main) == (["second"], None)
+
+
+def test_cancel():
+
+    async def main():
+        scheduler = Scheduler()
+        calls = []
+
+        scheduler.call_later(0.01, calls.append, "a", key="a")
+        scheduler.call_later(0.02, calls.append, "b", key="b")
+        scheduler.cancel("a")
+        scheduler.cancel("unknown")
+
+        await asyncio.sleep(0.05)
+
+        return calls
+
+    assert run(main) == ["b"]
+
+
+def test_earlier_call_rearms_timer():
+
+    async def main():
+        scheduler = Scheduler()
+        calls = []
+
+        scheduler.call_later(10, calls.append, "late")
+        scheduler.call_later(0.01, calls.append, "soon")
+
+        await asyncio.sleep(0.05)
+
+        return calls, scheduler.timer_when is not None
+
+    assert run(main) == (["soon"], True)
+
+
+def test_when_is_wall_clock():
+
+    async def main():
+        scheduler = Scheduler()
+        scheduler.call_later(60, print, key="check")
+
+        return scheduler.when("check")
+
+    assert abs(run(main) - (time.time() + 60)) < 1
+
+
+def test_failing_call_does_not_stop_others():
+
+    async def main():
+        scheduler = Scheduler()
+        calls = []
+
+        scheduler.call_later(0.01, lambda: 1 / 0)
+        scheduler.call_later(0.01, calls.append, "after")
+
+        await asyncio.sleep(0.05)
+
+        return calls
+
+    assert run(main) == ["after"]
+
+
+def test_sleep():
+
+    async def main():
+        scheduler = Scheduler()
+        started = scheduler.time()
+
+        await scheduler.sleep(0.02)
+
+        return scheduler.time() - started, scheduler.heap
+
+    elapsed, heap = run(main)
+
+    assert elapsed >= 0.02
+    assert heap == []
+
+
+def test_cancelled_sleep_leaves_nothing_due():
+
+    async def main():
+        scheduler = Scheduler()
+
+        task = asyncio.ensure_future(scheduler.sleep(10))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.sleep(0)
+
+        return [call for call in scheduler.heap if not call.cancelled]
+
+    assert run(main) == []
@@ -0,0 +1,164 @@
+import gzip
+
+from locald.logs import INDEX_ENTRY, get_index_path
+from locald.search import (
+    LogQuery,
+    get_range,
+    iter_mapped_lines,
+    iter_stream_lines,
+    search_log,
+)
+
+
+TIMESTAMPS = [100.0, 200.0, 300.0]
+OFFSETS = [0, 10, 20]
+
+
+def write_log(path, entries):
+    """
+    Write a log file and its index from (timestamp, lines) pairs, one index
+    entry per pair.
+    """
+
+    data = bytearray()
+    index = bytearray()
+
+    for timestamp, lines in entries:
+        index.extend(INDEX_ENTRY.pack(timestamp, len(data)))
+        for line in lines:
+            data.extend(line + b"\n")
+
+    with open(path, "wb") as fp:
+        fp.write(data)
+
+    with open(get_index_path(path), "wb") as fp:
+        fp.write(index)
+
+
+def test_get_range_everything():
+    assert get_range(TIMESTAMPS, OFFSETS, LogQuery()) == (0, None)
+
+
+def test_get_range_since():
+    assert get_range(TIMESTAMPS, OFFSETS, LogQuery(since=150)) == (10, None)
+    assert get_range(TIMESTAMPS, OFFSETS, LogQuery(since=200)) == (10, None)
+    assert get_range(TIMESTAMPS, OFFSETS, LogQuery(since=50)) == (0, None)
+
+
+def test_get_range_until():
+    assert get_range(TIMESTAMPS, OFFSETS, LogQuery(until=250)) == (0, 20)
+    assert get_range(TIMESTAMPS, OFFSETS, LogQuery(until=300)) == (0, None)
+
+
+def test_get_range_between():
+    query = LogQuery(since=150, until=250)
+
+    assert get_range(TIMESTAMPS, OFFSETS, query) == (10, 20)
+
+
+def test_get_range_outside():
+    assert get_range(TIMESTAMPS, OFFSETS, LogQuery(since=301)) is None
+    assert get_range(TIMESTAMPS, OFFSETS, LogQuery(until=99)) is None
+
+
+def test_iter_mapped_lines(tmp_path):
+    path = tmp_path / "service.log"
+    path.write_bytes(b"one\ntwo\nthree\nfour")
+
+    with open(path, "rb") as fp:
+        assert list(iter_mapped_lines(fp, 0, None)) == [
+            (0, b"one"),
+            (4, b"two"),
+            (8, b"three"),
+            (14, b"four"),
+        ]
+
+    with open(path, "rb") as fp:
+        assert list(iter_mapped_lines(fp, 4, 14)) == [
+            (4, b"two"),
+            (8, b"three"),
+        ]
+
+
+def test_iter_mapped_lines_pattern(tmp_path):
+    path = tmp_path / "service.log"
+    path.write_bytes(b"one\ntwo\nthree\nfour\n")
+
+    query = LogQuery(pattern="^t")
+
+    with open(path, "rb") as fp:
+        lines = list(iter_mapped_lines(fp, 0, None, query.file_pattern))
+
+    # only lines that may match are split out
+    assert lines == [(4, b"two"), (8, b"three")]
+
+
+def test_iter_mapped_lines_empty(tmp_path):
+    path = tmp_path / "service.log"
+    path.write_bytes(b"")
+
+    with open(path, "rb") as fp:
+        assert list(iter_mapped_lines(fp, 0, None)) == []
+
+
+def test_iter_stream_lines(tmp_path):
+    path = tmp_path / "service.log.gz"
+    with gzip.open(path, "wb") as fp:
+        fp.write(b"one\ntwo\nthree\n")
+
+    with gzip.open(path, "rb") as fp:
+        assert list(iter_stream_lines(fp, 4, 8)) == [(4, b"two")]
+
+
+def test_search_log(tmp_path):
+    log_path = str(tmp_path / "service.log")
+    write_log(log_path, [
+        (100.0, [b"starting", b"error: one"]),
+        (200.0, [b"working"]),
+        (300.0, [b"error: two", b"stopping"]),
+    ])
+
+    lines = list(search_log(log_path, "svc", LogQuery()))
+    assert lines[0] == (100.0, "svc", b"starting")
+    assert [line for _, _, line in lines] == [
+        b"starting",
+        b"error: one",
+        b"working",
+        b"error: two",
+        b"stopping",
+    ]
+
+    query = LogQuery(since=150, pattern="error")
+    assert list(search_log(log_path, "svc", query)) == [
+        (300.0, "svc", b"error: two"),
+    ]
+
+    query = LogQuery(until=250)
+    assert [line for _, _, line in search_log(log_path, "svc", query)] == [
+        b"starting",
+        b"error: one",
+        b"working",
+    ]
+
+
+def test_search_log_across_segments(tmp_path):
+    log_path = str(tmp_path / "service.log")
+
+    segment = log_path + ".20200101-000000-000000"
+    write_log(segment, [(100.0, [b"old"])])
+    with open(segment, "rb") as src, gzip.open(segment + ".gz", "wb") as dst:
+        dst.write(src.read())
+    (tmp_path / "service.log.20200101-000000-000000").unlink()
+
+    write_log(log_path, [(200.0, [b"new", b"newer"])])
+
+    lines = list(search_log(log_path, "svc", LogQuery()))
+    assert lines == [
+        (100.0, "svc", b"old"),
+        (200.0, "svc", b"new"),
+        (200.0, "svc", b"newer"),
+    ]
+
+    # the current file is only read as far as `end`
+    lines = list(search_log(log_path, "svc", LogQuery(since=150), end=4))
+    assert lines == [(200.0, "svc", b"new")]
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from locald.protocol import FrameDecoder, ProtocolError
+from locald.server import EMPTY_SAMPLE, Connection, get_current_sample
+
+
+class Writer(object):
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def get_extra_info(self, name):
+        return "test"
+
+    def write(self, data):
+        self.data.extend(data)
+
+    async def drain(self):
+        pass
+
+
+def send(response, more=False):
+    writer = Writer()
+
+    async def main():
+        await Connection(writer).send(7, response, more=more)
+
+    asyncio.run(main())
+
+    return FrameDecoder().feed(writer.data)
+
+
+def test_send():
+    assert send({"messages": ["ok"]}) == [
+        {"id": 7, "response": {"messages": ["ok"]}},
+    ]
+
+    assert send({"lines": []}, more=True) == [
+        {"id": 7, "response": {"lines": []}, "more": True},
+    ]
+
+
+def test_send_unserializable():
+    frames = send({"value": object()})
+
+    # answered with the error rather than not at all
+    assert len(frames) == 1
+    assert frames[0]["id"] == 7
+    assert "more" not in frames[0]
+    assert frames[0]["response"]["messages"][0].startswith(
+        "unable to send response:"
+    )
+
+
+def test_send_oversized(monkeypatch):
+    monkeypatch.setattr("locald.protocol.MAX_FRAME_SIZE", 200)
+
+    frames = send({"lines": ["x" * 300]})
+
+    assert "exceeds the maximum" in frames[0]["response"]["messages"][0]
+
+
+def test_send_part_unserializable():
+    # ends the command, whose final response carries the error
+    with pytest.raises(ProtocolError):
+        send({"value": object()}, more=True)
+
+
+class Process(object):
+
+    def __init__(self, pid):
+        self.pid = pid
+
+
+class Service(object):
+
+    def __init__(self, pid=None):
+        self.process = Process(pid) if pid is not None else None
+
+    def is_running(self):
+        return self.process is not None
+
+
+def test_get_current_sample():
+    samples = {"api": dict(EMPTY_SAMPLE, pid=10, rss=1024)}
+
+    assert get_current_sample("api", Service(10), samples)["rss"] == 1024
+
+
+def test_get_current_sample_stopped():
+    samples = {"api": dict(EMPTY_SAMPLE, pid=10, rss=1024)}
+
+    # sampled before it was stopped
+    assert get_current_sample("api", Service(), samples) is EMPTY_SAMPLE
+    assert get_current_sample("api", None, samples) is EMPTY_SAMPLE
+
+
+def test_get_current_sample_restarted():
+    samples = {"api": dict(EMPTY_SAMPLE, pid=10, rss=1024)}
+
+    assert get_current_sample("api", Service(11), samples) is EMPTY_SAMPLE
+    assert get_current_sample("web", Service(12), samples) is EMPTY_SAMPLE
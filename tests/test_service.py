@@ -0,0 +1,48 @@
+import pytest
+
+from locald.service import BACKOFF_SECONDS, RestartPolicy
+
+
+def get_policy(**values):
+    values.setdefault("restart_jitter", "0")
+    return RestartPolicy({"service": values})
+
+
+def test_get_delay_defaults():
+    policy = get_policy()
+
+    assert policy.get_delay(0) == 0
+    assert [policy.get_delay(step) for step in range(1, 5)] == [
+        BACKOFF_SECONDS * 2,
+        BACKOFF_SECONDS * 4,
+        BACKOFF_SECONDS * 8,
+        BACKOFF_SECONDS * 16,
+    ]
+
+
+def test_get_delay_backs_off_from_restart_seconds():
+    policy = get_policy(restart_seconds="0.5", restart_backoff="3")
+
+    assert [policy.get_delay(step) for step in range(4)] == [
+        0.5,
+        1.5,
+        4.5,
+        13.5,
+    ]
+
+
+def test_get_delay_is_capped():
+    policy = get_policy(restart_seconds="1", restart_max_seconds="10")
+
+    assert policy.get_delay(3) == 8
+    assert policy.get_delay(4) == 10
+    assert policy.get_delay(50) == 10
+
+
+@pytest.mark.parametrize("step", [0, 1, 5])
+def test_get_delay_jitter(step):
+    policy = get_policy(restart_seconds="2", restart_jitter="0.1")
+    delay = get_policy(restart_seconds="2").get_delay(step)
+
+    for _ in range(100):
+        assert delay * 0.9 <= policy.get_delay(step) <= delay * 1.1
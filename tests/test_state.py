@@ -0,0 +1,81 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from locald.state import create_output_pipe, get_output_inode, reopen_output
+
+
+pytestmark = pytest.mark.skipif(
+    not os.path.isdir("/proc/self/fd"),
+    reason="output is reopened through /proc",
+)
+
+
+def start(code):
+    stdout, fd = create_output_pipe()
+
+    try:
+        process = subprocess.Popen(
+            [sys.executable, "-u", "-c", code],
+            stdout=fd,
+            stderr=subprocess.STDOUT,
+        )
+    finally:
+        os.close(fd)
+
+    return process, stdout
+
+
+def read_line(stdout):
+    os.set_blocking(stdout.fileno(), True)
+    return stdout.readline()
+
+
+def test_output_outlives_its_reader():
+    process, stdout = start(
+        "import time; print('one'); time.sleep(0.2); print('two'); "
+        "time.sleep(0.5)"
+    )
+    inode = get_output_inode(stdout)
+
+    try:
+        assert read_line(stdout) == b"one\n"
+        stdout.close()
+
+        # written while nothing was reading, without a SIGPIPE
+        time.sleep(0.4)
+
+        stdout = reopen_output(process.pid, inode)
+        assert stdout is not None
+        assert read_line(stdout) == b"two\n"
+
+        assert process.wait(5) == 0
+        assert stdout.read() == b""
+    finally:
+        process.kill()
+        process.wait()
+        stdout.close()
+
+
+def test_reopen_output_other_pipe():
+    process, stdout = start("import time; time.sleep(5)")
+
+    try:
+        assert reopen_output(process.pid, get_output_inode(stdout) + 1) is None
+    finally:
+        process.kill()
+        process.wait()
+        stdout.close()
+
+
+def test_reopen_output_no_process():
+    process, stdout = start("pass")
+    process.wait()
+
+    try:
+        assert reopen_output(process.pid, get_output_inode(stdout)) is None
+    finally:
+        stdout.close()